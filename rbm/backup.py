@@ -0,0 +1,444 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Content addressed storage for builder and ring backups.
+
+Every backed up version of a file is stored once under its md5sum as
+objects/<first two hex digits>/<md5sum>, no matter how often it's backed up.
+Each backup is also recorded as a line of json in the manifest, which
+is what tells you which file a version belonged to and when it was taken.
+
+A backup never shares its inode with the file it backs up, since
+swift-ring-builder rewrites builders in place and would silently change a
+hardlinked backup along with them. Backups are reflinks, which are copy on
+write, where the filesystem supports them and copies otherwise, or if
+compression is enabled.
+
+Old backups are pruned according to a retention policy using only the
+manifest, the objects directory is never listed.
+"""
+
+import os
+from contextlib import contextmanager
+from errno import EEXIST, ENOENT
+from fcntl import ioctl, flock, LOCK_EX, LOCK_UN
+from gzip import GzipFile
+from hashlib import md5
+from time import time
+from uuid import uuid4
+from os.path import basename, dirname, join as pathjoin
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+# ioctl that clones a files extents (btrfs, xfs) on Linux
+FICLONE = 0x40049409
+GZIP_MAGIC = '\x1f\x8b'
+
+
+def makedirs(path):
+    """ create a directory and its parents unless they already exist """
+    try:
+        os.makedirs(path)
+    except OSError, err:
+        if err.errno != EEXIST:
+            raise
+
+
+def store_backup(store, filename, digest=None):
+    """ back up a file to a BackupStore
+
+    This is what gets run in the executor, so it's a module level function.
+
+    :params store: the BackupStore to use
+    :params filename: the file to back up
+    :params digest: md5sum of filename, if already known
+    :returns: md5sum of filename
+    """
+    return store.store(filename, digest)
+
+
+def prune_backups(store, now=None):
+    """ prune a BackupStore according to its retention policy
+
+    :params store: the BackupStore to prune
+    :params now: the time to apply the policy at, defaults to now
+    :returns: tuple of the number of pruned backups and reclaimed bytes
+    """
+    return store.prune(now)
+
+
+class ObjectWriter(object):
+    """ writes a new object to a BackupStore as its bytes are written
+    elsewhere, see BackupStore.writer and BackupStore.commit """
+
+    def __init__(self, store):
+        makedirs(store.objects_dir)
+        self.store = store
+        self.tmppath = pathjoin(store.objects_dir, '.tmp.%s' % uuid4().hex)
+        self.fp = open(self.tmppath, 'wb')
+        self.out = None
+        self.compressed = False
+
+    def write(self, data):
+        if self.out is None:
+            self.compressed = self.store.compress and \
+                data[:2] != GZIP_MAGIC
+            if self.compressed:
+                self.out = GzipFile(fileobj=self.fp, mode='wb')
+            else:
+                self.out = self.fp
+        self.out.write(data)
+
+    def close(self):
+        if self.compressed:
+            self.out.close()
+        self.fp.close()
+
+    def abort(self):
+        """ give up on the object """
+        self.fp.close()
+        try:
+            os.unlink(self.tmppath)
+        except OSError:
+            pass
+
+
+class BackupStore(object):
+    """ a deduplicated store of builder and ring backups
+
+    :params backup_dir: directory the store lives in
+    :params compress: whether to gzip stored objects. Files that are already
+                      gzipped (such as rings) are never compressed again.
+    :params chunk_size: chunk size used when copying files
+    :params keep_last: number of most recent backups to keep of each file
+    :params keep_hourly: number of hours to keep the last backup of each
+                         hour for
+    :params keep_daily: number of days to keep the last backup of each
+                        day for
+    :params max_size: maximum total size of the kept backups in bytes, or 0
+                      for no limit. The latest backup of each file is kept
+                      even if that exceeds max_size.
+    """
+
+    def __init__(self, backup_dir, compress=False, chunk_size=65536,
+                 keep_last=10, keep_hourly=24, keep_daily=30, max_size=0):
+        self.backup_dir = backup_dir
+        self.objects_dir = pathjoin(backup_dir, 'objects')
+        self.manifest = pathjoin(backup_dir, 'manifest')
+        self.lock_path = pathjoin(backup_dir, 'manifest.lock')
+        self.compress = compress
+        self.chunk_size = chunk_size
+        self.keep_last = keep_last
+        self.keep_hourly = keep_hourly
+        self.keep_daily = keep_daily
+        self.max_size = max_size
+
+    def object_path(self, digest, compressed=False):
+        """ get the path an object is stored at
+
+        :params digest: md5sum of the objects contents
+        :params compressed: whether the object is gzipped
+        :returns: path of the object
+        """
+        path = pathjoin(self.objects_dir, digest[:2], digest)
+        if compressed:
+            path += '.gz'
+        return path
+
+    def find(self, digest):
+        """ find a stored object
+
+        :params digest: md5sum of the wanted contents
+        :returns: path of the object or None if it isn't stored
+        """
+        if len(digest) != 32 or '/' in digest:
+            return None
+        for path in (self.object_path(digest),
+                     self.object_path(digest, compressed=True)):
+            if os.path.exists(path):
+                return path
+        return None
+
+    def open(self, digest):
+        """ open a stored object for reading, decompressing it if needed
+
+        :params digest: md5sum of the wanted contents
+        :returns: file like object
+        :raises: IOError if no such object is stored
+        """
+        path = self.find(digest)
+        if not path:
+            raise IOError(ENOENT, 'No backup with md5sum %s' % digest)
+        if path.endswith('.gz'):
+            return GzipFile(path, 'rb')
+        return open(path, 'rb')
+
+    def entries(self):
+        """ read the manifest
+
+        :returns: list of manifest entries, oldest first
+        """
+        entries = []
+        try:
+            with open(self.manifest, 'rb') as mfile:
+                for line in mfile:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue  # torn write
+        except IOError, err:
+            if err.errno != ENOENT:
+                raise
+        return entries
+
+    @contextmanager
+    def _locked(self):
+        """ hold the store lock, which guards the manifest and keeps objects
+        from being pruned while they're being backed up again. """
+        makedirs(self.backup_dir)
+        fd = os.open(self.lock_path, os.O_WRONLY | os.O_CREAT, 0644)
+        try:
+            flock(fd, LOCK_EX)
+            try:
+                yield
+            finally:
+                flock(fd, LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def _record(self, name, digest, size, sha256sum=None):
+        """ append an entry to the manifest, the store lock must be held """
+        entry = {'time': time(), 'name': name, 'digest': digest,
+                 'size': size}
+        if sha256sum:
+            entry['sha256'] = sha256sum
+        line = json.dumps(entry) + '\n'
+        fd = os.open(self.manifest, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _clone(src, tmppath):
+        """ reflink src to tmppath
+
+        :returns: True on success, False if the file has to be copied
+        """
+        try:
+            fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError:
+            return False
+        try:
+            ioctl(fd, FICLONE, src.fileno())
+            return True
+        except (IOError, OSError):
+            os.unlink(tmppath)
+            return False
+        finally:
+            os.close(fd)
+
+    def _copy(self, src, tmppath, compress):
+        """ copy src to tmppath, computing its md5sum along the way
+
+        :returns: md5sum of src
+        """
+        md5sum = md5()
+        with open(tmppath, 'wb') as dst:
+            out = GzipFile(fileobj=dst, mode='wb') if compress else dst
+            block = src.read(self.chunk_size)
+            while block:
+                md5sum.update(block)
+                out.write(block)
+                block = src.read(self.chunk_size)
+            if compress:
+                out.close()
+        return md5sum.hexdigest()
+
+    def _hash(self, path):
+        md5sum = md5()
+        with open(path, 'rb') as fp:
+            block = fp.read(self.chunk_size)
+            while block:
+                md5sum.update(block)
+                block = fp.read(self.chunk_size)
+        return md5sum.hexdigest()
+
+    def _ingest(self, filename, digest):
+        """ add a file to the objects, the store lock must be held
+
+        :params filename: the file to add
+        :params digest: md5sum of filename, if already known
+        :returns: md5sum of filename
+        """
+        makedirs(self.objects_dir)
+        tmppath = pathjoin(self.objects_dir, '.tmp.%s' % uuid4().hex)
+        try:
+            with open(filename, 'rb') as src:
+                compress = self.compress and src.read(2) != GZIP_MAGIC
+                src.seek(0)
+                if not compress and self._clone(src, tmppath):
+                    if not digest:
+                        digest = self._hash(tmppath)
+                else:
+                    digest = self._copy(src, tmppath, compress)
+            if self.find(digest):
+                os.unlink(tmppath)
+            else:
+                path = self.object_path(digest, compress)
+                makedirs(dirname(path))
+                os.rename(tmppath, path)
+        except Exception:
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+            raise
+        return digest
+
+    def store(self, filename, digest=None, sha256sum=None, name=None):
+        """ back up a file
+
+        If digest is given and an object with that digest is already
+        stored, the file isn't read at all. Otherwise it's read at most
+        once, either to hash a clone of it or while copying it.
+
+        The caller has to make sure filename isn't replaced while it's being
+        backed up, or digest may end up describing the wrong contents.
+
+        :params filename: the file to back up
+        :params digest: md5sum of filename, if already known
+        :params sha256sum: sha256 of filename to record, if known
+        :params name: name to record the backup under, defaults to the
+                      basename of filename
+        :returns: md5sum of filename
+        """
+        with self._locked():
+            if not digest or not self.find(digest):
+                digest = self._ingest(filename, digest)
+            self._record(name or basename(filename), digest,
+                         os.path.getsize(self.find(digest)), sha256sum)
+        return digest
+
+    def writer(self):
+        """ start writing a new object
+
+        :returns: an ObjectWriter to write the objects contents to, which
+                  has to be passed to commit or aborted.
+        """
+        return ObjectWriter(self)
+
+    def commit(self, writer, name, digest, sha256sum=None):
+        """ add an object written with an ObjectWriter to the store
+
+        :params writer: the ObjectWriter the object was written with
+        :params name: name of the file the object is a backup of
+        :params digest: md5sum of the objects contents
+        :params sha256sum: sha256 of the objects contents to record, if known
+        """
+        writer.close()
+        try:
+            with self._locked():
+                if self.find(digest):
+                    os.unlink(writer.tmppath)
+                else:
+                    path = self.object_path(digest, writer.compressed)
+                    makedirs(dirname(path))
+                    os.rename(writer.tmppath, path)
+                self._record(name, digest,
+                             os.path.getsize(self.find(digest)), sha256sum)
+        except Exception:
+            writer.abort()
+            raise
+
+    def retained(self, entries, now):
+        """ apply the retention policy to a list of manifest entries
+
+        :params entries: manifest entries, oldest first
+        :params now: the time to apply the policy at
+        :returns: the entries to keep, oldest first
+        """
+        keep = set()
+        latest = set()
+        by_name = {}
+        for i, entry in enumerate(entries):
+            by_name.setdefault(entry['name'], []).append(i)
+        for indexes in by_name.itervalues():
+            indexes.reverse()
+            latest.add(indexes[0])
+            keep.update(indexes[:max(self.keep_last, 1)])
+            for window, period in ((self.keep_hourly, 3600),
+                                   (self.keep_daily, 86400)):
+                seen = set()
+                for i in indexes:
+                    if now - entries[i]['time'] >= window * period:
+                        continue
+                    bucket = int(entries[i]['time'] // period)
+                    if bucket not in seen:
+                        seen.add(bucket)
+                        keep.add(i)
+        if self.max_size:
+            sizes = {}
+            refs = {}
+            for i in keep:
+                sizes[entries[i]['digest']] = entries[i]['size']
+                refs[entries[i]['digest']] = \
+                    refs.get(entries[i]['digest'], 0) + 1
+            total = sum(sizes.itervalues())
+            for i in sorted(keep):
+                if total <= self.max_size:
+                    break
+                if i in latest:
+                    continue
+                keep.remove(i)
+                digest = entries[i]['digest']
+                refs[digest] -= 1
+                if not refs[digest]:
+                    total -= sizes[digest]
+        return [entries[i] for i in sorted(keep)]
+
+    def prune(self, now=None):
+        """ drop the backups the retention policy doesn't keep
+
+        The manifest is rewritten without the dropped backups and objects
+        no longer referenced by it are deleted.
+
+        :params now: the time to apply the policy at, defaults to now
+        :returns: tuple of the number of pruned backups and reclaimed bytes
+        """
+        if now is None:
+            now = time()
+        reclaimed = 0
+        with self._locked():
+            entries = self.entries()
+            keep = self.retained(entries, now)
+            if len(keep) == len(entries):
+                return 0, 0
+            tmppath = '%s.%s' % (self.manifest, uuid4().hex)
+            with open(tmppath, 'wb') as mfile:
+                for entry in keep:
+                    mfile.write(json.dumps(entry) + '\n')
+            os.rename(tmppath, self.manifest)
+            kept = set(entry['digest'] for entry in keep)
+            for digest in set(entry['digest'] for entry in entries) - kept:
+                path = self.find(digest)
+                if not path:
+                    continue
+                reclaimed += os.path.getsize(path)
+                os.unlink(path)
+        return len(entries) - len(keep), reclaimed
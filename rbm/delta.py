@@ -0,0 +1,177 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compact deltas between two versions of a ring.
+
+A delta holds the partition assignments and device table entries that
+differ between two rings. It is served as gzipped json by
+GET /ring/<type>/delta?from=<hash> and can be applied to the old ring
+with apply_ring_delta::
+
+    from gzip import GzipFile
+    from swift.common.ring import RingData
+    from rbm.delta import load_delta, apply_ring_delta
+
+    old = RingData.load('/etc/swift/object.ring.gz')
+    new = apply_ring_delta(old, load_delta(response_body))
+    new.save('/etc/swift/object.ring.gz')
+
+gzip headers carry a timestamp, so the file a client saves won't have the
+md5sum of the ring on the server. Instead the delta carries a digest of the
+ring contents (see ring_digest) which apply_ring_delta verifies.
+"""
+
+import sys
+from array import array
+from copy import deepcopy
+from gzip import GzipFile
+from hashlib import md5
+from itertools import izip
+from StringIO import StringIO
+from swift.common.ring import RingData
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+DELTA_VERSION = 1
+
+
+class RingDeltaError(Exception):
+        pass
+
+
+def ring_digest(ring_data):
+    """ Compute a digest of the contents of a ring that doesn't depend on
+    how the ring was serialized.
+
+    :params ring_data: RingData instance
+    :returns: hex digest
+    """
+    digest = md5()
+    digest.update(json.dumps(ring_data.devs, sort_keys=True))
+    digest.update('%d' % ring_data._part_shift)
+    for part2dev in ring_data._replica2part2dev_id:
+        part2dev = array('H', part2dev)
+        if sys.byteorder != 'little':
+            part2dev.byteswap()
+        digest.update('%d:' % len(part2dev))
+        digest.update(part2dev.tostring())
+    return digest.hexdigest()
+
+
+def make_ring_delta(old, new):
+    """ Compute the delta between two rings
+
+    :params old: RingData instance of the ring the client has
+    :params new: RingData instance of the ring the client wants
+    :returns: delta dict
+    """
+    devs = {}
+    for dev_id in xrange(max(len(old.devs), len(new.devs))):
+        old_dev = old.devs[dev_id] if dev_id < len(old.devs) else None
+        new_dev = new.devs[dev_id] if dev_id < len(new.devs) else None
+        if old_dev != new_dev:
+            devs[str(dev_id)] = new_dev
+    replicas = []
+    for replica, new_part2dev in enumerate(new._replica2part2dev_id):
+        if replica < len(old._replica2part2dev_id):
+            old_part2dev = old._replica2part2dev_id[replica]
+        else:
+            old_part2dev = []
+        parts = []
+        dev_ids = []
+        last_part = 0
+        for part, (old_dev_id, new_dev_id) in enumerate(
+                izip(old_part2dev, new_part2dev)):
+            if old_dev_id != new_dev_id:
+                parts.append(part - last_part)
+                dev_ids.append(new_dev_id)
+                last_part = part
+        for part in xrange(len(old_part2dev), len(new_part2dev)):
+            parts.append(part - last_part)
+            dev_ids.append(new_part2dev[part])
+            last_part = part
+        # parts are stored as gaps between changed partitions
+        replicas.append({'length': len(new_part2dev), 'parts': parts,
+                         'devs': dev_ids})
+    return {'version': DELTA_VERSION, 'part_shift': new._part_shift,
+            'dev_count': len(new.devs), 'devs': devs, 'replicas': replicas,
+            'to_digest': ring_digest(new)}
+
+
+def apply_ring_delta(old, delta):
+    """ Apply a delta to a ring
+
+    :params old: RingData instance of the ring the delta was computed from
+    :params delta: delta dict
+    :returns: RingData instance of the new ring
+    :raises: RingDeltaError if the result doesn't match the delta's digest
+    """
+    if delta.get('version') != DELTA_VERSION:
+        raise RingDeltaError('Unsupported delta version %s' %
+                             delta.get('version'))
+    replica2part2dev_id = []
+    for replica, change in enumerate(delta['replicas']):
+        if replica < len(old._replica2part2dev_id):
+            part2dev = array('H', old._replica2part2dev_id[replica])
+        else:
+            part2dev = array('H')
+        if len(part2dev) > change['length']:
+            del part2dev[change['length']:]
+        else:
+            part2dev.extend([0] * (change['length'] - len(part2dev)))
+        part = 0
+        for gap, dev_id in izip(change['parts'], change['devs']):
+            part += gap
+            part2dev[part] = dev_id
+        replica2part2dev_id.append(part2dev)
+    devs = deepcopy(old.devs[:delta['dev_count']])
+    devs.extend([None] * (delta['dev_count'] - len(devs)))
+    for dev_id, dev in delta['devs'].iteritems():
+        devs[int(dev_id)] = dev
+    new = RingData(replica2part2dev_id, devs, delta['part_shift'])
+    if ring_digest(new) != delta['to_digest']:
+        raise RingDeltaError('Ring digest mismatch after applying delta')
+    return new
+
+
+def dump_delta(delta):
+    """ Serialize a delta as gzipped json """
+    buf = StringIO()
+    gz_file = GzipFile(fileobj=buf, mode='wb')
+    json.dump(delta, gz_file, separators=(',', ':'))
+    gz_file.close()
+    return buf.getvalue()
+
+
+def load_delta(data):
+    """ Deserialize a delta produced by dump_delta """
+    return json.load(GzipFile(fileobj=StringIO(data), mode='rb'))
+
+
+def make_ring_delta_file(old_file, new_file, from_hash, to_hash):
+    """ Compute the serialized delta between two ring files
+
+    :params old_file: path of the ring the client has
+    :params new_file: path of the ring the client wants
+    :params from_hash: md5sum of old_file
+    :params to_hash: md5sum of new_file
+    :returns: the serialized delta
+    """
+    delta = make_ring_delta(RingData.load(old_file), RingData.load(new_file))
+    delta['from'] = from_hash
+    delta['to'] = to_hash
+    return dump_delta(delta)
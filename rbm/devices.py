@@ -0,0 +1,261 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from binascii import hexlify
+from bisect import bisect_left, bisect_right
+from fnmatch import fnmatchcase
+from socket import inet_pton, AF_INET, AF_INET6, error as socket_error
+
+
+class DeviceIndex(object):
+    """ Index of a builders devices by id and by (ip, port, device)
+
+    Building the index takes a single pass over the devices, after which
+    lookups are O(1). Devices added to the builder after the index was built
+    have to be added to the index as well.
+
+    :params devs: a builders devs list
+    """
+
+    def __init__(self, devs):
+        self.by_id = {}
+        self.by_location = {}
+        self.next_id = 0
+        for dev in devs:
+            if dev is not None:
+                self.add(dev)
+
+    def add(self, dev):
+        """ add a device to the index
+
+        :params dev: the device dict
+        """
+        self.by_id[dev['id']] = dev
+        self.by_location[(dev['ip'], dev['port'], dev['device'])] = dev
+        self.next_id = max(self.next_id, dev['id'] + 1)
+
+    def get(self, dev_id):
+        """ look a device up by id
+
+        :params dev_id: id of the device
+        :returns: the device dict or None
+        """
+        return self.by_id.get(dev_id)
+
+    def find(self, ipaddr, port, device_name):
+        """ look a device up by its location
+
+        :params ipaddr: ip of the device
+        :params port: port of the device
+        :params device_name: name of the device
+        :returns: the device dict or None
+        """
+        return self.by_location.get((ipaddr, port, device_name))
+
+
+def parse_ip(ipaddr):
+    """ convert an ip address to a comparable form
+
+    :params ipaddr: an IPv4 or IPv6 address
+    :returns: tuple of the address family and the address as an int, or None
+              if ipaddr isn't an ip address
+    """
+    for family in (AF_INET, AF_INET6):
+        try:
+            packed = inet_pton(family, ipaddr)
+        except (socket_error, TypeError, ValueError):
+            continue
+        return family, int(hexlify(packed), 16)
+    return None
+
+
+def parse_cidr(cidr):
+    """ convert a CIDR block to a range of addresses
+
+    :params cidr: an IPv4 or IPv6 CIDR block, such as 10.0.0.0/24
+    :returns: tuple of the lowest and highest address, as returned by
+              parse_ip
+    :raises: ValueError if cidr isn't a CIDR block
+    """
+    ipaddr, _junk, bits = cidr.partition('/')
+    addr = parse_ip(ipaddr)
+    if not addr:
+        raise ValueError('Invalid CIDR block %s' % cidr)
+    family, value = addr
+    width = 32 if family == AF_INET else 128
+    try:
+        bits = int(bits)
+    except ValueError:
+        raise ValueError('Invalid CIDR block %s' % cidr)
+    if not 0 <= bits <= width:
+        raise ValueError('Invalid CIDR block %s' % cidr)
+    hostmask = (1 << (width - bits)) - 1
+    return (family, value & ~hostmask), (family, value | hostmask)
+
+
+class DeviceSearchIndex(object):
+    """ Secondary indexes over a builders devices for structured searches
+
+    A search filter is a dict of fields and the values to match, all of
+    which have to match, or "and"/"or" with a list of filters:
+
+        {"zone": [1, 2], "weight": {"min": 1.5},
+         "or": [{"ip": "10.0.0.0/24"}, {"device": "sd[a-c]"}]}
+
+    id, region, zone, port and weight match a number, a list of numbers or a
+    {"min": x, "max": y} range. ip matches an address or a CIDR block, device
+    matches a glob and meta matches a substring. Each of them also accepts a
+    list of values, any of which may match.
+
+    :params devs: a builders devs list. The devices must not be modified
+                  while the index is in use.
+    """
+
+    numeric_fields = ('id', 'region', 'zone', 'port', 'weight')
+    text_fields = ('ip', 'device', 'meta')
+
+    def __init__(self, devs):
+        self.devs = {}
+        numeric = dict((field, []) for field in self.numeric_fields)
+        self.text = dict((field, {}) for field in self.text_fields)
+        addrs = []
+        for dev in devs:
+            if dev is None:
+                continue
+            self.devs[dev['id']] = dev
+            for field in self.numeric_fields:
+                if dev.get(field) is not None:
+                    numeric[field].append((dev[field], dev['id']))
+            for field in self.text_fields:
+                self.text[field].setdefault(dev.get(field) or '',
+                                            set()).add(dev['id'])
+            addr = parse_ip(dev.get('ip'))
+            if addr:
+                addrs.append((addr, dev['id']))
+        self.numeric = {}
+        for field, entries in numeric.iteritems():
+            entries.sort()
+            self.numeric[field] = ([key for key, _junk in entries],
+                                   [dev_id for _junk, dev_id in entries])
+        addrs.sort()
+        self.addrs = ([key for key, _junk in addrs],
+                      [dev_id for _junk, dev_id in addrs])
+
+    @staticmethod
+    def _range(index, low, high):
+        """ ids of the entries of a sorted index between low and high """
+        keys, ids = index
+        return set(ids[bisect_left(keys, low):bisect_right(keys, high)])
+
+    @staticmethod
+    def _is_number(value):
+        return isinstance(value, (int, long, float)) and \
+            not isinstance(value, bool)
+
+    def _match_numeric(self, field, value):
+        if isinstance(value, dict):
+            low = value.get('min', float('-inf'))
+            high = value.get('max', float('inf'))
+            if set(value) - set(['min', 'max']) or \
+                    not self._is_number(low) or not self._is_number(high):
+                raise ValueError('Invalid range for %s' % field)
+            return self._range(self.numeric[field], low, high)
+        if not self._is_number(value):
+            raise ValueError('Invalid value for %s' % field)
+        return self._range(self.numeric[field], value, value)
+
+    def _match_text(self, field, value):
+        if not isinstance(value, basestring):
+            raise ValueError('Invalid value for %s' % field)
+        if field == 'ip' and '/' in value:
+            low, high = parse_cidr(value)
+            return self._range(self.addrs, low, high)
+        values = self.text[field]
+        if field == 'meta':
+            matches = [ids for meta, ids in values.iteritems()
+                       if value in meta]
+        elif field == 'device' and any(c in value for c in '*?['):
+            matches = [ids for device, ids in values.iteritems()
+                       if fnmatchcase(device, value)]
+        else:
+            matches = [values.get(value, ())]
+        return set().union(*matches)
+
+    def _match(self, field, value):
+        """ ids of the devices whos field matches value """
+        if field in self.numeric_fields:
+            match = self._match_numeric
+        elif field in self.text_fields:
+            match = self._match_text
+        else:
+            raise ValueError('Unknown search field %s' % field)
+        if isinstance(value, list):
+            return set().union(*[match(field, v) for v in value])
+        return match(field, value)
+
+    def search(self, search_filter):
+        """ find the devices matching a filter
+
+        :params search_filter: the filter, see the class docstring
+        :returns: set of the matching device ids
+        :raises: ValueError if the filter is malformed
+        """
+        if not isinstance(search_filter, dict) or not search_filter:
+            raise ValueError('Filters must be non empty objects')
+        result = None
+        for field, value in search_filter.iteritems():
+            if field in ('and', 'or'):
+                if not isinstance(value, list) or not value:
+                    raise ValueError('%s takes a non empty list of filters' %
+                                     field)
+                matches = [self.search(f) for f in value]
+                if field == 'and':
+                    ids = set.intersection(*matches)
+                else:
+                    ids = set.union(*matches)
+            else:
+                ids = self._match(field, value)
+            result = ids if result is None else result & ids
+        return result
+
+    def page(self, sort='id', marker=None, limit=None):
+        """ get a page of the device ids ordered by a numeric field
+
+        Devices with equal values are ordered by id, so the order is stable.
+
+        :params sort: the numeric field to order by
+        :params marker: id of the last device of the previous page
+        :params limit: maximum number of ids to return
+        :returns: tuple of the list of ids and whether more ids follow
+        :raises: ValueError if sort or marker are invalid
+        """
+        if sort not in self.numeric_fields:
+            raise ValueError('Invalid sort field %s' % sort)
+        keys, ids = self.numeric[sort]
+        start = 0
+        if marker is not None:
+            if sort == 'id':
+                start = bisect_right(keys, marker)
+            else:
+                dev = self.devs.get(marker)
+                if dev is None:
+                    raise ValueError('Unknown marker %s' % marker)
+                low = bisect_left(keys, dev[sort])
+                high = bisect_right(keys, dev[sort])
+                start = bisect_right(ids, marker, low, high)
+        end = len(ids) if limit is None else start + limit
+        return ids[start:end], end < len(ids)
+
+    def devices(self, dev_ids):
+        """ the devices with the given ids, ordered by id """
+        return [self.devs[dev_id] for dev_id in sorted(dev_ids)]
@@ -0,0 +1,234 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import cPickle as pickle
+from collections import deque
+from contextlib import contextmanager
+from fcntl import fcntl, F_GETFL, F_SETFL
+from eventlet import sleep, tpool, Timeout
+from eventlet.green import os as green_os
+from eventlet.event import Event
+from eventlet.semaphore import Semaphore
+
+
+class ExecutorBusy(Exception):
+        pass
+
+
+class ExecutorError(Exception):
+        pass
+
+
+class QueueFull(Exception):
+        pass
+
+
+class QueueTimeout(Exception):
+        pass
+
+
+def _run_child(wfd, func, args):
+    """ call func in a forked worker and write the pickled outcome to wfd,
+    never returning into the parent's code. """
+    try:
+        try:
+            outcome = (True, func(*args))
+        except Exception as err:
+            outcome = (False, err)
+        try:
+            data = pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)
+        except Exception as err:
+            data = pickle.dumps((False, ExecutorError(str(err))),
+                                pickle.HIGHEST_PROTOCOL)
+        while data:
+            data = data[os.write(wfd, data):]
+    finally:
+        os._exit(0)
+
+
+class Executor(object):
+    """ Runs CPU bound calls off the eventlet hub
+
+    In tpool mode calls are run in eventlets native thread pool, in process
+    mode each call is run in a forked worker process and in inline mode
+    they're simply called directly. At most pool_size calls run at once and
+    at most queue_size more may be waiting for their turn, any further calls
+    are refused with ExecutorBusy.
+
+    Calls made in process mode have their return values pickled, so func
+    has to return anything it modified. The result is read back with green
+    reads rather than through a multiprocessing pool, whose helper threads
+    would block the hub once the threading module is monkey patched, as
+    swift's wsgi server does.
+    """
+
+    modes = ('tpool', 'process', 'inline')
+
+    def __init__(self, mode='tpool', pool_size=4, queue_size=32,
+                 poll_interval=0.01):
+        if mode not in self.modes:
+            raise ValueError('Invalid executor mode: %s' % mode)
+        self.mode = mode
+        self.pool_size = pool_size
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.semaphore = Semaphore(pool_size)
+        self.pending = 0
+
+    @property
+    def busy(self):
+        """ whether further calls would be refused """
+        return self.pending >= self.pool_size + self.queue_size
+
+    def _call_in_process(self, func, args):
+        """ run func in a forked worker process, yielding to the hub while
+        the worker is busy. """
+        rfd, wfd = os.pipe()
+        try:
+            pid = os.fork()
+        except OSError:
+            os.close(rfd)
+            os.close(wfd)
+            raise
+        if not pid:
+            os.close(rfd)
+            _run_child(wfd, func, args)
+        os.close(wfd)
+        chunks = []
+        try:
+            fcntl(rfd, F_SETFL, fcntl(rfd, F_GETFL) | os.O_NONBLOCK)
+            while True:
+                chunk = green_os.read(rfd, 65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            os.close(rfd)
+            while not os.waitpid(pid, os.WNOHANG)[0]:
+                sleep(self.poll_interval)
+        if not chunks:
+            raise ExecutorError('Worker %d exited without a result' % pid)
+        ok, result = pickle.loads(''.join(chunks))
+        if not ok:
+            raise result
+        return result
+
+    def call(self, func, *args):
+        """ call func with args and wait for its result
+
+        :params func: the function to call
+        :returns: the return value of func
+        :raises: ExecutorBusy if too many calls are already waiting
+        """
+        if self.mode == 'inline':
+            return func(*args)
+        if self.busy:
+            raise ExecutorBusy('%d calls pending' % self.pending)
+        self.pending += 1
+        try:
+            self.semaphore.acquire()
+            try:
+                if self.mode == 'tpool':
+                    return tpool.execute(func, *args)
+                return self._call_in_process(func, args)
+            finally:
+                self.semaphore.release()
+        finally:
+            self.pending -= 1
+
+
+class MutationQueue(object):
+    """ Serializes the greenthreads of a process in FIFO order
+
+    At most depth greenthreads may wait for their turn, further ones are
+    refused with QueueFull. A greenthread that hasn't had its turn after
+    timeout seconds gives up with QueueTimeout.
+
+    Turns may record the change they made from one version of what's being
+    changed to another, so that greenthreads that waited behind them can
+    rebase the version they expected onto the current one.
+    """
+
+    def __init__(self, depth=16, timeout=30):
+        self.depth = depth
+        self.timeout = timeout
+        self.waiters = deque()
+        self.busy = False
+        self.changes = []
+
+    def _release(self):
+        """ hand the turn to the next waiter, if any """
+        if self.waiters:
+            self.waiters.popleft().send()
+        else:
+            self.busy = False
+            # nobody who waited behind the changes is left to rebase
+            del self.changes[:]
+
+    def changed(self, old, new):
+        """ record a change made during the current turn
+
+        :params old: the version that was changed
+        :params new: the version it was changed to
+        """
+        self.changes.append((old, new))
+
+    def rebase(self, version, since):
+        """ follow a version through the changes recorded while waiting
+
+        :params version: the version expected when getting in line
+        :params since: what turn gave when getting in line
+        :returns: what version became through those changes, or version
+                  itself if none of them changed it
+        """
+        for old, new in self.changes[since:]:
+            if old == version:
+                version = new
+        return version
+
+    def _wait(self):
+        """ wait until the turn is handed to us """
+        if len(self.waiters) >= self.depth:
+            raise QueueFull('%d waiting' % len(self.waiters))
+        event = Event()
+        self.waiters.append(event)
+        try:
+            with Timeout(self.timeout, QueueTimeout('waited %ss' %
+                                                    self.timeout)):
+                event.wait()
+        except QueueTimeout:
+            if event.ready():
+                # the turn was handed to us just as we gave up
+                self._release()
+            else:
+                self.waiters.remove(event)
+            raise
+
+    @contextmanager
+    def turn(self):
+        """ wait for and hold our turn
+
+        :returns: the position in the recorded changes to rebase from
+        :raises: QueueFull or QueueTimeout
+        """
+        since = len(self.changes)
+        if self.busy:
+            self._wait()
+        else:
+            self.busy = True
+        try:
+            yield since
+        finally:
+            self._release()
@@ -13,19 +13,37 @@
 
 
 import os
-import shutil
+import random
+from io import BytesIO
+from tempfile import mkstemp
 from hashlib import md5
-from errno import EEXIST
+from copy import deepcopy
+from itertools import izip
+from uuid import uuid4
+from multiprocessing import cpu_count
+from errno import ENOENT, EAGAIN, EEXIST
+from fcntl import flock, LOCK_SH, LOCK_EX, LOCK_NB, LOCK_UN
+from contextlib import contextmanager, nested
+from gzip import GzipFile
 import cPickle as pickle
 from webob import Request
-from eventlet import sleep
+from eventlet import sleep, spawn_n, GreenPile
 from urllib import quote, unquote
+from urlparse import parse_qs
+from email.utils import formatdate, parsedate_tz, mktime_tz
 from time import gmtime, strftime, time
-from os.path import basename, join as pathjoin, getsize
+from os.path import basename, dirname, join as pathjoin
 from swift.common.ring import RingBuilder
-from swift.common.utils import split_path, get_logger, lock_file
+from swift.common.utils import split_path, get_logger, TRUE_VALUES
 from swift.common.exceptions import LockTimeout, RingBuilderError, \
     RingValidationError
+from rbm.executor import Executor, ExecutorBusy, MutationQueue, \
+    QueueFull, QueueTimeout
+from rbm.delta import make_ring_delta_file
+from rbm.backup import BackupStore, store_backup, prune_backups
+from rbm.writer import write_file
+from rbm.devices import DeviceIndex, DeviceSearchIndex
+from rbm.stats import builder_stats
 try:
     import simplejson as json
 except ImportError:
@@ -33,37 +51,426 @@ except ImportError:
 
 
 class FileIterable(object):
-    def __init__(self, filename):
-        self.filename = filename
+    def __init__(self, fileobj, chunk_size=65536, start=0, end=None):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.start = start
+        self.end = end
 
     def __iter__(self):
-        return FileIterator(self.filename)
+        return FileIterator(self.fileobj, self.chunk_size, self.start,
+                            self.end)
+
+    def close(self):
+        self.fileobj.close()
+
+
+class MultipartFileIterable(object):
+    """ serve several byte ranges of an open file as multipart/byteranges
+
+    :params fileobj: the open file to serve
+    :params ranges: list of (start, end) tuples, end being exclusive
+    :params size: total size of the file
+    :params boundary: the multipart boundary to use
+    """
+
+    def __init__(self, fileobj, ranges, size, boundary, chunk_size=65536):
+        self.fileobj = fileobj
+        self.ranges = ranges
+        self.boundary = boundary
+        self.chunk_size = chunk_size
+        self.part_headers = ['--%s\r\nContent-Type: application/octet-stream'
+                             '\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' %
+                             (boundary, start, end - 1, size)
+                             for start, end in ranges]
+        self.trailer = '--%s--\r\n' % boundary
+
+    @property
+    def content_length(self):
+        length = len(self.trailer)
+        for header, (start, end) in zip(self.part_headers, self.ranges):
+            length += len(header) + end - start + 2
+        return length
+
+    def __iter__(self):
+        for header, (start, end) in zip(self.part_headers, self.ranges):
+            yield header
+            for chunk in FileIterator(self.fileobj, self.chunk_size, start,
+                                      end):
+                yield chunk
+            yield '\r\n'
+        yield self.trailer
+
+    def close(self):
+        self.fileobj.close()
 
 
 class FileIterator(object):
+    """ iterate over a byte range of an open file in chunks
 
-    chunk_size = 4096
+    The file is read with plain reads rather than mapped, so a file that's
+    truncated in place while it's being served (swift-ring-builder does
+    rewrite builders in place) only cuts the response short instead of
+    taking down the worker with a SIGBUS.
+    """
 
-    def __init__(self, filename):
-        self.filename = filename
-        self.fileobj = open(self.filename, 'rb')
+    def __init__(self, fileobj, chunk_size=65536, start=0, end=None):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.offset = start
+        self.end = end
+        fileobj.seek(start)
 
     def __iter__(self):
         return self
 
     def next(self):
-        chunk = self.fileobj.read(self.chunk_size)
+        size = self.chunk_size
+        if self.end is not None:
+            size = min(size, self.end - self.offset)
+        chunk = self.fileobj.read(size) if size > 0 else ''
         if not chunk:
             raise StopIteration
+        self.offset += len(chunk)
         return chunk
 
     __next__ = next
 
+
 class RingFileChanged(Exception):
         pass
 
+
+class RebalanceError(Exception):
+        pass
+
+
+class InvalidOperation(Exception):
+        pass
+
+
+def _flock_wait(fd, operation):
+    """ poll for a flock until it's obtained, the caller has to bound the
+    wait with a timeout """
+    while True:
+        try:
+            flock(fd, operation | LOCK_NB)
+            return
+        except IOError, err:
+            if err.errno != EAGAIN:
+                raise
+        sleep(0.01)
+
+
+@contextmanager
+def lock_path(path, timeout=10, shared=False):
+    """ flock a file, like swift.common.utils.lock_file but with support for
+    shared locks. Any number of shared locks may be held at once, while an
+    exclusive lock excludes all others.
+
+    Waiting writers are preferred over new readers, or a steady stream of
+    overlapping readers could keep a writer out forever. Everyone passes a
+    gate, <path>.gate, on the way to the lock. Writers hold the gate
+    exclusively while they wait for the lock, so readers that arrive after
+    a waiting writer queue up behind it.
+
+    :params path: the file to lock, created if it doesn't exist
+    :params timeout: seconds to wait for the lock
+    :params shared: whether to take a shared lock rather than an exclusive one
+    :raises: LockTimeout if the lock couldn't be obtained in time
+    """
+    operation = LOCK_SH if shared else LOCK_EX
+    gate = os.open('%s.gate' % path, os.O_WRONLY | os.O_CREAT, 0644)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0644)
+        try:
+            with LockTimeout(timeout, path):
+                _flock_wait(gate, operation)
+                try:
+                    _flock_wait(fd, operation)
+                finally:
+                    flock(gate, LOCK_UN)
+            yield
+        finally:
+            os.close(fd)
+    finally:
+        os.close(gate)
+
+
+def iter_json_list(items, chunk_size=65536):
+    """ encode a list as json incrementally
+
+    Yields the same json as json.dumps(items), in chunks of roughly
+    chunk_size bytes.
+
+    :params items: the list to encode
+    :params chunk_size: the size of the chunks to yield
+    """
+    chunk = ['[']
+    size = 1
+    for i, item in enumerate(items):
+        encoded = json.dumps(item)
+        if i:
+            encoded = ', ' + encoded
+        chunk.append(encoded)
+        size += len(encoded)
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+def builder_from_dict(builder_data):
+    """Create a builder instance from the output of RingBuilder.to_dict
+
+    :params builder_data: dict of builder data
+    :returns: RingBuilder instance
+    """
+    builder = RingBuilder(1, 1, 1)
+    builder.copy_from(builder_data)
+    return builder
+
+
+def hash_file(filename):
+    """Read a file from disk and compute its md5sum
+
+    :params filename: file to obtain the md5sum of
+    :returns: hex digest of file
+    """
+    md5sum = md5()
+    with open(filename, 'rb') as tfile:
+        block = tfile.read(4096)
+        while block:
+            md5sum.update(block)
+            block = tfile.read(4096)
+    return md5sum.hexdigest()
+
+
+def load_builder(builder_file):
+    """Load a builder file
+
+    Like the other functions run in the executor, builders are passed in and
+    out as the dicts of RingBuilder.to_dict, since that's how they pickle
+    when the executor is a process pool.
+
+    :params builder_file: path to builder_file
+    :returns: dict of builder data
+    """
+    return RingBuilder.load(builder_file).to_dict()
+
+
+def _write_builder(fileobj, builder_data):
+    pickle.dump(builder_data, fileobj, protocol=2)
+
+
+def _write_json(fileobj, content):
+    fileobj.write(json.dumps(content))
+
+
+def _write_ring(fileobj, ring):
+    # a fixed gzip mtime makes identical rings identical on disk. Rings
+    # written by swift's own RingData.save may not match byte for byte,
+    # older versions of it stamp the current time into the gzip header.
+    gz_file = GzipFile(filename='', mode='wb', fileobj=fileobj,
+                       mtime=1300507380.0)
+    if hasattr(ring, 'serialize_v1'):
+        ring.serialize_v1(gz_file)
+    else:
+        pickle.dump(ring.to_dict(), gz_file, protocol=2)
+    gz_file.close()
+
+
+def dump_builder(builder_data, builder_file, backups=None, sha256sum=False):
+    """Pickle a builder to disk, replacing the existing builder
+
+    :params builder_data: dict of builder data to write out
+    :params builder_file: path to builder_file
+    :params backups: BackupStore to back the new builder up to, if any
+    :params sha256sum: whether to record a sha256 with the backup
+    :returns: md5sum of the new builder_file
+    """
+    return write_file(builder_file, _write_builder, (builder_data,), backups,
+                      sha256sum)
+
+
+def save_ring(builder_data, ring_file, backups=None, sha256sum=False):
+    """Write out the ring of a builder, replacing the existing ring
+
+    :params builder_data: dict of builder data whos ring to write out
+    :params ring_file: path to ring_file
+    :params backups: BackupStore to back the new ring up to, if any
+    :params sha256sum: whether to record a sha256 with the backup
+    :returns: md5sum of the new ring_file
+    """
+    ring = builder_from_dict(builder_data).get_ring()
+    return write_file(ring_file, _write_ring, (ring,), backups, sha256sum)
+
+
+def _rebalance(builder):
+    """ rebalance a builder instance in place, whether or not the result is
+    worth saving
+
+    :params builder: builder instance to rebalance
+    :returns: tuple of the number of reassigned partitions, the new balance
+              and why the rebalance isn't worth saving, or None if it is
+    :raises: RebalanceError if the rebalance failed
+    """
+    devs_changed = builder.devs_changed
+    try:
+        last_balance = builder.get_balance()
+        parts, balance = builder.rebalance()[:2]
+    except RingBuilderError, err:
+        raise RebalanceError(err.message)
+    if not parts:
+        return parts, balance, ('Either none need to be assigned or none '
+                                'can be due to min_part_hours [%s].' %
+                                builder.min_part_hours)
+    if not devs_changed and abs(last_balance - balance) < 1:
+        return parts, balance, ('Refusing to save rebalance. Did not change '
+                                'at least 1%.')
+    try:
+        builder.validate()
+    except RingValidationError, err:
+        raise RebalanceError(err.message)
+    return parts, balance, None
+
+
+def rebalance_builder(builder):
+    """ rebalance a builder instance in place
+
+    :params builder: builder instance to rebalance
+    :returns: tuple of the number of reassigned partitions and the new balance
+    :raises: RebalanceError if the rebalance failed or isn't worth saving
+    """
+    parts, balance, unsaveable = _rebalance(builder)
+    if unsaveable:
+        raise RebalanceError(unsaveable)
+    return parts, balance
+
+
+def rebalanced_builder(builder_data):
+    """ rebalance a builder
+
+    :params builder_data: dict of builder data to rebalance, its partition
+                          assignments are modified in place
+    :returns: tuple of the rebalanced builder data, the number of reassigned
+              partitions and the new balance
+    :raises: RebalanceError if the rebalance failed or isn't worth saving
+    """
+    builder = builder_from_dict(builder_data)
+    parts, balance = rebalance_builder(builder)
+    return builder.to_dict(), parts, balance
+
+
+def preview_rebalance(builder_data):
+    """ rebalance a copy of a builder and report what would change
+
+    The builder data itself is left alone, so the caller may pass that of a
+    shared builder.
+
+    :params builder_data: dict of builder data to rebalance
+    :returns: dict with the number of reassigned partitions, the new balance,
+              the number of partitions, whether the rebalance would be saved
+              (and if not why not) and, per device id, the number of
+              partition replicas the device would gain and lose
+    :raises: RebalanceError if the rebalance failed
+    """
+    builder = builder_from_dict(deepcopy(builder_data))
+    # rebalance reassigns partitions in place
+    before = [part2dev[:] for part2dev in builder._replica2part2dev or []]
+    parts, balance, unsaveable = _rebalance(builder)
+    moved = {}
+    for replica, part2dev in enumerate(builder._replica2part2dev):
+        if replica < len(before):
+            old_part2dev = before[replica]
+        else:
+            old_part2dev = []
+        for old_dev_id, dev_id in izip(old_part2dev, part2dev):
+            if old_dev_id != dev_id:
+                moved.setdefault(old_dev_id, [0, 0])[1] += 1
+                moved.setdefault(dev_id, [0, 0])[0] += 1
+        for dev_id in part2dev[len(old_part2dev):]:
+            moved.setdefault(dev_id, [0, 0])[0] += 1
+    return {'reassigned': parts, 'balance': balance,
+            'partitions': builder.parts, 'saveable': not unsaveable,
+            'reason': unsaveable,
+            'moved': dict((str(dev_id), {'gained': gained, 'lost': lost})
+                          for dev_id, (gained, lost) in moved.iteritems())}
+
+
+def stats_of_builder(builder_data):
+    """ compute the balance and dispersion statistics of a builder
+
+    :params builder_data: dict of builder data
+    :returns: dict of the statistics
+    """
+    return builder_stats(builder_from_dict(builder_data))
+
+
+def load_builder_at(builder_file, lasthash):
+    """Load a builder file, provided it's still the version with lasthash
+
+    The file is read once and the builder loaded from the bytes that were
+    hashed, so a builder replaced in between can't slip through.
+
+    :params builder_file: path to builder_file
+    :params lasthash: the md5sum the builder file is expected to have
+    :returns: RingBuilder instance
+    :raises: RingFileChanged if the builder file's md5sum differs
+    """
+    with open(builder_file, 'rb') as fp:
+        data = fp.read()
+    if md5(data).hexdigest() != lasthash:
+        raise RingFileChanged('%s builder md5sum differs' %
+                              basename(builder_file))
+    return RingBuilder.load(builder_file, open=lambda *args: BytesIO(data))
+
+
+def rebalance_builder_file(builder_file, seed=None, lasthash=None):
+    """ load and rebalance a builder file
+
+    This is what runs in the rebalance worker processes, so it only
+    returns picklable data.
+
+    :params builder_file: path to builder_file
+    :params seed: if given the random module is seeded with it for the
+                  rebalance, so attempts with different seeds assign
+                  partitions differently. The random state of the worker is
+                  restored afterwards, so later unseeded rebalances in the
+                  same worker don't repeat it.
+    :params lasthash: if given, the md5sum the builder file has to have when
+                      it's loaded
+    :returns: dict with either an error message or the rebalanced builder
+              data, the number of reassigned partitions and the new balance
+    :raises: RingFileChanged if the builder file doesn't match lasthash
+    """
+    state = random.getstate()
+    if seed is not None:
+        random.seed(seed)
+    try:
+        if lasthash is None:
+            builder = RingBuilder.load(builder_file)
+        else:
+            builder = load_builder_at(builder_file, lasthash)
+        parts, balance = rebalance_builder(builder)
+    except RebalanceError, err:
+        return {'error': str(err)}
+    finally:
+        random.setstate(state)
+    return {'builder': builder.to_dict(), 'reassigned': parts,
+            'balance': balance}
+
+
 class RingBuilderMiddleware(object):
 
+    # post targets that modify the builder
+    mutating_targets = ('add', 'remove', 'weight', 'meta', 'batch',
+                        'rebalance')
+    # fields devices can be listed by
+    list_sort_fields = ('id', 'zone', 'weight')
+
     def __init__(self, app, conf, *args, **kwargs):
         self.app = app
         self.swift_dir = conf.get('swift_dir', '/etc/swift')
@@ -83,6 +490,57 @@ class RingBuilderMiddleware(object):
                         'container': pathjoin(self.swift_dir, self.cont_ring),
                         'object': pathjoin(self.swift_dir, self.obj_ring)}
         self.key = conf['key']
+        self.lock_timeout = float(conf.get('lock_timeout', 1))
+        self.mutation_queues = None
+        if conf.get('mutation_queue', 'false').lower() in TRUE_VALUES:
+            depth = int(conf.get('mutation_queue_depth', 16))
+            timeout = float(conf.get('mutation_queue_timeout', 30))
+            self.mutation_queues = dict(
+                (builder_type, MutationQueue(depth, timeout))
+                for builder_type in self.bf_path)
+        self.chunk_size = int(conf.get('static_chunk_size', 1048576))
+        self.max_ranges = int(conf.get('max_ranges', 100))
+        self.stream_threshold = int(conf.get('json_stream_threshold', 1000))
+        try:
+            default_workers = cpu_count()
+        except NotImplementedError:
+            default_workers = 1
+        self.rebalance_workers = int(conf.get('rebalance_workers',
+                                              default_workers))
+        self.rebalance_attempts = int(conf.get('rebalance_attempts', 1))
+        self.max_rebalance_attempts = max(
+            int(conf.get('max_rebalance_attempts', 8)),
+            self.rebalance_attempts)
+        self.max_jobs = int(conf.get('max_rebalance_jobs', 100))
+        self.job_poll_interval = float(conf.get('job_poll_interval', 0.1))
+        self.jobs_dir = conf.get('jobs_dir',
+                                 pathjoin(self.swift_dir, 'rebalance_jobs'))
+        self.jobs = {}
+        self.job_executor = Executor(
+            conf.get('rebalance_executor', 'process'), self.rebalance_workers,
+            int(conf.get('rebalance_queue_size', 100)),
+            self.job_poll_interval)
+        self.executor = Executor(conf.get('executor', 'tpool'),
+                                 int(conf.get('executor_pool_size', 4)),
+                                 int(conf.get('executor_queue_size', 32)))
+        self.digest_cache = {}
+        self.delta_cache = {}
+        self.builder_cache = {}
+        self.search_indexes = {}
+        self.builder_stats = {}
+        self.digest_sidecars = conf.get('digest_sidecars',
+                                        'true').lower() in TRUE_VALUES
+        self.backups = BackupStore(
+            self.backup_dir,
+            conf.get('compress_backups', 'false').lower() in TRUE_VALUES,
+            keep_last=int(conf.get('backup_keep_last', 10)),
+            keep_hourly=int(conf.get('backup_keep_hourly', 24)),
+            keep_daily=int(conf.get('backup_keep_daily', 30)),
+            max_size=int(conf.get('backup_max_size', 0)))
+        self.backup_sha256 = conf.get('backup_sha256',
+                                      'false').lower() in TRUE_VALUES
+        self.prune_interval = float(conf.get('backup_prune_interval', 3600))
+        self.pruner_started = False
 
     def _log_request(self, env, response_status_int):
         """
@@ -124,58 +582,256 @@ class RingBuilderMiddleware(object):
         )))
 
     @staticmethod
-    def _get_md5sum(filename):
+    def _query_flag(env, name):
+        """ check whether a boolean query string parameter is set
+
+        :params env: The WSGI environment for the request.
+        :params name: name of the query string parameter
+        :returns: True or False
+        """
+        values = parse_qs(env.get('QUERY_STRING', ''))
+        return values.get(name, [''])[-1].lower() in TRUE_VALUES
+
+    def _rebalance_attempts(self, env):
+        """ get the number of rebalance attempts a request asks for
+
+        :params env: The WSGI environment for the request.
+        :returns: the attempts query string parameter, rebalance_attempts if
+                  it's missing, or None if it's invalid
+        """
+        values = parse_qs(env.get('QUERY_STRING', ''))
+        try:
+            attempts = int(values.get('attempts',
+                                      [self.rebalance_attempts])[-1])
+        except ValueError:
+            return None
+        if not 1 <= attempts <= self.max_rebalance_attempts:
+            return None
+        return attempts
+
+    @staticmethod
+    def _stat_key(filename):
+        """Get the stat identity of a file
+
+        :params filename: file to stat
+        :returns: tuple of (device, inode, size, mtime)
+        """
+        st = os.stat(filename)
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+    def _hash_file(self, filename):
+        """Read a file from disk and compute its md5sum off the hub
+
+        :params filename: file to obtain the md5sum of
+        :returns: hex digest of file
+        """
+        return self.executor.call(hash_file, filename)
+
+    @staticmethod
+    def _sidecar_path(filename):
+        """Get the path of the md5 sidecar file of a builder or ring"""
+        return '%s.md5' % filename
+
+    def _read_sidecar(self, filename, key):
+        """Read the md5 sidecar of a file if it matches its stat identity
+
+        :params filename: file whos sidecar to read
+        :params key: the current stat identity of filename
+        :returns: hex digest of file or None if no valid sidecar is present
+        """
+        if not self.digest_sidecars:
+            return None
+        try:
+            with open(self._sidecar_path(filename), 'rb') as sfile:
+                fields = sfile.read().split()
+            if len(fields) != 5:
+                return None
+            sidecar_key = (int(fields[1]), int(fields[2]), int(fields[3]),
+                           float(fields[4]))
+        except (IOError, OSError, ValueError):
+            return None
+        if sidecar_key != key:
+            return None
+        return fields[0]
+
+    def _write_sidecar(self, filename, key, digest):
+        """Atomically write the md5 sidecar of a file
+
+        Failing to write a sidecar isn't fatal, it just means other workers
+        will have to compute the digest themselves.
+
+        :params filename: file whos sidecar to write
+        :params key: the stat identity of filename
+        :params digest: hex digest of filename
+        """
+        if not self.digest_sidecars:
+            return
+        sidecar = self._sidecar_path(filename)
+        tmppath = None
+        try:
+            fd, tmppath = mkstemp(dir=dirname(sidecar),
+                                  prefix='.%s.' % basename(sidecar))
+            try:
+                os.write(fd, '%s %d %d %d %r\n' % ((digest,) + key))
+            finally:
+                os.close(fd)
+            os.rename(tmppath, sidecar)
+            tmppath = None
+        except (IOError, OSError), err:
+            self.logger.error(_('Unable to write md5 sidecar %s: %s' %
+                                (sidecar, err)))
+        finally:
+            if tmppath:
+                try:
+                    os.unlink(tmppath)
+                except OSError:
+                    pass
+
+    def _update_digest(self, filename, digest=None):
+        """Refresh the digest cache entry and sidecar of a file we just wrote
+
+        :params filename: file that was written
+        :params digest: hex digest of the files contents if already known
+        :returns: hex digest of file
+        """
+        key = self._stat_key(filename)
+        if digest is None:
+            digest = self._hash_file(filename)
+        self.digest_cache[filename] = (key, digest)
+        self._write_sidecar(filename, key, digest)
+        return digest
+
+    def _get_md5sum(self, filename):
         """Get the md5sum of file
 
+        The digest cache and then the md5 sidecar are consulted first and
+        are only trusted if the files stat identity still matches. Digests
+        computed here are only cached if the file wasn't modified within
+        the last second, since a same second rewrite could otherwise go
+        unnoticed. They're only cached in memory, sidecars are only written
+        by _update_digest after we wrote a file ourselves, so that reads
+        never write to disk.
+
         :params filename: file to obtain the md5sum of
         :returns: hex digest of file
         """
-        md5sum = md5()
-        with open(filename, 'rb') as tfile:
-            block = tfile.read(4096)
-            while block:
-                md5sum.update(block)
-                block = tfile.read(4096)
-        return md5sum.hexdigest()
+        key = self._stat_key(filename)
+        cached = self.digest_cache.get(filename)
+        if cached and cached[0] == key:
+            return cached[1]
+        digest = self._read_sidecar(filename, key)
+        if digest:
+            self.digest_cache[filename] = (key, digest)
+            return digest
+        digest = self._hash_file(filename)
+        if time() - key[3] > 1 and self._stat_key(filename) == key:
+            self.digest_cache[filename] = (key, digest)
+        return digest
+
+    def _load_builder(self, builder_file, writable=False):
+        """Load a builder, reusing the parsed copy of an earlier request if
+        the builder file hasn't changed since.
+
+        Cached builders are shared between requests and must never be
+        modified. Handlers that modify the builder must ask for a writable
+        copy instead.
+
+        :params builder_file: path to builder_file
+        :params writable: whether the caller intends to modify the builder
+        :returns: RingBuilder instance
+        """
+        try:
+            key = self._stat_key(builder_file)
+        except OSError:
+            return builder_from_dict(self.executor.call(load_builder,
+                                                        builder_file))
+        cached = self.builder_cache.get(builder_file)
+        if cached and cached[0] == key:
+            if writable:
+                return builder_from_dict(deepcopy(cached[1].to_dict()))
+            return cached[1]
+        builder = builder_from_dict(self.executor.call(load_builder,
+                                                       builder_file))
+        if not writable and time() - key[3] > 1 and \
+                self._stat_key(builder_file) == key:
+            self.builder_cache[builder_file] = (key, builder)
+        return builder
+
+    def _lock(self, filename, shared=False, timeout=None):
+        """ lock a builder or ring file
+
+        Builders and rings are replaced by renaming a new file over them, so
+        locking the file itself wouldn't keep out anyone who opens it after
+        the rename. A dedicated <filename>.lock file is locked instead.
+
+        :params filename: the builder or ring file to lock
+        :params shared: whether to take a shared (read) lock rather than an
+                        exclusive (write) lock
+        :params timeout: seconds to wait for the lock, defaults to
+                         lock_timeout
+        :raises: LockTimeout if the lock couldn't be obtained in time
+        """
+        if timeout is None:
+            timeout = self.lock_timeout
+        return lock_path('%s.lock' % filename, timeout, shared)
 
     def _make_backup(self, filename):
-        """ Create a backup of the current builder file
+        """ Back up the current version of a builder or ring file
+
+        Versions written by us were already backed up as they were written,
+        so this only has to do any work for files that were changed by
+        something else.
 
         :params filename: The file to backup
         """
         try:
-            os.mkdir(self.backup_dir)
+            digest = self._get_md5sum(filename)
         except OSError, err:
-            if err.errno != EEXIST:
+            if err.errno != ENOENT:
                 raise
-        backup = pathjoin(self.backup_dir, '%d.' %
-                          time() + basename(filename))
-        shutil.copy(filename, backup)
-        self.logger.info(_('Backed up %s to %s (%s)' %
-                        (filename, backup, self._get_md5sum(backup))))
+            return  # nothing to back up yet
+        if self.backups.find(digest):
+            return
+        self.executor.call(store_backup, self.backups, filename, digest)
+        self.logger.info(_('Backed up %s (%s)' % (filename, digest)))
 
-    def _is_existing_dev(self, builder, ipaddr, port, device_name):
-        """ Check if a device is currently present in the builder
+    def _find_backup(self, filename, digest):
+        """ Find a backup of a file by its md5sum
 
-        :params builder: builder instance to use
-        :params ip: ip to check for
-        :params port: port to check for
-        :params device_name: device_name to check for
-        :returns: True or False
+        :params filename: the file whos backups to search
+        :params digest: md5sum of the wanted version of the file
+        :returns: path of the backup or None if there's no such backup
         """
-        for dev in builder.devs:
-            if dev is None:
-                continue
-            if dev['ip'] == ipaddr and dev['port'] == port and \
-                    dev['device'] == device_name:
-                return True
-        return False
+        return self.backups.find(digest)
+
+    def prune_backups(self):
+        """ prune the backups according to the retention policy
+
+        :returns: tuple of the number of pruned backups and reclaimed bytes
+        """
+        pruned, reclaimed = self.executor.call(prune_backups, self.backups)
+        if pruned:
+            self.logger.info(_('Pruned %d backups, reclaimed %d bytes' %
+                               (pruned, reclaimed)))
+        return pruned, reclaimed
+
+    def _prune_backups_forever(self):
+        """ prune the backups every prune_interval seconds """
+        while True:
+            sleep(self.prune_interval)
+            try:
+                self.prune_backups()
+            except ExecutorBusy:
+                pass  # try again next time
+            except Exception:
+                self.logger.exception(_('Error pruning backups'))
 
-    def _add_device(self, builder, zone, ipaddr, port, device_name, weight,
-                    meta):
+    def _add_device(self, builder, index, zone, ipaddr, port, device_name,
+                    weight, meta):
         """ Add a device to the builder instance
 
         :params builder: builder instance to use
+        :params index: DeviceIndex of the builder, which is kept up to date
         :params zone: zone of new device
         :params ipaddr: ip of new device
         :params port: port of new device
@@ -183,12 +839,94 @@ class RingBuilderMiddleware(object):
         :params weight: weight of new device
         :params meta: meta info of new device
         """
-        next_dev_id = 0
-        if builder.devs:
-            next_dev_id = max(d['id'] for d in builder.devs if d) + 1
-        builder.add_dev({'id': next_dev_id, 'zone': zone, 'ip': ipaddr,
-                         'port': int(port), 'device': device_name,
-                         'weight': weight, 'meta': meta})
+        dev = {'id': index.next_id, 'zone': zone, 'ip': ipaddr,
+               'port': int(port), 'device': device_name, 'weight': weight,
+               'meta': meta}
+        builder.add_dev(dev)
+        index.add(dev)
+
+    @staticmethod
+    def _validators(filehash, mtime):
+        """ get the ETag and Last-Modified headers of a ring or builder
+
+        :params filehash: md5sum of the file
+        :params mtime: modification time of the file
+        :returns: list of headers
+        """
+        return [('ETag', '"%s"' % filehash),
+                ('Last-Modified', formatdate(mtime, usegmt=True))]
+
+    @staticmethod
+    def _not_modified(env, filehash, mtime):
+        """ check a conditional request against the current state of a file
+
+        If-None-Match takes precedence over If-Modified-Since.
+
+        :params env: The WSGI environment for the request.
+        :params filehash: md5sum of the file
+        :params mtime: modification time of the file
+        :returns: True if a 304 Not Modified should be returned
+        """
+        if env.get('HTTP_IF_NONE_MATCH'):
+            for etag in env['HTTP_IF_NONE_MATCH'].split(','):
+                etag = etag.strip()
+                if etag.startswith('W/'):
+                    etag = etag[2:]
+                if etag == '*' or etag.strip('"') == filehash:
+                    return True
+            return False
+        if env.get('HTTP_IF_MODIFIED_SINCE'):
+            since = parsedate_tz(env['HTTP_IF_MODIFIED_SINCE'])
+            if since:
+                return int(mtime) <= mktime_tz(since)
+        return False
+
+    @staticmethod
+    def _parse_range(header, size):
+        """ parse a Range header
+
+        :params header: value of the Range header
+        :params size: size of the file being served
+        :returns: None if the header is malformed and should be ignored,
+                  otherwise a list of (start, end) tuples (end being exclusive)
+                  of all satisfiable ranges.
+        """
+        units, sep, spec = header.partition('=')
+        if not sep or units.strip().lower() != 'bytes':
+            return None
+        ranges = []
+        for byte_range in spec.split(','):
+            first, sep, last = byte_range.strip().partition('-')
+            if not sep or not (first + last).isdigit():
+                return None
+            if not first:
+                if int(last):
+                    ranges.append((max(size - int(last), 0), size))
+                continue
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            if start < size:
+                end = int(last) + 1 if last else size
+                ranges.append((start, min(end, size)))
+        return ranges
+
+    @staticmethod
+    def _if_range_matches(env, filehash, mtime):
+        """ check whether a Range header should be honored based on If-Range
+
+        :params env: The WSGI environment for the request.
+        :params filehash: md5sum of the file
+        :params mtime: modification time of the file
+        :returns: True or False
+        """
+        if_range = env.get('HTTP_IF_RANGE', '').strip()
+        if not if_range:
+            return True
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            return if_range == '"%s"' % filehash
+        since = parsedate_tz(if_range)
+        return bool(since) and int(mtime) <= mktime_tz(since)
 
     def return_static_file(self, filename, start_response, env):
         """ lock and serve a static file to the client from disk
@@ -196,16 +934,122 @@ class RingBuilderMiddleware(object):
         :params filename: the file to serve and who's md5sum to use
                           for the X-Current-Hash header.
         :params start_response: start_response object
-        :returns: iterator for reading the file from disk.
+        :returns: the servers wsgi.file_wrapper if it provides one so it can
+                  use sendfile, otherwise an iterator for reading the file
+                  from disk.
         """
-        with lock_file(filename, timeout=1, unlink=False):
+        with self._lock(filename, shared=True):
             filehash = self._get_md5sum(filename)
+            mtime = os.stat(filename).st_mtime
+            validators = self._validators(filehash, mtime)
+            if self._not_modified(env, filehash, mtime):
+                self._log_request(env, 304)
+                return self.http_not_modified(start_response,
+                                              [('X-Current-Hash', filehash)] +
+                                              validators)
+            fileobj = open(filename, 'rb')
+            size = os.fstat(fileobj.fileno()).st_size
+            ranges = None
+            if env.get('HTTP_RANGE') and \
+                    self._if_range_matches(env, filehash, mtime):
+                ranges = self._parse_range(env['HTTP_RANGE'], size)
+                if ranges is not None and len(ranges) > self.max_ranges:
+                    ranges = None
+            if ranges is not None:
+                return self.return_ranges(fileobj, size, ranges, filehash,
+                                          validators, start_response, env)
             self._log_request(env, 200)
-            start_response('200 OK', [('Content-Length', getsize(filename)),
+            start_response('200 OK', [('Content-Length', str(size)),
                                       ('X-Current-Hash', filehash),
                                       ('Content-Type',
-                                       'application/octet-stream')])
-            return FileIterable(filename)
+                                       'application/octet-stream')] +
+                           validators + [('Accept-Ranges', 'bytes')])
+            if 'wsgi.file_wrapper' in env:
+                return env['wsgi.file_wrapper'](fileobj, self.chunk_size)
+            return FileIterable(fileobj, self.chunk_size)
+
+    def return_ranges(self, fileobj, size, ranges, filehash, validators,
+                      start_response, env):
+        """ serve byte ranges of an open static file
+
+        :params fileobj: the open file to serve
+        :params size: size of the file
+        :params ranges: list of satisfiable (start, end) tuples
+        :params filehash: md5sum of the file
+        :params validators: the ETag and Last-Modified headers of the file
+        :params start_response: start_response object
+        :returns: a 206 Partial Content or a 416 if no range was satisfiable
+        """
+        headers = [('X-Current-Hash', filehash)] + validators + \
+            [('Accept-Ranges', 'bytes')]
+        if not ranges:
+            fileobj.close()
+            self._log_request(env, 416)
+            start_response('416 Requested Range Not Satisfiable',
+                           [('Content-Length', '0'),
+                            ('Content-Range', 'bytes */%d' % size)] + headers)
+            return []
+        self._log_request(env, 206)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            start_response('206 Partial Content',
+                           [('Content-Length', str(end - start)),
+                            ('Content-Range', 'bytes %d-%d/%d' %
+                             (start, end - 1, size)),
+                            ('Content-Type', 'application/octet-stream')] +
+                           headers)
+            return FileIterable(fileobj, self.chunk_size, start, end)
+        body = MultipartFileIterable(fileobj, ranges, size, uuid4().hex,
+                                     self.chunk_size)
+        start_response('206 Partial Content',
+                       [('Content-Length', str(body.content_length)),
+                        ('Content-Type', 'multipart/byteranges; boundary=%s'
+                         % body.boundary)] + headers)
+        return body
+
+    def ring_delta(self, ring_type, start_response, env):
+        """ serve the delta between an older version of a ring, as found in
+        the backups, and the current ring.
+
+        :params ring_type: the type of ring to serve a delta of
+        :returns: the serialized delta, a 304 if the client is already up to
+                  date or a 404 if no backup of the clients ring exists.
+        """
+        from_hash = parse_qs(env.get('QUERY_STRING', '')).get('from',
+                                                              [''])[-1]
+        if not from_hash:
+            self._log_request(env, 400)
+            return self.http_bad_request(start_response, 'Missing from hash.')
+        ring_file = self.rf_path[ring_type]
+        current_hash = self._get_md5sum(ring_file)
+        headers = [('X-Current-Hash', current_hash),
+                   ('ETag', '"%s"' % current_hash)]
+        if from_hash == current_hash:
+            self._log_request(env, 304)
+            return self.http_not_modified(start_response, headers)
+        cached = self.delta_cache.get(ring_file)
+        if not cached or cached[0] != current_hash:
+            cached = (current_hash, {})
+            self.delta_cache[ring_file] = cached
+        delta = cached[1].get(from_hash)
+        if not delta:
+            backup = self._find_backup(ring_file, from_hash)
+            if not backup:
+                self._log_request(env, 404)
+                return self.http_not_found(start_response,
+                                           'Unknown ring version.')
+            delta = self.executor.call(make_ring_delta_file, backup,
+                                       ring_file, from_hash, current_hash)
+            if self._get_md5sum(ring_file) != current_hash:
+                self._log_request(env, 409)
+                return self.http_conflict(start_response,
+                                          'Ring changed, try again.')
+            cached[1][from_hash] = delta
+        self._log_request(env, 200)
+        start_response('200 OK', [('Content-Length', str(len(delta))),
+                                  ('Content-Type',
+                                   'application/octet-stream')] + headers)
+        return [delta]
 
     def write_builder(self, builder, builder_file):
         """Write out RingBuilder instance
@@ -215,8 +1059,12 @@ class RingBuilderMiddleware(object):
         :returns: md5sum of the newly written builder
         """
         self._make_backup(builder_file)
-        pickle.dump(builder.to_dict(), open(builder_file, 'wb'), protocol=2)
-        newmd5 = self._get_md5sum(builder_file)
+        newmd5 = self._update_digest(
+            builder_file,
+            self.executor.call(dump_builder, builder.to_dict(), builder_file,
+                               self.backups, self.backup_sha256))
+        self.builder_cache[builder_file] = (self._stat_key(builder_file),
+                                            builder)
         self.logger.info('Wrote %s (%s)' % (builder_file, newmd5))
         return newmd5
 
@@ -232,72 +1080,397 @@ class RingBuilderMiddleware(object):
             raise RingFileChanged('%s builder md5sum differs' %
                                   basename(builder_file))
 
-    def rebalance(self, builder_type, lasthash, start_response, env):
+    def _save_rebalance(self, builder_type, builder, parts, balance):
+        """ write out a rebalanced builder along with its new ring
+
+        :params builder_type: the builder_type that was rebalanced
+        :params builder: the rebalanced builder instance
+        :params parts: number of reassigned partitions
+        :params balance: the new balance of the builder
+        :returns: md5sum of the newly written builder
+        """
+        self.logger.info(_('Reassigned %d (%.02f%%) partitions. Balance is'
+                           ' %.02f.' % (parts, 100.0 * parts / builder.parts,
+                                        balance)))
+        if balance > 5:
+            self.logger.info(_('Balance of %.02f indicates you should '
+                               'push this ring, wait %d hours and '
+                               'rebalance/repush.' % (balance,
+                               builder.min_part_hours)))
+        newmd5 = self.write_builder(builder, self.bf_path[builder_type])
+        ring_file = self.rf_path[builder_type]
+        self._make_backup(ring_file)
+        ringmd5 = self._update_digest(
+            ring_file, self.executor.call(save_ring, builder.to_dict(),
+                                          ring_file, self.backups,
+                                          self.backup_sha256))
+        self.logger.info(_('Wrote new ring file %s (%s)' %
+                           (ring_file, ringmd5)))
+        return newmd5
+
+    def rebalance(self, builder_type, lasthash, start_response, env,
+                  attempts=1):
         """ rebalance a ring
 
-            note: rebalance doesn't yield.
+            note: the rebalance itself runs in the executor, or with more
+            than one attempt in the rebalance workers. The builder stays
+            locked until it's done.
         """
-        with lock_file(self.bf_path[builder_type], timeout=1, unlink=False):
+        with self._lock(self.bf_path[builder_type]):
             self.verify_current_hash(self.bf_path[builder_type], lasthash)
-            builder = RingBuilder.load(self.bf_path[builder_type])
-            devs_changed = builder.devs_changed
             try:
-                last_balance = builder.get_balance()
-                parts, balance = builder.rebalance()
-            except RingBuilderError, err:
-                self.logger.exception(_("Error during ring validation."))
-                return self.return_response(False, None, err.message,
-                                            start_response, env)
-            if not parts:
-                msg = 'Either none need to be assigned or none can be due ' \
-                      'to min_part_hours [%s].' % builder.min_part_hours
-                self.logger.error(_(msg))
-                return self.return_response(False, None, msg, start_response,
-                                            env)
-            if not devs_changed and abs(last_balance - balance) < 1:
-                msg = 'Refusing to save rebalance. Did not change at least 1%.'
-                self.logger.error(_(msg))
-                return self.return_response(False, None, msg, start_response,
-                                            env)
-            try:
-                builder.validate()
-            except RingValidationError, err:
-                self.logger.exception(_("Error during ring validation."))
-                return self.return_response(False, None, err.message,
+                if attempts > 1:
+                    result = self._best_rebalance(self.bf_path[builder_type],
+                                                  attempts)
+                    builder = builder_from_dict(result['builder'])
+                    parts = result['reassigned']
+                    balance = result['balance']
+                else:
+                    builder = self._load_builder(self.bf_path[builder_type],
+                                                 writable=True)
+                    builder_data, parts, balance = self.executor.call(
+                        rebalanced_builder, builder.to_dict())
+                    builder = builder_from_dict(builder_data)
+            except RebalanceError, err:
+                self.logger.error(_('Error during rebalance: %s' % err))
+                return self.return_response(False, None, str(err),
                                             start_response, env)
-            self.logger.info(_('Reassigned %d (%.02f%%) partitions. Balance is'
-                               ' %.02f.' % (parts,
-                                            100.0 * parts / builder.parts,
-                                            balance)))
-            if balance > 5:
-                self.logger.info(_('Balance of %.02f indicates you should '
-                                   'push this ring, wait %d hours and '
-                                   'rebalance/repush.' % (balance,
-                                   builder.min_part_hours)))
-            newmd5 = self.write_builder(builder, self.bf_path[builder_type])
-            ring_file = self.rf_path[builder_type]
-            self._make_backup(ring_file)
-            builder.get_ring().save(ring_file)
-            self.logger.info(_('Wrote new ring file %s (%s)' %
-                               (ring_file, self._get_md5sum(ring_file))))
+            newmd5 = self._save_rebalance(builder_type, builder, parts,
+                                          balance)
             return self.return_response(True, newmd5, {'balance': balance,
                                                        'reassigned': parts,
                                                        'partitions':
                                                        builder.parts},
                                         start_response, env)
 
+    def _rebalance_and_save(self, builder_type, attempts):
+        """ rebalance a locked builder in the rebalance workers and write out
+        the result
+
+        :params builder_type: the builder_type to rebalance
+        :params attempts: number of rebalance attempts to make
+        :returns: dict with either an error message or the number of
+                  reassigned partitions, the new balance, the number of
+                  partitions and the new md5sum of the builder
+        """
+        try:
+            result = self._best_rebalance(self.bf_path[builder_type],
+                                          attempts)
+            builder = builder_from_dict(result['builder'])
+            newmd5 = self._save_rebalance(builder_type, builder,
+                                          result['reassigned'],
+                                          result['balance'])
+        except RebalanceError, err:
+            self.logger.error(_('Error during rebalance: %s' % err))
+            return {'error': str(err)}
+        except Exception, err:
+            # the other builders are still being rebalanced under the
+            # locks held by rebalance_all, so this mustn't raise
+            self.logger.exception(_('error rebalancing %s' % builder_type))
+            return {'error': str(err)}
+        return {'reassigned': result['reassigned'],
+                'balance': result['balance'], 'partitions': builder.parts,
+                'hash': newmd5}
+
+    def rebalance_all(self, hashes, start_response, env, attempts=1):
+        """ rebalance several builders at once
+
+            note: the builders are rebalanced in parallel in the rebalance
+            workers. They're all locked until every one of them is done,
+            failures are reported per builder_type.
+
+        :params hashes: dict of builder_types and the hashes to use when
+                        verifying their state
+        :params attempts: number of rebalance attempts to make per builder
+        :returns: a json dict of the result of each builder_type, each
+                  either an error or what a single rebalance returns along
+                  with the new md5sum.
+        """
+        if not isinstance(hashes, dict) or not hashes or \
+                set(hashes) - set(self.bf_path):
+            return self.return_response(False, None, 'Malformed request.',
+                                        start_response, env)
+        builder_types = sorted(hashes)
+        with nested(*[self._lock(self.bf_path[builder_type])
+                      for builder_type in builder_types]):
+            for builder_type in builder_types:
+                self.verify_current_hash(self.bf_path[builder_type],
+                                         hashes[builder_type])
+            pile = GreenPile(len(builder_types))
+            for builder_type in builder_types:
+                pile.spawn(self._rebalance_and_save, builder_type, attempts)
+            results = dict(zip(builder_types, pile))
+        self._log_request(env, 200)
+        return self.http_ok_json(start_response, json.dumps(results))
+
+    def rebalance_preview(self, builder_type, lasthash, start_response, env):
+        """ report what a rebalance would do without saving anything
+
+            note: the builder is only locked while it's loaded, the
+            rebalance runs on a copy in the executor.
+        """
+        with self._lock(self.bf_path[builder_type], shared=True):
+            self.verify_current_hash(self.bf_path[builder_type], lasthash)
+            builder = self._load_builder(self.bf_path[builder_type])
+        try:
+            result = self.executor.call(preview_rebalance,
+                                        builder.to_dict())
+        except RebalanceError, err:
+            return self.return_response(False, None, str(err),
+                                        start_response, env)
+        return self.return_response(True, lasthash, result, start_response,
+                                    env)
+
+    def _best_rebalance(self, builder_file, attempts, lasthash=None):
+        """ rebalance a builder file in the rebalance workers, making several
+        attempts with different seeds at once if asked to.
+
+        :params builder_file: path to builder_file
+        :params attempts: number of attempts
+        :params lasthash: if given, the md5sum the workers have to find the
+                          builder file at
+        :returns: the result of rebalance_builder_file with the best balance,
+                  and of those the fewest reassigned partitions
+        :raises: RebalanceError if every attempt failed
+        :raises: RingFileChanged if the builder file doesn't match lasthash
+        """
+        if attempts == 1:
+            results = [self.job_executor.call(rebalance_builder_file,
+                                              builder_file, None, lasthash)]
+        else:
+            pile = GreenPile(attempts)
+            for _junk in xrange(attempts):
+                pile.spawn(self.job_executor.call, rebalance_builder_file,
+                           builder_file, random.getrandbits(32), lasthash)
+            results = list(pile)
+        succeeded = [result for result in results if 'error' not in result]
+        if not succeeded:
+            raise RebalanceError(results[0]['error'])
+        return min(succeeded, key=lambda result: (result['balance'],
+                                                  result['reassigned']))
+
+    def _job_path(self, job_id):
+        return pathjoin(self.jobs_dir, '%s.json' % job_id)
+
+    def _save_job(self, job):
+        """ write out the state of a job, so any worker can report it
+
+        Failing to save a job isn't fatal to the job, its status just can't
+        be looked up.
+
+        :params job: the job dict to save
+        """
+        try:
+            if not os.path.isdir(self.jobs_dir):
+                try:
+                    os.makedirs(self.jobs_dir)
+                except OSError, err:
+                    if err.errno != EEXIST:
+                        raise
+            write_file(self._job_path(job['id']), _write_json, (job,))
+        except (IOError, OSError), err:
+            self.logger.error(_('Unable to save rebalance job %s: %s' %
+                                (job['id'], err)))
+
+    def _load_job(self, job_id):
+        """ read the state of a job saved by any worker
+
+        :params job_id: id of the job
+        :returns: the job dict or None for unknown jobs
+        """
+        if len(job_id) != 32 or job_id.strip('0123456789abcdef'):
+            return None
+        try:
+            with open(self._job_path(job_id)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _prune_jobs(self):
+        """ remove the oldest finished jobs once more than
+        max_rebalance_jobs of them are saved
+        """
+        try:
+            names = os.listdir(self.jobs_dir)
+        except OSError:
+            return
+        finished = []
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            job = self._load_job(name[:-len('.json')])
+            if job and job['status'] in ('complete', 'failed'):
+                finished.append(job)
+        finished.sort(key=lambda j: j['submitted'])
+        for job in finished[:max(len(finished) - self.max_jobs, 0)]:
+            try:
+                os.unlink(self._job_path(job['id']))
+            except OSError:
+                pass
+
+    def _new_job(self, builder_type, attempts=1):
+        """ register a new rebalance job
+
+        Jobs are saved to a file each in the jobs_dir, so their status can
+        be looked up on any worker. Unfinished jobs are also tracked by the
+        worker running them, which refuses new jobs once it has
+        max_rebalance_jobs of its own unfinished.
+
+        :params builder_type: the builder_type the job will rebalance
+        :params attempts: number of rebalance attempts the job makes
+        :returns: the job dict
+        :raises ExecutorBusy: if there are too many unfinished jobs
+        """
+        if len(self.jobs) >= self.max_jobs:
+            raise ExecutorBusy('Too many rebalance jobs pending')
+        job = {'id': uuid4().hex, 'type': builder_type, 'status': 'queued',
+               'submitted': time(), 'started': None, 'finished': None,
+               'attempts': attempts, 'reassigned': None, 'balance': None,
+               'partitions': None, 'hash': None, 'error': None}
+        self.jobs[job['id']] = job
+        self._save_job(job)
+        return job
+
+    def _run_rebalance_job(self, job, lasthash):
+        """ run a rebalance job in the worker pool and save its result
+
+        The rebalance itself runs without holding the builder lock. The
+        workers only rebalance the builder if it still has lasthash when
+        they load it, and the builder is locked, and its hash verified
+        again, once the result needs to be written out.
+
+        :params job: the job dict to run and update
+        :params lasthash: the hash the rebalanced builder is expected to have
+        """
+        builder_type = job['type']
+        builder_file = self.bf_path[builder_type]
+        job['status'] = 'running'
+        job['started'] = time()
+        self._save_job(job)
+        try:
+            result = self._best_rebalance(builder_file, job['attempts'],
+                                          lasthash)
+            job['status'] = 'saving'
+            self._save_job(job)
+            with self._lock(builder_file, timeout=10):
+                self.verify_current_hash(builder_file, lasthash)
+                builder = builder_from_dict(result['builder'])
+                newmd5 = self._save_rebalance(builder_type, builder,
+                                              result['reassigned'],
+                                              result['balance'])
+            job.update({'status': 'complete', 'hash': newmd5,
+                        'reassigned': result['reassigned'],
+                        'balance': result['balance'],
+                        'partitions': builder.parts})
+        except RebalanceError, err:
+            self.logger.error(_('rebalance job %s failed: %s' %
+                                (job['id'], err)))
+            job.update({'status': 'failed', 'error': str(err)})
+        except RingFileChanged:
+            job.update({'status': 'failed',
+                        'error': 'Builder md5sum differs'})
+        except LockTimeout:
+            job.update({'status': 'failed', 'error': 'Builder locked.'})
+        except Exception, err:
+            self.logger.exception(_('error on rebalance job %s' % job['id']))
+            job.update({'status': 'failed', 'error': str(err)})
+        job['finished'] = time()
+        self._save_job(job)
+        del self.jobs[job['id']]
+        self._prune_jobs()
+
+    def rebalance_async(self, builder_type, lasthash, start_response, env,
+                        attempts=1):
+        """ start a rebalance job in a worker process and return right away
+
+        :params builder_type: the builder_type to rebalance
+        :params lasthash: the hash to use when verifying state
+        :params attempts: number of rebalance attempts to make
+        :returns: a 202 Accepted with the id of the rebalance job
+        """
+        if self.job_executor.busy:
+            raise ExecutorBusy('Too many rebalance jobs pending')
+        with self._lock(self.bf_path[builder_type], shared=True):
+            self.verify_current_hash(self.bf_path[builder_type], lasthash)
+        job = self._new_job(builder_type, attempts)
+        spawn_n(self._run_rebalance_job, job, lasthash)
+        self._log_request(env, 202)
+        return self.http_accepted(start_response, lasthash,
+                                  json.dumps({'job': job['id']}))
+
+    def job_status(self, job_id, start_response, env):
+        """ report the status of a rebalance job
+
+        :params job_id: id of the job
+        :returns: the job as a json dict or a 404 for unknown jobs
+        """
+        job = self.jobs.get(job_id) or self._load_job(job_id)
+        if not job:
+            self._log_request(env, 404)
+            return self.http_not_found(start_response)
+        current_md5sum = self._get_md5sum(self.bf_path[job['type']])
+        return self.return_response(True, current_md5sum, job,
+                                    start_response, env)
+
     def list_devices(self, builder_type, start_response, env):
         """ list ALL devices in the ring
 
+        Supports marker, limit, fields and sort query parameters to list
+        pages of devices and only some of their fields. Pages are ordered
+        by sort (id, zone or weight) and then by id, and the X-Next-Marker
+        header is set if there are further pages.
+
         :params builder_type: the builder_type to use when loading the builder
         :returns: list of boolean status, md5sum of the current ring, and all
                   builder.devs
         """
-        with lock_file(self.bf_path[builder_type], timeout=1, unlink=False):
-            builder = RingBuilder.load(self.bf_path[builder_type])
-            current_md5sum = self._get_md5sum(self.bf_path[builder_type])
-            return self.return_response(True, current_md5sum, builder.devs,
+        params = parse_qs(env.get('QUERY_STRING', ''))
+        if not set(params) & set(['marker', 'limit', 'fields', 'sort']):
+            with self._lock(self.bf_path[builder_type], shared=True):
+                builder = self._load_builder(self.bf_path[builder_type])
+                current_md5sum = self._get_md5sum(self.bf_path[builder_type])
+                return self.return_response(True, current_md5sum,
+                                            builder.devs, start_response, env)
+        sort = params.get('sort', ['id'])[-1]
+        try:
+            marker = params.get('marker', [None])[-1]
+            if marker is not None:
+                marker = int(marker)
+            limit = params.get('limit', [None])[-1]
+            if limit is not None:
+                limit = int(limit)
+                if limit < 1:
+                    raise ValueError()
+        except ValueError:
+            return self.return_response(False, None,
+                                        'Invalid marker or limit.',
+                                        start_response, env)
+        if sort not in self.list_sort_fields:
+            return self.return_response(False, None,
+                                        'Invalid sort field %s.' % sort,
+                                        start_response, env)
+        fields = None
+        if 'fields' in params:
+            fields = set(['id'])
+            for value in params['fields']:
+                fields.update(f for f in value.split(',') if f)
+        with self._lock(self.bf_path[builder_type], shared=True):
+            current_md5sum, index = self._search_index(
+                self.bf_path[builder_type])
+        try:
+            dev_ids, more = index.page(sort, marker, limit)
+        except ValueError as err:
+            return self.return_response(False, current_md5sum, str(err),
                                         start_response, env)
+        devs = [index.devs[dev_id] for dev_id in dev_ids]
+        if fields:
+            devs = [dict((k, v) for k, v in dev.iteritems() if k in fields)
+                    for dev in devs]
+        headers = []
+        if more and dev_ids:
+            headers.append(('X-Next-Marker', str(dev_ids[-1])))
+        return self.return_response(True, current_md5sum, devs,
+                                    start_response, env, headers)
 
     def search(self, builder_type, search_pattern, start_response, env):
         """ search the builder for devices matching search pattern
@@ -307,8 +1480,8 @@ class RingBuilderMiddleware(object):
         :returns: list of boolean status, md5sum of current builder
                   file on disk, and error message or dict of matched devices.
         """
-        with lock_file(self.bf_path[builder_type], timeout=1, unlink=False):
-            builder = RingBuilder.load(self.bf_path[builder_type])
+        with self._lock(self.bf_path[builder_type], shared=True):
+            builder = self._load_builder(self.bf_path[builder_type])
             try:
                 search_result = builder.search_devs(str(search_pattern))
                 return self.return_response(True, self._get_md5sum(
@@ -321,41 +1494,202 @@ class RingBuilderMiddleware(object):
                                             'Invalid search term',
                                             start_response, env)
 
-    def remove_devs(self, builder_type, devices, lasthash, start_response,
-                    env):
-        """ remove devices from the builder
+    def _search_index(self, builder_file):
+        """ get the search index of the current version of a builder,
+        building it if needed.
+
+        :params builder_file: path to builder_file
+        :returns: tuple of the builders md5sum and its DeviceSearchIndex
+        """
+        current_md5sum = self._get_md5sum(builder_file)
+        cached = self.search_indexes.get(builder_file)
+        if cached and cached[0] == current_md5sum:
+            return cached
+        builder = self._load_builder(builder_file)
+        if self._get_md5sum(builder_file) != current_md5sum:
+            # changed while loading, don't cache
+            return current_md5sum, DeviceSearchIndex(builder.devs)
+        cached = (current_md5sum, DeviceSearchIndex(builder.devs))
+        self.search_indexes[builder_file] = cached
+        return cached
+
+    def stats(self, builder_type, start_response, env):
+        """ get the balance and dispersion statistics of a builder
+
+        Statistics are only computed once per version of the builder.
 
         :params builder_type: the builder_type to use when loading the builder
+        :returns: list of boolean status, md5sum of current builder
+                  file on disk, and dict of statistics.
+        """
+        builder_file = self.bf_path[builder_type]
+        with self._lock(builder_file, shared=True):
+            current_md5sum = self._get_md5sum(builder_file)
+            cached = self.builder_stats.get(builder_file)
+            if not cached or cached[0] != current_md5sum:
+                builder = self._load_builder(builder_file)
+                cached = (current_md5sum,
+                          self.executor.call(stats_of_builder,
+                                             builder.to_dict()))
+                self.builder_stats[builder_file] = cached
+        return self.return_response(True, current_md5sum, cached[1],
+                                    start_response, env)
+
+    def filter_devices(self, builder_type, search_filter, start_response,
+                       env):
+        """ find the devices matching a structured search filter
+
+        :params builder_type: the builder_type to search
+        :params search_filter: the filter, see DeviceSearchIndex
+        :returns: list of boolean status, md5sum of current builder
+                  file on disk, and error message or list of matched devices.
+        """
+        with self._lock(self.bf_path[builder_type], shared=True):
+            current_md5sum, index = self._search_index(
+                self.bf_path[builder_type])
+        try:
+            dev_ids = index.search(search_filter)
+        except ValueError as err:
+            return self.return_response(False, current_md5sum, str(err),
+                                        start_response, env)
+        return self.return_response(True, current_md5sum,
+                                    index.devices(dev_ids), start_response,
+                                    env)
+
+    def _apply_remove(self, builder, devices):
+        """ remove devices from a builder instance
+
+        :params builder: builder instance to modify
         :params devices: list of device ids to be removed.
+        :returns: whether the builder was modified
+        :raises: InvalidOperation if the devices couldn't be removed
+        """
+        if not isinstance(devices, list):
+            raise InvalidOperation('Malformed request.')
+        for dev_id in devices:
+            sleep()  # so we don't starve/block
+            try:
+                builder.remove_dev(int(dev_id))
+            except (IndexError, TypeError):
+                raise InvalidOperation('Invalid dev id %s.' % dev_id)
+            except RingBuilderError as err:
+                raise InvalidOperation('Error removing %s - %s.' %
+                                       (dev_id, err))
+            except ValueError as err:
+                raise InvalidOperation(str(err))
+        return True
+
+    def _apply_weight(self, builder, dev_weights):
+        """ change the weight of devices in a builder instance
+
+        :params builder: builder instance to modify
+        :params dev_weights: a dict of device id and weight
+        :returns: whether the builder was modified
+        :raises: InvalidOperation if a weight couldn't be changed
+        """
+        for dev_id in dev_weights:
+            sleep()  # so we don't starve/block
+            try:
+                builder.set_dev_weight(int(dev_id),
+                                       float(dev_weights[dev_id]))
+            except (IndexError, TypeError):
+                raise InvalidOperation('Invalid dev id %s.' % dev_id)
+            except ValueError as err:
+                raise InvalidOperation(str(err))
+        return True
+
+    def _apply_meta(self, builder, dev_meta):
+        """ change the meta info of devices in a builder instance
+
+        :params builder: builder instance to modify
+        :params dev_meta: a dict of device id and meta info
+        :returns: whether the builder was modified
+        :raises: InvalidOperation if dev_meta is malformed or no device was
+                 modified
+        """
+        if not isinstance(dev_meta, dict) or not dev_meta:
+            raise InvalidOperation('Malformed request.')
+        index = DeviceIndex(builder.devs)
+        modified = False
+        invalid = None
+        try:
+            for dev_id in dev_meta:
+                sleep()  # so we don't starve/block
+                device = index.get(int(dev_id))
+                if device:
+                    modified = True
+                    device['meta'] = '%s' % dev_meta[dev_id]
+                elif invalid is None:
+                    invalid = dev_id
+        except ValueError as err:
+            raise InvalidOperation(str(err))
+        if not modified:
+            raise InvalidOperation('Invalid dev id %s.' % invalid)
+        return True
+
+    def _apply_add(self, builder, devices):
+        """ add devices to a builder instance, skipping existing ones
+
+        :params builder: builder instance to modify
+        :params devices: list of device dicts
+        :returns: whether the builder was modified
+        :raises: InvalidOperation if the devices are malformed
+        """
+        index = DeviceIndex(builder.devs)
+        ring_modified = False
+        try:
+            for device in devices:
+                sleep()  # so we don't starve/block
+                if not index.find(device['ip'], int(device['port']),
+                                  device['device']):
+                    self._add_device(builder, index, int(device['zone']),
+                                     device['ip'], int(device['port']),
+                                     device['device'],
+                                     float(device['weight']),
+                                     device['meta'])
+                    ring_modified = True
+        except (AttributeError, KeyError, ValueError, TypeError):
+            raise InvalidOperation('Malformed request.')
+        return ring_modified
+
+    def _modify(self, builder_type, lasthash, start_response, env, apply,
+                *args):
+        """ lock, load, modify and write out a builder
+
+        :params builder_type: the builder_type to use when loading the builder
         :params lasthash: the hash to use when verifying state
+        :params apply: the _apply_* method to modify the builder with
+        :returns: the new md5sum, a 400 if apply raised InvalidOperation or
+                  if the builder remains unchanged.
         """
-        with lock_file(self.bf_path[builder_type], timeout=1, unlink=False):
+        with self._lock(self.bf_path[builder_type]):
             self.verify_current_hash(self.bf_path[builder_type], lasthash)
-            builder = RingBuilder.load(self.bf_path[builder_type])
-            if not isinstance(devices, list):
+            builder = self._load_builder(self.bf_path[builder_type],
+                                         writable=True)
+            try:
+                modified = apply(builder, *args)
+            except InvalidOperation as err:
+                return self.return_response(False, lasthash, str(err),
+                                            start_response, env)
+            if not modified:
                 return self.return_response(False, lasthash,
-                                            'Malformed request.',
+                                            'Ring remains unchanged.',
                                             start_response, env)
-            for dev_id in devices:
-                sleep()  # so we don't starve/block
-                try:
-                    builder.remove_dev(int(dev_id))
-                except (IndexError, TypeError):
-                    return self.return_response(False, lasthash,
-                                                'Invalid dev id %s.' % dev_id,
-                                                start_response, env)
-                except RingBuilderError as err:
-                    return self.return_response(False, lasthash,
-                                                'Error removing %s - %s.' %
-                                                (dev_id, err),
-                                                start_response, env)
-                except ValueError as err:
-                    return self.return_response(False, lasthash, str(err),
-                                                start_response, env)
             newmd5 = self.write_builder(builder, self.bf_path[builder_type])
             return self.return_response(True, newmd5, None, start_response,
                                         env)
 
+    def remove_devs(self, builder_type, devices, lasthash, start_response,
+                    env):
+        """ remove devices from the builder
+
+        :params builder_type: the builder_type to use when loading the builder
+        :params devices: list of device ids to be removed.
+        :params lasthash: the hash to use when verifying state
+        """
+        return self._modify(builder_type, lasthash, start_response, env,
+                            self._apply_remove, devices)
+
     def change_weight(self, builder_type, dev_weights, lasthash,
                       start_response, env):
         """ Change weight of devices
@@ -364,24 +1698,8 @@ class RingBuilderMiddleware(object):
         :param dev_weights: a dict of device id and weight
         :param lasthash: the hash to use when verifying state
         """
-        with lock_file(self.bf_path[builder_type], timeout=1, unlink=False):
-            self.verify_current_hash(self.bf_path[builder_type], lasthash)
-            builder = RingBuilder.load(self.bf_path[builder_type])
-            for dev_id in dev_weights:
-                sleep()  # so we don't starve/block
-                try:
-                    builder.set_dev_weight(int(dev_id),
-                                           float(dev_weights[dev_id]))
-                except (IndexError, TypeError):
-                    return self.return_response(False, lasthash,
-                                                'Invalid dev id %s.' % dev_id,
-                                                start_response, env)
-                except ValueError as err:
-                    return self.return_response(False, lasthash, str(err),
-                                                start_response, env)
-            newmd5 = self.write_builder(builder, self.bf_path[builder_type])
-            return self.return_response(True, newmd5, None, start_response,
-                                        env)
+        return self._modify(builder_type, lasthash, start_response, env,
+                            self._apply_weight, dev_weights)
 
     def change_meta(self, builder_type, dev_meta, lasthash, start_response,
                     env):
@@ -391,63 +1709,53 @@ class RingBuilderMiddleware(object):
         :param dev_meta: a dict of device id and meta info
         :param lasthash: the hash to use when verifying state
         """
-        with lock_file(self.bf_path[builder_type], timeout=1, unlink=False):
-            self.verify_current_hash(self.bf_path[builder_type], lasthash)
-            builder = RingBuilder.load(self.bf_path[builder_type])
-            try:
-                modified = False
-                for dev_id in dev_meta:
-                    sleep()  # so we don't starve/block
-                    for device in builder.devs:
-                        if not device:
-                            continue
-                        if device['id'] == int(dev_id):
-                            modified = True
-                            device['meta'] = '%s' % dev_meta[dev_id]
-                if modified:
-                    newmd5 = self.write_builder(builder,
-                                                self.bf_path[builder_type])
-                    return self.return_response(True, newmd5, None,
-                                                start_response, env)
-                else:
-                    return self.return_response(False, lasthash,
-                                                'Invalid dev id %s.' % dev_id,
-                                                start_response, env)
-            except ValueError as err:
-                return self.return_response(False, lasthash, str(err),
-                                            start_response, env)
+        return self._modify(builder_type, lasthash, start_response, env,
+                            self._apply_meta, dev_meta)
 
     def add_to_ring(self, builder_type, body, lasthash, start_response, env):
         """ Handle a add device post """
-        with lock_file(self.bf_path[builder_type], timeout=1, unlink=False):
-            self.verify_current_hash(self.bf_path[builder_type], lasthash)
-            builder = RingBuilder.load(self.bf_path[builder_type])
-            ring_modified = False
+        return self._modify(builder_type, lasthash, start_response, env,
+                            self._apply_add, body['devices'])
+
+    def _apply_batch(self, builder, operations):
+        """ apply a list of operations to a builder instance, in order
+
+        :params builder: builder instance to modify
+        :params operations: list of dicts with an "op" of add, remove, weight
+                            or meta and the "devices" to apply it to
+        :returns: whether the builder was modified
+        :raises: InvalidOperation naming the first operation that failed
+        """
+        appliers = {'add': self._apply_add, 'remove': self._apply_remove,
+                    'weight': self._apply_weight, 'meta': self._apply_meta}
+        if not isinstance(operations, list):
+            raise InvalidOperation('Malformed request.')
+        modified = False
+        for i, operation in enumerate(operations):
             try:
-                for device in body['devices']:
-                    sleep()  # so we don't starve/block
-                    if not self._is_existing_dev(builder, device['ip'],
-                                                 int(device['port']),
-                                                 device['device']):
-                        self._add_device(builder, int(device['zone']),
-                                         device['ip'], int(device['port']),
-                                         device['device'],
-                                         float(device['weight']),
-                                         device['meta'])
-                        ring_modified = True
-            except (AttributeError, KeyError, ValueError, TypeError) as err:
-                return self.return_response(False, lasthash,
-                                            "Malformed request.",
-                                            start_response, env)
-            if ring_modified:
-                newmd5 = self.write_builder(builder,
-                                            self.bf_path[builder_type])
-                return self.return_response(True, newmd5, None,
-                                            start_response, env)
-            else:
-                return self.return_response(False, lasthash,
-                                            'Ring remains unchanged.',
-                                            start_response, env)
+                apply = appliers[operation['op']]
+                devices = operation['devices']
+            except (KeyError, TypeError):
+                raise InvalidOperation('Operation %d: Malformed request.' % i)
+            try:
+                modified = apply(builder, devices) or modified
+            except InvalidOperation as err:
+                raise InvalidOperation('Operation %d (%s): %s' %
+                                       (i, operation['op'], err))
+        return modified
+
+    def batch(self, builder_type, operations, lasthash, start_response, env):
+        """ apply several operations to the builder at once
+
+        The builder is only written if all operations succeed, so a batch is
+        applied either completely or not at all.
+
+        :params builder_type: the builder_type to use when loading the builder
+        :params operations: list of operations, see _apply_batch
+        :params lasthash: the hash to use when verifying state
+        """
+        return self._modify(builder_type, lasthash, start_response, env,
+                            self._apply_batch, operations)
 
     def handle_post(self, builder_type, target, env, start_response, body):
         """ Prase and handle a ring builder post request"""
@@ -465,11 +1773,29 @@ class RingBuilderMiddleware(object):
             if target != 'rebalance':
                 self._log_request(env, 400)
                 return self.http_bad_request(start_response, 'Bad Request')
+            content = {}
         if 'HTTP_X_RING_BUILDER_LAST_HASH' in env:
             lasthash = env['HTTP_X_RING_BUILDER_LAST_HASH']
         else:
             lasthash = None
-        if target == 'add' and 'devices' in content and lasthash:
+        if builder_type == 'all':
+            if self._query_flag(env, 'dry_run') or \
+                    self._query_flag(env, 'async'):
+                self._log_request(env, 400)
+                return self.http_bad_request(
+                    start_response, 'Rebalance builders one at a time for '
+                    'dry runs and async rebalances.')
+            attempts = self._rebalance_attempts(env)
+            if attempts is None:
+                self._log_request(env, 400)
+                return self.http_bad_request(
+                    start_response, 'attempts must be between 1 and %d.' %
+                    self.max_rebalance_attempts)
+            if not isinstance(content, dict):
+                content = {}
+            return self.rebalance_all(content.get('hashes'), start_response,
+                                      env, attempts)
+        elif target == 'add' and 'devices' in content and lasthash:
             return self.add_to_ring(builder_type, json.loads(body), lasthash,
                                     start_response, env)
         elif target == 'remove' and 'devices' in content and lasthash:
@@ -481,44 +1807,151 @@ class RingBuilderMiddleware(object):
         elif target == 'meta' and 'devices' in content and lasthash:
             return self.change_meta(builder_type, content['devices'], lasthash,
                                     start_response, env)
+        elif target == 'batch' and 'operations' in content and lasthash:
+            return self.batch(builder_type, content['operations'], lasthash,
+                              start_response, env)
         elif target == 'rebalance' and lasthash:
-            return self.rebalance(builder_type, lasthash, start_response, env)
+            if self._query_flag(env, 'dry_run'):
+                return self.rebalance_preview(builder_type, lasthash,
+                                              start_response, env)
+            attempts = self._rebalance_attempts(env)
+            if attempts is None:
+                self._log_request(env, 400)
+                return self.http_bad_request(
+                    start_response, 'attempts must be between 1 and %d.' %
+                    self.max_rebalance_attempts)
+            if self._query_flag(env, 'async'):
+                return self.rebalance_async(builder_type, lasthash,
+                                            start_response, env, attempts)
+            return self.rebalance(builder_type, lasthash, start_response, env,
+                                  attempts)
         elif target == 'search' and 'value' in content:
             return self.search(builder_type, content['value'], start_response,
                                env)
+        elif target == 'search' and 'filter' in content:
+            return self.filter_devices(builder_type, content['filter'],
+                                       start_response, env)
         else:
             self._log_request(env, 400)
             return self.http_bad_request(start_response, 'Bad Request')
 
     def handle_head(self, target_file, start_response, env):
         """handle a head request. at this point it simply obtains the targets
-        md5sum.
+        md5sum, honoring If-None-Match and If-Modified-Since.
 
         :params target_file: File whos md5sum to obtain.
         :returns: list of boolean status, md5sum of the current ring, and all
                   builder.devs
         """
-        with lock_file(target_file, unlink=False):
+        with self._lock(target_file, shared=True):
             current_hash = self._get_md5sum(target_file)
-            return self.return_response(True, current_hash, None,
-                                        start_response, env)
+            mtime = os.stat(target_file).st_mtime
+        headers = [('X-Current-Hash', current_hash)] + \
+            self._validators(current_hash, mtime)
+        if self._not_modified(env, current_hash, mtime):
+            self._log_request(env, 304)
+            return self.http_not_modified(start_response, headers)
+        self._log_request(env, 200)
+        start_response('200 OK', headers)
+        return []
+
+    @staticmethod
+    def _with_queue_wait(start_response, waited):
+        """ wrap start_response to add an X-Queue-Wait header
+
+        :params start_response: start_response object
+        :params waited: seconds the request waited in the mutation queue
+        """
+        def queued_start_response(status, headers, *args):
+            return start_response(status, headers +
+                                  [('X-Queue-Wait', '%.3f' % waited)], *args)
+        return queued_start_response
+
+    @staticmethod
+    def _rebased(env, queue, since, start_response):
+        """ apply a queued request to the builder as changed by the requests
+        it was queued behind
+
+        Requests are sent with the X-Ring-Builder-Last-Hash of the builder
+        they were meant for. If that builder was changed by requests ahead in
+        the queue, the request is applied to the resulting builder instead of
+        failing with a 409. Changes made any other way still conflict.
+
+        :params env: the queued requests environment
+        :params queue: the MutationQueue it waited in
+        :params since: what the queue turn gave
+        :params start_response: start_response object
+        :returns: start_response wrapped to record the change the request
+                  makes for the requests queued behind it
+        """
+        lasthash = env.get('HTTP_X_RING_BUILDER_LAST_HASH')
+        if lasthash:
+            lasthash = queue.rebase(lasthash, since)
+            env['HTTP_X_RING_BUILDER_LAST_HASH'] = lasthash
+
+        def rebased_start_response(status, headers, *args):
+            if lasthash and status.startswith('2'):
+                for name, value in headers:
+                    if name == 'X-Current-Hash' and value != lasthash:
+                        queue.changed(lasthash, value)
+            return start_response(status, headers, *args)
+        return rebased_start_response
 
     def post(self, env, start_response, body):
         """handle all post requests"""
         builder_type, target = split_path(env['PATH_INFO'], 3, 3, True)[1:]
-        if builder_type not in ['account', 'container', 'object']:
+        if builder_type == 'all' and target == 'rebalance':
+            # only the listed builders are queued for, malformed requests
+            # are rejected by rebalance_all
+            try:
+                hashes = json.loads(body).get('hashes')
+            except (ValueError, AttributeError):
+                hashes = None
+            if not isinstance(hashes, dict):
+                hashes = {}
+            builder_types = sorted(set(hashes) & set(self.bf_path))
+        elif builder_type in ['account', 'container', 'object']:
+            builder_types = [builder_type]
+        else:
             self._log_request(env, 400)
             return self.http_bad_request(start_response,
                                          'Invalid builder type.')
         try:
-            return self.handle_post(builder_type, target, env,
-                                    start_response, body)
+            if self.mutation_queues is None or \
+                    target not in self.mutating_targets or \
+                    (target == 'rebalance' and
+                     self._query_flag(env, 'dry_run')):
+                return self.handle_post(builder_type, target, env,
+                                        start_response, body)
+            submitted = time()
+            with nested(*[self.mutation_queues[queued].turn()
+                          for queued in builder_types]) as since:
+                queued_start_response = self._with_queue_wait(
+                    start_response, time() - submitted)
+                if builder_type != 'all':
+                    queued_start_response = self._rebased(
+                        env, self.mutation_queues[builder_type], since[0],
+                        queued_start_response)
+                return self.handle_post(builder_type, target, env,
+                                        queued_start_response, body)
+        except QueueFull:
+            self._log_request(env, 503)
+            return self.http_service_unavailable(
+                start_response, 'Too many queued changes, try again.')
+        except QueueTimeout:
+            self._log_request(env, 503)
+            return self.http_service_unavailable(
+                start_response, 'Timed out waiting for queued changes.')
         except RingFileChanged:
             self._log_request(env, 409)
             return self.http_conflict(start_response, 'Builder md5sum differs')
         except LockTimeout:
             self._log_request(env, 409)
             return self.http_conflict(start_response, 'Builder locked.')
+        except ExecutorBusy:
+            self._log_request(env, 503)
+            return self.http_service_unavailable(start_response,
+                                                 'Too busy, try again.')
         except Exception as err:
             self.logger.exception(_('error on builder post'))
             self._log_request(env, 500)
@@ -549,6 +1982,10 @@ class RingBuilderMiddleware(object):
         except LockTimeout:
             self._log_request(env, 409)
             return self.http_conflict(start_response, '%s locked.' % path)
+        except ExecutorBusy:
+            self._log_request(env, 503)
+            return self.http_service_unavailable(start_response,
+                                                 'Too busy, try again.')
         except Exception as err:
             self.logger.exception(_('error on %s head' % path))
             self._log_request(env, 500)
@@ -561,6 +1998,8 @@ class RingBuilderMiddleware(object):
                          self.obj_builder, self.acct_ring, self.cont_ring,
                          self.obj_ring]
         allowed_paths = ['account/list', 'container/list', 'object/list']
+        delta_paths = ['account/delta', 'container/delta', 'object/delta']
+        stats_paths = ['account/stats', 'container/stats', 'object/stats']
         try:
             if path in allowed_files:
                 if env.get('REQUEST_METHOD') == 'GET':
@@ -572,6 +2011,34 @@ class RingBuilderMiddleware(object):
                         return self.ring_or_builder_head(env, start_response)
                     else:
                         return self.http_not_found(start_response)
+            elif path_prefix == 'ringbuilder' and path.startswith('jobs/'):
+                if not env.get('REQUEST_METHOD') == 'GET':
+                    self._log_request(env, 400)
+                    return self.http_bad_request(start_response, 'Try GET.')
+                return self.job_status(path.split('/', 1)[1], start_response,
+                                       env)
+            elif path in delta_paths:
+                if not env.get('REQUEST_METHOD') == 'GET':
+                    self._log_request(env, 400)
+                    return self.http_bad_request(start_response, 'Try GET.')
+                if path_prefix == 'ring':
+                    return self.ring_delta(path.split('/')[0], start_response,
+                                           env)
+                else:
+                    self._log_request(env, 400)
+                    return self.http_bad_request(start_response,
+                                                 'Try /ring uri')
+            elif path in stats_paths:
+                if not env.get('REQUEST_METHOD') == 'GET':
+                    self._log_request(env, 400)
+                    return self.http_bad_request(start_response, 'Try GET.')
+                if path_prefix == 'ringbuilder':
+                    return self.stats(path.split('/')[0], start_response,
+                                      env)
+                else:
+                    self._log_request(env, 400)
+                    return self.http_bad_request(start_response,
+                                                 'Try /ringbuilder uri')
             elif path in allowed_paths:
                 if not env.get('REQUEST_METHOD') == 'GET':
                     self._log_request(env, 400)
@@ -589,13 +2056,17 @@ class RingBuilderMiddleware(object):
         except LockTimeout:
             self._log_request(env, 409)
             return self.http_conflict(start_response, 'Ring locked.')
+        except ExecutorBusy:
+            self._log_request(env, 503)
+            return self.http_service_unavailable(start_response,
+                                                 'Too busy, try again.')
         except Exception as err:
             self.logger.exception(_('error on ring get'))
             self._log_request(env, 500)
             return self.http_internal_server_error(start_response, str(err))
 
     def return_response(self, success, current_hash, content, start_response,
-                        env):
+                        env, headers=None):
         """ generate/return an http response to the client
 
         :params success: whether or not the requested succeeded
@@ -604,18 +2075,24 @@ class RingBuilderMiddleware(object):
         :params content: the content (if any) that should be returned in the
                          response body.
         :params start_response: start_response
+        :params headers: extra headers for successful json responses
         :returns: an http response
         """
         if success:
             self._log_request(env, 200)
             if content:
                 self._log_request(env, 200)
+                if isinstance(content, list) and \
+                        len(content) > self.stream_threshold:
+                    return self.http_ok_stream(start_response, current_hash,
+                                               content, headers)
                 return self.http_ok(start_response, current_hash,
-                                    json.dumps(content))
+                                    json.dumps(content), headers)
             else:
                 self._log_request(env, 200)
                 if isinstance(content, list):
-                    return self.http_ok(start_response, current_hash, '[]')
+                    return self.http_ok(start_response, current_hash, '[]',
+                                        headers)
                 else:
                     return self.http_ok(start_response, current_hash)
         else:
@@ -633,7 +2110,7 @@ class RingBuilderMiddleware(object):
         return [content]
 
     @staticmethod
-    def http_ok(start_response, ringhash=None, content=None):
+    def http_ok(start_response, ringhash=None, content=None, headers=None):
         """return a 200 optionally setting the X-Current-Hash header and
         returning content"""
         if ringhash:
@@ -641,7 +2118,8 @@ class RingBuilderMiddleware(object):
                 start_response('200 OK',
                                [('Content-Length', str(len(content))),
                                 ('X-Current-Hash', str(ringhash)),
-                                ('Content-Type', 'application/json')])
+                                ('Content-Type', 'application/json')] +
+                               (headers or []))
                 return [content]
             else:
                 start_response('200 OK', [('X-Current-Hash', str(ringhash))])
@@ -650,6 +2128,40 @@ class RingBuilderMiddleware(object):
             start_response('200 OK', [('Content-Length', '0')])
             return []
 
+    @staticmethod
+    def http_ok_stream(start_response, ringhash, items, headers=None):
+        """return a 200 with a json list that's encoded as it's sent
+
+        Without a Content-Length the server uses chunked transfer encoding,
+        so the first chunk goes out without the whole list being encoded.
+        """
+        start_response('200 OK', [('X-Current-Hash', str(ringhash)),
+                                  ('Content-Type', 'application/json')] +
+                       (headers or []))
+        return iter_json_list(items)
+
+    @staticmethod
+    def http_ok_json(start_response, content):
+        """return a 200 with a json body that isn't about a single ring"""
+        start_response('200 OK', [('Content-Length', str(len(content))),
+                                  ('Content-Type', 'application/json')])
+        return [content]
+
+    @staticmethod
+    def http_accepted(start_response, ringhash, content):
+        """return a 202 Accepted with a json body"""
+        start_response('202 Accepted',
+                       [('Content-Length', str(len(content))),
+                        ('X-Current-Hash', str(ringhash)),
+                        ('Content-Type', 'application/json')])
+        return [content]
+
+    @staticmethod
+    def http_not_modified(start_response, headers):
+        """return a 304 Not Modified with the given validator headers"""
+        start_response('304 Not Modified', headers)
+        return []
+
     @staticmethod
     def http_bad_request(start_response, content):
         """return a 400 Bad request"""
@@ -680,6 +2192,16 @@ class RingBuilderMiddleware(object):
                         ('Content-Type', 'text/plain')])
         return [content]
 
+    @staticmethod
+    def http_service_unavailable(start_response, content):
+        """return a 503 Service Unavailable"""
+        if not content.endswith('\r\n'):
+            content += '\r\n'
+        start_response('503 Service Unavailable',
+                       [('Content-Length', str(len(content))),
+                        ('Content-Type', 'text/plain')])
+        return [content]
+
     @staticmethod
     def http_unauthorized(start_response):
         """return a 401 Unauthorized"""
@@ -687,6 +2209,11 @@ class RingBuilderMiddleware(object):
         return []
 
     def __call__(self, env, start_response):
+        if self.prune_interval and not self.pruner_started:
+            # started here rather than in __init__ so that it runs in the
+            # worker processes
+            self.pruner_started = True
+            spawn_n(self._prune_backups_forever)
         req = Request(env)
         try:
             if req.path.startswith('/ringbuilder/'):
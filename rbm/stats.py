@@ -0,0 +1,155 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Balance and dispersion statistics of a builder.
+
+The passes over the partition assignments use numpy if it's installed and
+fall back to plain python otherwise; the results are the same.
+"""
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# what swift reports for devices without weight that still have partitions
+MAX_BALANCE = 999.99
+
+
+def _as_numpy(part2dev):
+    """ view a part2dev array('H') as a numpy array without copying it """
+    if isinstance(part2dev, array) and part2dev.typecode == 'H' and \
+            len(part2dev):
+        return numpy.frombuffer(part2dev, numpy.uint16)
+    return numpy.array(part2dev, numpy.intp)
+
+
+def part_counts(replica2part2dev, dev_count):
+    """ count the partition replicas assigned to each device
+
+    :params replica2part2dev: a builders _replica2part2dev arrays
+    :params dev_count: number of device ids
+    :returns: list of the number of replicas per device id
+    """
+    if numpy is not None and replica2part2dev:
+        assigned = numpy.concatenate([_as_numpy(part2dev)
+                                      for part2dev in replica2part2dev])
+        return numpy.bincount(assigned, minlength=dev_count).tolist()
+    counts = [0] * dev_count
+    for part2dev in replica2part2dev:
+        for dev_id in part2dev:
+            counts[dev_id] += 1
+    return counts
+
+
+def shared_parts(replica2part2dev, tier_of):
+    """ count the partitions with more than one replica in the same tier
+
+    :params replica2part2dev: a builders _replica2part2dev arrays
+    :params tier_of: list mapping device ids to (non negative) tier numbers
+    :returns: number of partitions
+    """
+    if not replica2part2dev:
+        return 0
+    if numpy is not None:
+        parts = max(len(part2dev) for part2dev in replica2part2dev)
+        tier_of = numpy.array(tier_of, numpy.intp)
+        # a replica count like 2.5 leaves the last replica shorter, pad it
+        # with tiers no device has
+        tiers = numpy.empty((len(replica2part2dev), parts), numpy.intp)
+        for replica, part2dev in enumerate(replica2part2dev):
+            tiers[replica, :len(part2dev)] = tier_of[_as_numpy(part2dev)]
+            tiers[replica, len(part2dev):] = -1 - replica
+        tiers.sort(axis=0)
+        return int((tiers[1:] == tiers[:-1]).any(axis=0).sum())
+    shared = 0
+    for part in xrange(max(len(part2dev) for part2dev in replica2part2dev)):
+        tiers = [tier_of[part2dev[part]] for part2dev in replica2part2dev
+                 if part < len(part2dev)]
+        if len(set(tiers)) < len(tiers):
+            shared += 1
+    return shared
+
+
+def _balance(parts, parts_wanted):
+    if not parts_wanted:
+        return MAX_BALANCE if parts else 0.0
+    return round(100.0 * parts / parts_wanted - 100.0, 2)
+
+
+def _group(devices, key):
+    """ sum up the weight and partitions of devices by key """
+    groups = {}
+    for dev in devices:
+        group = groups.setdefault(str(dev[key]), {
+            'devices': 0, 'weight': 0.0, 'parts': 0, 'parts_wanted': 0.0})
+        group['devices'] += 1
+        group['weight'] += dev['weight']
+        group['parts'] += dev['parts']
+        group['parts_wanted'] += dev['parts_wanted']
+    for group in groups.itervalues():
+        group['balance'] = _balance(group['parts'], group['parts_wanted'])
+        group['parts_wanted'] = round(group['parts_wanted'], 2)
+    return groups
+
+
+def builder_stats(builder, worst=10):
+    """ compute the balance and dispersion statistics of a builder
+
+    :params builder: the builder instance
+    :params worst: number of worst balanced devices to list
+    :returns: dict of the statistics
+    """
+    replica2part2dev = builder._replica2part2dev or []
+    devs = [dev for dev in builder.devs if dev is not None]
+    counts = part_counts(replica2part2dev, len(builder.devs))
+    total_weight = sum(dev['weight'] for dev in devs)
+    assigned = sum(len(part2dev) for part2dev in replica2part2dev)
+    devices = []
+    for dev in devs:
+        if total_weight:
+            parts_wanted = assigned * dev['weight'] / total_weight
+        else:
+            parts_wanted = 0.0
+        parts = counts[dev['id']]
+        devices.append({'id': dev['id'], 'zone': dev['zone'],
+                        'ip': dev['ip'], 'device': dev['device'],
+                        'weight': dev['weight'], 'parts': parts,
+                        'parts_wanted': parts_wanted,
+                        'balance': _balance(parts, parts_wanted)})
+    zones = _group(devices, 'zone')
+    ips = _group(devices, 'ip')
+    for dev in devices:
+        dev['parts_wanted'] = round(dev['parts_wanted'], 2)
+    dispersion = {}
+    for key, groups in (('zone', zones), ('ip', ips)):
+        numbers = dict((name, i) for i, name in enumerate(groups))
+        # partitions still on removed devices count as their own tier
+        tier_of = range(len(numbers), len(numbers) + len(builder.devs))
+        for dev in devs:
+            tier_of[dev['id']] = numbers[str(dev[key])]
+        shared = shared_parts(replica2part2dev, tier_of)
+        dispersion[key] = {'parts': shared, 'percent': round(
+            100.0 * shared / builder.parts, 2) if replica2part2dev else 0.0}
+    ranked = sorted(devices, key=lambda dev: (-abs(dev['balance']),
+                                              dev['id']))
+    return {'partitions': builder.parts, 'replicas': builder.replicas,
+            'assigned': assigned, 'weight': total_weight,
+            'balance': max([abs(dev['balance']) for dev in devices] or [0]),
+            'devices': devices, 'zones': zones, 'ips': ips,
+            'dispersion': dispersion,
+            'worst': [dev['id'] for dev in ranked[:worst]]}
@@ -0,0 +1,141 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Atomic, hash while write persistence of builders and rings.
+
+write_file streams a new version of a file through a HashingWriter, which
+computes its md5sum (and optionally its sha256) as the bytes go by and can
+tee them into the backup store. Each byte is written once and never read
+back.
+"""
+
+import os
+from hashlib import md5, sha256
+from tempfile import mkstemp
+from os.path import basename, dirname
+
+
+def temp_path_for(target):
+    """Create a temp file next to target to write its replacement to
+
+    The temp file gets the same permissions as target (or 0644 if target
+    doesn't exist yet), since it's going to be renamed over it.
+
+    :params target: the file that is going to be replaced
+    :returns: path of the temp file
+    """
+    fd, tmppath = mkstemp(dir=dirname(target),
+                          prefix='.%s.' % basename(target))
+    try:
+        try:
+            mode = os.stat(target).st_mode & 0777
+        except OSError:
+            mode = 0644
+        os.fchmod(fd, mode)
+    finally:
+        os.close(fd)
+    return tmppath
+
+
+def fsync_dir(path):
+    """ fsync a directory so renames in it are durable
+
+    :params path: the directory to fsync
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class HashingWriter(object):
+    """ file wrapper that hashes everything written to it
+
+    :params fileobj: the file to write to
+    :params sha256sum: whether to compute a sha256 as well as the md5sum
+    :params tee: optional second file like object to write the same bytes to
+    """
+
+    def __init__(self, fileobj, sha256sum=False, tee=None):
+        self.fileobj = fileobj
+        self.tee = tee
+        self.md5sum = md5()
+        self.sha256sum = sha256() if sha256sum else None
+
+    def write(self, data):
+        self.md5sum.update(data)
+        if self.sha256sum:
+            self.sha256sum.update(data)
+        self.fileobj.write(data)
+        if self.tee:
+            self.tee.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def hexdigest(self):
+        """ the md5sum of what was written """
+        return self.md5sum.hexdigest()
+
+    def sha256_hexdigest(self):
+        """ the sha256 of what was written, or None if not computed """
+        if self.sha256sum:
+            return self.sha256sum.hexdigest()
+        return None
+
+
+def write_file(target, serialize, args=(), backups=None, sha256sum=False):
+    """ atomically replace a file
+
+    serialize(fileobj, *args) writes the new contents to a temp file next to
+    target, which is hashed while it's written and fsync'd before it's
+    renamed over target. Readers see either the old or the new file, and a
+    crash never leaves a partially written target behind.
+
+    If a BackupStore is given the new version is backed up before it
+    replaces target, by teeing the bytes into the store as they're written.
+    The temp file itself is never linked into the store, since it becomes
+    the live file, which swift-ring-builder may rewrite in place. If the
+    backup fails target is left alone.
+
+    :params target: the file to replace
+    :params serialize: function that writes the new contents to a file
+    :params args: further arguments to serialize
+    :params backups: BackupStore to back the new version up to, if any
+    :params sha256sum: whether to record a sha256 of the new version with
+                       its backup
+    :returns: md5sum of the new contents
+    """
+    tmppath = temp_path_for(target)
+    tee = None
+    try:
+        if backups is not None:
+            tee = backups.writer()
+        with open(tmppath, 'wb') as fp:
+            writer = HashingWriter(fp, sha256sum, tee)
+            serialize(writer, *args)
+            fp.flush()
+            os.fsync(fp.fileno())
+        if tee:
+            backups.commit(tee, basename(target), writer.hexdigest(),
+                           writer.sha256_hexdigest())
+        os.rename(tmppath, target)
+    except Exception:
+        os.unlink(tmppath)
+        if tee:
+            tee.abort()
+        raise
+    fsync_dir(dirname(target))
+    return writer.hexdigest()
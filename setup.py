@@ -19,6 +19,10 @@ setup(
         'Programming Language :: Python :: 2.6',
         ],
     install_requires=[],
+    extras_require={
+        # speeds up the builder statistics, which work without it too
+        'stats': ['numpy'],
+        },
     entry_points={
         'paste.filter_factory': [
             'rbm=rbm.middleware:filter_factory',
@@ -22,12 +22,21 @@ import swift.common.utils
 from swift.common.exceptions import LockTimeout
 import cPickle as pickle
 import gzip
-from swift.common.ring import RingBuilder
+from swift.common.ring import RingBuilder, RingData
+from array import array
 from mock import Mock, MagicMock, call as mock_call
 import json
 import errno
+import tempfile
+from time import time
+try:
+    from unittest import SkipTest
+except ImportError:
+    from nose import SkipTest
+from email.utils import formatdate
 from rbm.ring_builder import RingFileChanged
 
+
 class FakeApp(object):
     def __call__(self, env, start_response):
         return 'FakeApp'
@@ -56,6 +65,50 @@ class FakedBuilder(object):
         return builder
 
 
+class MiddlewareTestCase(unittest.TestCase):
+    """ tests against a middleware with its swift_dir and backup_dir in a
+    temporary directory and an inline executor """
+
+    conf = {}
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.app = self.make_app()
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def make_app(self, **conf):
+        """ make a middleware using the test directory, conf overrides the
+        class's conf """
+        from rbm import ring_builder
+        app_conf = {'key': 'a', 'swift_dir': self.testdir,
+                    'backup_dir': os.path.join(self.testdir, 'backups'),
+                    'executor': 'inline'}
+        app_conf.update(self.conf)
+        app_conf.update(conf)
+        return ring_builder.RingBuilderMiddleware(FakeApp(), app_conf)
+
+    def make_builder(self, devices=4):
+        """ a small builder that can actually be rebalanced """
+        builder = RingBuilder(8, 3, 0)
+        for i in xrange(devices):
+            builder.add_dev({'id': i, 'region': 1, 'zone': i,
+                             'ip': '1.1.1.1', 'port': 6010,
+                             'device': 'sd%d' % i, 'weight': 1.0,
+                             'meta': ''})
+        return builder
+
+    def write_builder(self, builder=None, builder_type='object'):
+        """ dump builder, a FakedBuilder by default, as the app's
+        builder_type builder and return its md5sum """
+        from rbm import ring_builder
+        if builder is None:
+            builder = FakedBuilder().create_builder()
+        return ring_builder.dump_builder(builder.to_dict(),
+                                         self.app.bf_path[builder_type])
+
+
 class TestRingBuilder(unittest.TestCase):
 
     def setUp(self):
@@ -69,14 +122,19 @@ class TestRingBuilder(unittest.TestCase):
         pickle.dump = MagicMock(return_value=True)
         self.real_gzip = gzip.GzipFile
         gzip.GzipFile = MagicMock()
+        self.testdir = tempfile.mkdtemp()
         self.real_mkdir = os.mkdir
         os.mkdir = MagicMock()
         from rbm import ring_builder
         tb = FakedBuilder()
         self.mock_builder = tb.create_builder()
-        self.app = ring_builder.RingBuilderMiddleware(FakeApp(),
-                                                      {'key': 'something'})
+        self.app = ring_builder.RingBuilderMiddleware(
+            FakeApp(), {'key': 'something', 'swift_dir': self.testdir,
+                        'backup_dir': os.path.join(self.testdir, 'backups')})
+        for path in self.app.bf_path.values() + self.app.rf_path.values():
+            open(path, 'wb').close()
         self.app._get_md5sum = MagicMock(return_value="newhash")
+        self.app._update_digest = MagicMock(return_value="newhash")
         self.app._make_backup = MagicMock(return_value=True)
         self.app.write_builder = MagicMock(return_value="newhash")
 
@@ -86,6 +144,15 @@ class TestRingBuilder(unittest.TestCase):
         swift.common.utils.lock_file = self.real_lock_file
         RingBuilder.search_devs = self.real_search_devs
         os.mkdir = self.real_mkdir
+        shutil.rmtree(self.testdir)
+
+    def assert_head_ok(self, start_response):
+        self.assertEquals(start_response.call_count, 1)
+        status, headers = start_response.call_args[0]
+        self.assertEquals(status, '200 OK')
+        self.assertEquals(headers[:2], [('X-Current-Hash', 'newhash'),
+                                        ('ETag', '"newhash"')])
+        self.assertEquals(headers[2][0], 'Last-Modified')
 
     def test_head_builder(self):
         start_response = MagicMock(return_value="MOCKED")
@@ -94,30 +161,27 @@ class TestRingBuilder(unittest.TestCase):
                             environ={'REQUEST_METHOD': 'HEAD',
                                      'HTTP_X_RING_BUILDER_KEY': 'something'})
         resp = self.app(req.environ, start_response)
-        ob = '/etc/swift/object.builder'
+        ob = os.path.join(self.testdir, 'object.builder')
         self.app._get_md5sum.assert_called_once_with(ob)
-        start_response.assert_called_once_with('200 OK',
-                                               [('X-Current-Hash', 'newhash')])
+        self.assert_head_ok(start_response)
         self.app._get_md5sum.reset_mock()
         start_response.reset_mock()
         req = Request.blank('/ringbuilder/container.builder',
                             environ={'REQUEST_METHOD': 'HEAD',
                                      'HTTP_X_RING_BUILDER_KEY': 'something'})
         resp = self.app(req.environ, start_response)
-        cb = '/etc/swift/container.builder'
+        cb = os.path.join(self.testdir, 'container.builder')
         self.app._get_md5sum.assert_called_once_with(cb)
-        start_response.assert_called_once_with('200 OK',
-                                               [('X-Current-Hash', 'newhash')])
+        self.assert_head_ok(start_response)
         self.app._get_md5sum.reset_mock()
         start_response.reset_mock()
         req = Request.blank('/ringbuilder/account.builder',
                             environ={'REQUEST_METHOD': 'HEAD',
                                      'HTTP_X_RING_BUILDER_KEY': 'something'})
         resp = self.app(req.environ, start_response)
-        ab = '/etc/swift/account.builder'
+        ab = os.path.join(self.testdir, 'account.builder')
         self.app._get_md5sum.assert_called_once_with(ab)
-        start_response.assert_called_once_with('200 OK',
-                                               [('X-Current-Hash', 'newhash')])
+        self.assert_head_ok(start_response)
 
     def test_head_ring(self):
         start_response = MagicMock(return_value="MOCKED")
@@ -125,30 +189,27 @@ class TestRingBuilder(unittest.TestCase):
                             environ={'REQUEST_METHOD': 'HEAD',
                                      'HTTP_X_RING_BUILDER_KEY': 'something'})
         resp = self.app(req.environ, start_response)
-        objr = '/etc/swift/object.ring.gz'
+        objr = os.path.join(self.testdir, 'object.ring.gz')
         self.app._get_md5sum.assert_called_once_with(objr)
-        start_response.assert_called_once_with('200 OK',
-                                               [('X-Current-Hash', 'newhash')])
+        self.assert_head_ok(start_response)
         self.app._get_md5sum.reset_mock()
         start_response.reset_mock()
         req = Request.blank('/ring/container.ring.gz',
                             environ={'REQUEST_METHOD': 'HEAD',
                                      'HTTP_X_RING_BUILDER_KEY': 'something'})
         resp = self.app(req.environ, start_response)
-        cr = '/etc/swift/container.ring.gz'
+        cr = os.path.join(self.testdir, 'container.ring.gz')
         self.app._get_md5sum.assert_called_once_with(cr)
-        start_response.assert_called_once_with('200 OK',
-                                               [('X-Current-Hash', 'newhash')])
+        self.assert_head_ok(start_response)
         self.app._get_md5sum.reset_mock()
         start_response.reset_mock()
         req = Request.blank('/ring/account.ring.gz',
                             environ={'REQUEST_METHOD': 'HEAD',
                                      'HTTP_X_RING_BUILDER_KEY': 'something'})
         resp = self.app(req.environ, start_response)
-        ar = '/etc/swift/account.ring.gz'
+        ar = os.path.join(self.testdir, 'account.ring.gz')
         self.app._get_md5sum.assert_called_once_with(ar)
-        start_response.assert_called_once_with('200 OK',
-                                               [('X-Current-Hash', 'newhash')])
+        self.assert_head_ok(start_response)
 
     def test_bad_method(self):
         start_response = MagicMock(return_value="MOCKED")
@@ -156,7 +217,7 @@ class TestRingBuilder(unittest.TestCase):
                             environ={'REQUEST_METHOD': 'INVALID',
                                      'HTTP_X_RING_BUILDER_KEY': 'something'})
         resp = self.app(req.environ, start_response)
-        objr = '/etc/swift/object.ring.gz'
+        objr = os.path.join(self.testdir, 'object.ring.gz')
         #self.app._get_md5sum.assert_called_once_with(objr)
         start_response.assert_called_once_with('400 Bad Request',
                                                [('Content-Length', '16'),
@@ -167,7 +228,7 @@ class TestRingBuilder(unittest.TestCase):
                             environ={'REQUEST_METHOD': 'INVALID',
                                      'HTTP_X_RING_BUILDER_KEY': 'something'})
         resp = self.app(req.environ, start_response)
-        objr = '/etc/swift/object.ring.gz'
+        objr = os.path.join(self.testdir, 'object.ring.gz')
         #self.app._get_md5sum.assert_called_once_with(objr)
         start_response.assert_called_once_with('400 Bad Request',
                                                [('Content-Length', '16'),
@@ -179,7 +240,7 @@ class TestRingBuilder(unittest.TestCase):
         req = Request.blank('/ring/object',
                             environ={'REQUEST_METHOD': 'INVALID'})
         resp = self.app(req.environ, start_response)
-        objr = '/etc/swift/object.ring.gz'
+        objr = os.path.join(self.testdir, 'object.ring.gz')
         #self.app._get_md5sum.assert_called_once_with(objr)
         start_response.assert_called_once_with('401 Unauthorized',
                                                [('Content-Length', '0')])
@@ -187,7 +248,7 @@ class TestRingBuilder(unittest.TestCase):
         req = Request.blank('/ringbuilder/object',
                             environ={'REQUEST_METHOD': 'INVALID'})
         resp = self.app(req.environ, start_response)
-        objr = '/etc/swift/object.ring.gz'
+        objr = os.path.join(self.testdir, 'object.ring.gz')
         #self.app._get_md5sum.assert_called_once_with(objr)
         start_response.assert_called_once_with('401 Unauthorized',
                                                [('Content-Length', '0')])
@@ -198,7 +259,7 @@ class TestRingBuilder(unittest.TestCase):
                             environ={'REQUEST_METHOD': 'GET',
                                      'HTTP_X_RING_BUILDER_KEY': 'nope'})
         resp = self.app(req.environ, start_response)
-        objr = '/etc/swift/object.ring.gz'
+        objr = os.path.join(self.testdir, 'object.ring.gz')
         #self.app._get_md5sum.assert_called_once_with(objr)
         start_response.assert_called_once_with('401 Unauthorized',
                                                [('Content-Length', '0')])
@@ -207,7 +268,7 @@ class TestRingBuilder(unittest.TestCase):
                             environ={'REQUEST_METHOD': 'POST',
                                      'HTTP_X_RING_BUILDER_KEY': 'nope'})
         resp = self.app(req.environ, start_response)
-        objr = '/etc/swift/object.ring.gz'
+        objr = os.path.join(self.testdir, 'object.ring.gz')
         #self.app._get_md5sum.assert_called_once_with(objr)
         start_response.assert_called_once_with('401 Unauthorized',
                                                [('Content-Length', '0')])
@@ -227,7 +288,7 @@ class TestRingBuilder(unittest.TestCase):
                                                 ('X-Current-Hash', 'newhash'),
                                                 ('Content-Type',
                                                  'application/json')])
-        bf = '/etc/swift/account.builder'
+        bf = os.path.join(self.testdir, 'account.builder')
         RingBuilder.load.assert_called_once_with(bf)
         self.assertEquals(resp, ['{"id": 1, "weight": 5}'])
 
@@ -246,7 +307,7 @@ class TestRingBuilder(unittest.TestCase):
                                                 ('X-Current-Hash', 'newhash'),
                                                 ('Content-Type',
                                                  'application/json')])
-        bf = '/etc/swift/container.builder'
+        bf = os.path.join(self.testdir, 'container.builder')
         RingBuilder.load.assert_called_once_with(bf)
         self.assertEquals(resp, ['{"id": 1, "weight": 5}'])
 
@@ -265,7 +326,7 @@ class TestRingBuilder(unittest.TestCase):
                                                 ('X-Current-Hash', 'newhash'),
                                                 ('Content-Type',
                                                  'application/json')])
-        bf = '/etc/swift/object.builder'
+        bf = os.path.join(self.testdir, 'object.builder')
         RingBuilder.load.assert_called_once_with(bf)
         self.assertEquals(resp, ['{"id": 1, "weight": 5}'])
 
@@ -282,7 +343,7 @@ class TestRingBuilder(unittest.TestCase):
         resp = self.app(req.environ, start_response)
         start_response.assert_called_once_with('200 OK', [('X-Current-Hash',
                                                            'newhash')])
-        bf = '/etc/swift/account.builder'
+        bf = os.path.join(self.testdir, 'account.builder')
         RingBuilder.load.assert_called_once_with(bf)
         for dev in self.mock_builder.devs:
             if dev['id'] == 1:
@@ -301,7 +362,7 @@ class TestRingBuilder(unittest.TestCase):
         resp = self.app(req.environ, start_response)
         start_response.assert_called_once_with('200 OK', [('X-Current-Hash',
                                                            'newhash')])
-        bf = '/etc/swift/container.builder'
+        bf = os.path.join(self.testdir, 'container.builder')
         RingBuilder.load.assert_called_once_with(bf)
         for dev in self.mock_builder.devs:
             if dev['id'] == 1:
@@ -320,7 +381,7 @@ class TestRingBuilder(unittest.TestCase):
         resp = self.app(req.environ, start_response)
         start_response.assert_called_once_with('200 OK', [('X-Current-Hash',
                                                            'newhash')])
-        bf = '/etc/swift/object.builder'
+        bf = os.path.join(self.testdir, 'object.builder')
         RingBuilder.load.assert_called_once_with(bf)
         for dev in self.mock_builder.devs:
             if dev['id'] == 1:
@@ -339,7 +400,7 @@ class TestRingBuilder(unittest.TestCase):
         resp = self.app(req.environ, start_response)
         start_response.assert_called_once_with('200 OK', [('X-Current-Hash',
                                                            'newhash')])
-        bf = '/etc/swift/account.builder'
+        bf = os.path.join(self.testdir, 'account.builder')
         RingBuilder.load.assert_called_once_with(bf)
         for dev in self.mock_builder.devs:
             if dev['id'] == 1:
@@ -358,7 +419,7 @@ class TestRingBuilder(unittest.TestCase):
         resp = self.app(req.environ, start_response)
         start_response.assert_called_once_with('200 OK', [('X-Current-Hash',
                                                            'newhash')])
-        bf = '/etc/swift/container.builder'
+        bf = os.path.join(self.testdir, 'container.builder')
         RingBuilder.load.assert_called_once_with(bf)
         for dev in self.mock_builder.devs:
             if dev['id'] == 1:
@@ -377,7 +438,7 @@ class TestRingBuilder(unittest.TestCase):
         resp = self.app(req.environ, start_response)
         start_response.assert_called_once_with('200 OK', [('X-Current-Hash',
                                                            'newhash')])
-        bf = '/etc/swift/object.builder'
+        bf = os.path.join(self.testdir, 'object.builder')
         RingBuilder.load.assert_called_once_with(bf)
         for dev in self.mock_builder.devs:
             if dev['id'] == 1:
@@ -396,7 +457,7 @@ class TestRingBuilder(unittest.TestCase):
         resp = self.app(req.environ, start_response)
         start_response.assert_called_once_with('200 OK', [('X-Current-Hash',
                                                            'newhash')])
-        bf = '/etc/swift/account.builder'
+        bf = os.path.join(self.testdir, 'account.builder')
         RingBuilder.load.assert_called_once_with(bf)
         for dev in self.mock_builder.devs:
             if dev['id'] == 0:
@@ -415,7 +476,7 @@ class TestRingBuilder(unittest.TestCase):
         resp = self.app(req.environ, start_response)
         start_response.assert_called_once_with('200 OK', [('X-Current-Hash',
                                                            'newhash')])
-        bf = '/etc/swift/container.builder'
+        bf = os.path.join(self.testdir, 'container.builder')
         RingBuilder.load.assert_called_once_with(bf)
         for dev in self.mock_builder.devs:
             if dev['id'] == 0:
@@ -434,7 +495,7 @@ class TestRingBuilder(unittest.TestCase):
         resp = self.app(req.environ, start_response)
         start_response.assert_called_once_with('200 OK', [('X-Current-Hash',
                                                            'newhash')])
-        bf = '/etc/swift/object.builder'
+        bf = os.path.join(self.testdir, 'object.builder')
         RingBuilder.load.assert_called_once_with(bf)
         for dev in self.mock_builder.devs:
             if dev['id'] == 0:
@@ -477,7 +538,7 @@ class TestRingBuilder(unittest.TestCase):
         resp = self.app(req.environ, start_response)
         start_response.assert_called_once_with('200 OK', [('X-Current-Hash',
                                                            'newhash')])
-        bf = '/etc/swift/account.builder'
+        bf = os.path.join(self.testdir, 'account.builder')
         RingBuilder.load.assert_called_once_with(bf)
         self.assertTrue(len(self.mock_builder.devs) == 7)
         self.assertTrue(_dev_in_builder(self.mock_builder, field='meta',
@@ -530,7 +591,7 @@ class TestRingBuilder(unittest.TestCase):
         resp = self.app(req.environ, start_response)
         start_response.assert_called_once_with('200 OK', [('X-Current-Hash',
                                                            'newhash')])
-        bf = '/etc/swift/container.builder'
+        bf = os.path.join(self.testdir, 'container.builder')
         RingBuilder.load.assert_called_once_with(bf)
         self.assertTrue(len(self.mock_builder.devs) == 7)
         self.assertTrue(_dev_in_builder(self.mock_builder, field='meta',
@@ -584,7 +645,7 @@ class TestRingBuilder(unittest.TestCase):
         resp = self.app(req.environ, start_response)
         start_response.assert_called_once_with('200 OK', [('X-Current-Hash',
                                                            'newhash')])
-        bf = '/etc/swift/object.builder'
+        bf = os.path.join(self.testdir, 'object.builder')
         RingBuilder.load.assert_called_once_with(bf)
         self.assertTrue(len(self.mock_builder.devs) == 7)
         self.assertTrue(_dev_in_builder(self.mock_builder, field='meta',
@@ -630,10 +691,10 @@ class TestRingBuilder(unittest.TestCase):
                                                 ('X-Current-Hash', 'newhash'),
                                                 ('Content-Type',
                                                  'application/json')])
-        mb_calls = mock_call('/etc/swift/account.ring.gz')
+        mb_calls = mock_call(os.path.join(self.testdir, 'account.ring.gz'))
         self.app._make_backup.assert_has_calls(mb_calls, any_order=False)
         self.assertTrue(builder.get_ring.call_count == 1)
-        bf = '/etc/swift/account.builder'
+        bf = os.path.join(self.testdir, 'account.builder')
         self.app.write_builder.assert_has_calls([mock_call(builder, bf)])
 
     def test_rb_rebalance_container(self):
@@ -667,8 +728,8 @@ class TestRingBuilder(unittest.TestCase):
                                                 ('X-Current-Hash', 'newhash'),
                                                 ('Content-Type',
                                                  'application/json')])
-        rf = '/etc/swift/container.ring.gz'
-        bf = '/etc/swift/container.builder'
+        rf = os.path.join(self.testdir, 'container.ring.gz')
+        bf = os.path.join(self.testdir, 'container.builder')
         mb_calls = mock_call(rf)
         self.app._make_backup.assert_has_calls(mb_calls, any_order=False)
         self.assertTrue(builder.get_ring.call_count == 1)
@@ -704,8 +765,8 @@ class TestRingBuilder(unittest.TestCase):
                                                 ('X-Current-Hash', 'newhash'),
                                                 ('Content-Type',
                                                  'application/json')])
-        rf = '/etc/swift/object.ring.gz'
-        bf = '/etc/swift/object.builder'
+        rf = os.path.join(self.testdir, 'object.ring.gz')
+        bf = os.path.join(self.testdir, 'object.builder')
         mb_calls = mock_call(rf)
         self.app._make_backup.assert_has_calls(mb_calls, any_order=False)
         self.assertTrue(builder.get_ring.call_count == 1)
@@ -1246,28 +1307,40 @@ class TestRingBuilderComponents(unittest.TestCase):
         self.assertTrue('400 Bad Request' in start_response.call_args[0])
 
     def test_make_backup(self):
-        shutil.copy = MagicMock()
         from rbm import ring_builder
+        from rbm.backup import store_backup
         self.app = ring_builder.RingBuilderMiddleware(FakeApp(), {'key': 'a'})
         self.app._get_md5sum = MagicMock(return_value="currenthash")
-        #self.app.get_builder = MagicMock(return_value=self.mock_builder)
-        self.app.is_existing_dev = MagicMock(return_value=True)
-        self.app.write_builder = MagicMock(return_value="newhash")
-        builder_type = 'object'
+        self.app.executor.call = MagicMock(return_value="currenthash")
         result = self.app._make_backup('something')
         self.assertTrue(result is None)
-        os.mkdir.assert_has_calls(mock_call('/etc/swift/backups'))
-        #oserror dir exists
-        os.mkdir.reset_mock()
-        os.mkdir.side_effect = OSError(errno.EEXIST, 'something')
-        result = self.app._make_backup('something')
-        self.assertTrue(shutil.copy.call_count == 2)
-        os.mkdir.assert_has_calls(mock_call('/etc/swift/backups'))
-        #oserror dir exists
-        os.mkdir.reset_mock()
-        os.mkdir.side_effect = OSError(2, 'oops')
+        self.app._get_md5sum.assert_called_once_with('something')
+        self.app.executor.call.assert_called_once_with(
+            store_backup, self.app.backups, 'something', 'currenthash')
+        #nothing to back up yet
+        self.app.executor.call.reset_mock()
+        self.app._get_md5sum.side_effect = OSError(errno.ENOENT, 'nope')
+        self.app._make_backup('something')
+        self.assertFalse(self.app.executor.call.called)
+        #other errors
+        self.app._get_md5sum.side_effect = OSError(errno.EACCES, 'oops')
         self.assertRaises(OSError, self.app._make_backup, 'something')
 
+    def test_prune_backups(self):
+        from rbm import ring_builder
+        from rbm.backup import prune_backups
+        self.app = ring_builder.RingBuilderMiddleware(FakeApp(), {'key': 'a'})
+        self.app.executor.call = MagicMock(return_value=(2, 42))
+        self.assertEquals(self.app.prune_backups(), (2, 42))
+        self.app.executor.call.assert_called_once_with(prune_backups,
+                                                       self.app.backups)
+        self.assertEquals(self.app.backups.keep_last, 10)
+        self.app = ring_builder.RingBuilderMiddleware(
+            FakeApp(), {'key': 'a', 'backup_keep_last': '3',
+                        'backup_max_size': '1000'})
+        self.assertEquals(self.app.backups.keep_last, 3)
+        self.assertEquals(self.app.backups.max_size, 1000)
+
     def test_verify_current_hash_bad_hash(self):
         from rbm import ring_builder
         self.app = ring_builder.RingBuilderMiddleware(FakeApp(), {'key': 'a'})
@@ -1277,5 +1350,1601 @@ class TestRingBuilderComponents(unittest.TestCase):
                           'notvalid')
 
 
+class TestDigestCache(MiddlewareTestCase):
+
+    def setUp(self):
+        MiddlewareTestCase.setUp(self)
+        self.target = self.app.bf_path['object']
+        with open(self.target, 'wb') as f:
+            f.write('somedata')
+        old = time() - 60
+        os.utime(self.target, (old, old))
+
+    def test_get_md5sum_cached(self):
+        real_hash = self.app._hash_file(self.target)
+        self.assertEquals(self.app._get_md5sum(self.target), real_hash)
+        self.app._hash_file = MagicMock(return_value='nope')
+        self.assertEquals(self.app._get_md5sum(self.target), real_hash)
+        self.assertEquals(self.app._hash_file.call_count, 0)
+        #changed file should be rehashed
+        with open(self.target, 'wb') as f:
+            f.write('otherdata')
+        self.assertEquals(self.app._get_md5sum(self.target), 'nope')
+        self.assertEquals(self.app._hash_file.call_count, 1)
+
+    def test_get_md5sum_recent_not_cached(self):
+        now = time()
+        os.utime(self.target, (now, now))
+        self.app._get_md5sum(self.target)
+        self.assertTrue(self.target not in self.app.digest_cache)
+        #our own writes are always cached
+        digest = self.app._update_digest(self.target)
+        self.assertEquals(self.app.digest_cache[self.target][1], digest)
+        self.app._hash_file = MagicMock(return_value='nope')
+        self.assertEquals(self.app._get_md5sum(self.target), digest)
+
+    def test_sidecar_shared_between_workers(self):
+        digest = self.app._update_digest(self.target)
+        self.assertTrue(os.path.exists(self.target + '.md5'))
+        other = self.make_app()
+        other._hash_file = MagicMock(return_value='nope')
+        self.assertEquals(other._get_md5sum(self.target), digest)
+        self.assertEquals(other._hash_file.call_count, 0)
+        #stale sidecar is ignored
+        with open(self.target, 'wb') as f:
+            f.write('otherdata')
+        other = self.make_app()
+        other._hash_file = MagicMock(return_value='nope')
+        self.assertEquals(other._get_md5sum(self.target), 'nope')
+
+    def test_sidecar_not_written_on_read(self):
+        self.app._get_md5sum(self.target)
+        self.assertFalse(os.path.exists(self.target + '.md5'))
+
+    def test_sidecar_temp_file_removed_on_error(self):
+        from rbm import ring_builder
+        real_rename = os.rename
+        try:
+            ring_builder.os.rename = MagicMock(side_effect=OSError(28,
+                                                                   'full'))
+            self.app._update_digest(self.target, 'somedigest')
+        finally:
+            ring_builder.os.rename = real_rename
+        self.assertEquals(os.listdir(self.testdir), ['object.builder'])
+
+    def test_sidecar_disabled(self):
+        self.app = self.make_app(digest_sidecars='false')
+        self.app._update_digest(self.target)
+        self.assertFalse(os.path.exists(self.target + '.md5'))
+
+
+class TestBuilderCache(MiddlewareTestCase):
+
+    def setUp(self):
+        MiddlewareTestCase.setUp(self)
+        self.target = self.app.bf_path['object']
+        with open(self.target, 'wb') as f:
+            f.write('somedata')
+        old = time() - 60
+        os.utime(self.target, (old, old))
+        self.mock_builder = FakedBuilder().create_builder()
+        self.real_load = RingBuilder.load
+        RingBuilder.load = MagicMock(return_value=self.mock_builder)
+
+    def tearDown(self):
+        RingBuilder.load = self.real_load
+        MiddlewareTestCase.tearDown(self)
+
+    def test_load_builder_cached(self):
+        builder = self.app._load_builder(self.target)
+        self.assertEquals(builder.devs, self.mock_builder.devs)
+        self.assertTrue(self.app._load_builder(self.target) is builder)
+        RingBuilder.load.assert_called_once_with(self.target)
+        #changed builder should be reloaded
+        with open(self.target, 'wb') as f:
+            f.write('otherdata')
+        old = time() - 30
+        os.utime(self.target, (old, old))
+        self.app._load_builder(self.target)
+        self.assertEquals(RingBuilder.load.call_count, 2)
+
+    def test_load_builder_writable_copy(self):
+        self.app._load_builder(self.target)
+        builder = self.app._load_builder(self.target, writable=True)
+        self.assertFalse(builder is self.mock_builder)
+        builder.devs[1]['meta'] = 'changed'
+        self.assertEquals(self.mock_builder.devs[1]['meta'], 'meta for 1')
+        RingBuilder.load.assert_called_once_with(self.target)
+
+
+class TestAtomicWrites(MiddlewareTestCase):
+
+    def setUp(self):
+        MiddlewareTestCase.setUp(self)
+        self.builder_file = self.app.bf_path['object']
+        self.ring_file = self.app.rf_path['object']
+
+    def test_dump_builder(self):
+        from rbm import ring_builder
+        builder = FakedBuilder().create_builder()
+        digest = ring_builder.dump_builder(builder.to_dict(),
+                                           self.builder_file)
+        self.assertEquals(digest, ring_builder.hash_file(self.builder_file))
+        with open(self.builder_file, 'rb') as fp:
+            self.assertEquals(pickle.load(fp)['devs'], builder.devs)
+        self.assertEquals(os.listdir(self.testdir), ['object.builder'])
+        #failed writes leave the builder alone
+        broken = {'devs': lambda: None}
+        self.assertRaises(Exception, ring_builder.dump_builder, broken,
+                          self.builder_file)
+        self.assertEquals(digest, ring_builder.hash_file(self.builder_file))
+        self.assertEquals(os.listdir(self.testdir), ['object.builder'])
+        #builders cross the executor as dicts, which survive pickling
+        data = pickle.loads(pickle.dumps(builder.to_dict(),
+                                         pickle.HIGHEST_PROTOCOL))
+        self.assertEquals(data, builder.to_dict())
+        rebuilt = ring_builder.builder_from_dict(data)
+        self.assertEquals([d['id'] for d in rebuilt.devs],
+                          [d['id'] for d in builder.devs])
+
+    def test_save_ring(self):
+        from rbm import ring_builder
+        builder = RingBuilder(2, 2, 0)
+        for i in xrange(2):
+            builder.add_dev({'id': i, 'region': 1, 'zone': i,
+                             'ip': '1.1.1.1', 'port': 6010,
+                             'device': 'sd%d' % i, 'weight': 1.0,
+                             'meta': ''})
+        builder.rebalance()
+        digest = ring_builder.save_ring(builder.to_dict(), self.ring_file)
+        self.assertEquals(digest, ring_builder.hash_file(self.ring_file))
+        ring = RingData.load(self.ring_file)
+        self.assertEquals([d['id'] for d in ring.devs], [0, 1])
+        #the same ring is always written the same way
+        self.assertEquals(ring_builder.save_ring(builder.to_dict(),
+                                                 self.ring_file), digest)
+
+    def test_write_builder_doesnt_rehash(self):
+        from rbm import ring_builder
+        app = self.app
+        app._hash_file = MagicMock(side_effect=Exception('rehashed'))
+        digest = app.write_builder(FakedBuilder().create_builder(),
+                                   self.builder_file)
+        self.assertEquals(digest, ring_builder.hash_file(self.builder_file))
+        self.assertEquals(app._get_md5sum(self.builder_file), digest)
+
+    def test_write_file_backs_up(self):
+        from hashlib import md5, sha256
+        from rbm.backup import BackupStore
+        from rbm.writer import write_file
+        store = BackupStore(os.path.join(self.testdir, 'backups'))
+        write = lambda fp, data: fp.write(data)
+        digest = write_file(self.builder_file, write, ('one',), store, True)
+        self.assertEquals(digest, md5('one').hexdigest())
+        #never linked to the live file, which may be rewritten in place
+        self.assertNotEquals(os.stat(store.find(digest)).st_ino,
+                             os.stat(self.builder_file).st_ino)
+        with open(self.builder_file, 'r+b') as fp:
+            fp.write('ten')
+        self.assertEquals(store.open(digest).read(), 'one')
+        entry = store.entries()[-1]
+        self.assertEquals(entry['name'], 'object.builder')
+        self.assertEquals(entry['sha256'], sha256('one').hexdigest())
+        #compressed stores get the bytes teed to them
+        store = BackupStore(os.path.join(self.testdir, 'backups'),
+                            compress=True)
+        digest = write_file(self.builder_file, write, ('two',), store)
+        self.assertTrue(store.find(digest).endswith('.gz'))
+        self.assertEquals(store.open(digest).read(), 'two')
+        self.assertFalse('sha256' in store.entries()[-1])
+        #a failed backup leaves the target alone
+        store.commit = MagicMock(side_effect=OSError(errno.ENOSPC, 'full'))
+        self.assertRaises(OSError, write_file, self.builder_file, write,
+                          ('three',), store)
+        with open(self.builder_file) as fp:
+            self.assertEquals(fp.read(), 'two')
+        self.assertEquals(os.listdir(self.testdir),
+                          ['backups', 'object.builder'])
+        self.assertFalse([f for f in os.listdir(store.objects_dir)
+                          if f.startswith('.tmp')])
+        #as does a backup store that can't take the new version at all
+        store.writer = MagicMock(side_effect=OSError(errno.EACCES, 'denied'))
+        self.assertRaises(OSError, write_file, self.builder_file, write,
+                          ('four',), store)
+        with open(self.builder_file) as fp:
+            self.assertEquals(fp.read(), 'two')
+        self.assertEquals(os.listdir(self.testdir),
+                          ['backups', 'object.builder'])
+
+    def test_make_backup_skips_stored(self):
+        app = self.app
+        app.write_builder(FakedBuilder().create_builder(), self.builder_file)
+        self.assertEquals(len(app.backups.entries()), 1)
+        app._make_backup(self.builder_file)
+        self.assertEquals(len(app.backups.entries()), 1)
+
+    def test_lock_uses_lock_file(self):
+        app = self.make_app(lock_timeout='0.05')
+        with app._lock(self.builder_file):
+            self.assertTrue(os.path.exists(self.builder_file + '.lock'))
+            self.assertFalse(os.path.exists(self.builder_file))
+
+    def test_shared_locks(self):
+        app = self.make_app(lock_timeout='0.05')
+        with app._lock(self.builder_file, shared=True):
+            #readers don't block each other
+            with app._lock(self.builder_file, shared=True):
+                pass
+            #but do block writers
+            try:
+                with app._lock(self.builder_file):
+                    self.fail('got exclusive lock')
+            except LockTimeout:
+                pass
+        with app._lock(self.builder_file):
+            try:
+                with app._lock(self.builder_file, shared=True):
+                    self.fail('got shared lock')
+            except LockTimeout:
+                pass
+        #and once released anyone can lock it again
+        with app._lock(self.builder_file):
+            pass
+
+    def test_writer_not_starved_by_readers(self):
+        from eventlet import GreenPile, sleep, spawn
+        app = self.make_app(lock_timeout='1')
+        pile = GreenPile()
+        order = []
+
+        def _read():
+            with app._lock(self.builder_file, shared=True):
+                order.append('read')
+                sleep(0.03)
+
+        def _readers():
+            #a new reader every 10ms, each holding the lock for 30ms, so
+            #the readers overlap and there's never a moment without one
+            while 'write' not in order:
+                pile.spawn(_read)
+                sleep(0.01)
+
+        readers = spawn(_readers)
+        sleep(0.05)
+        with app._lock(self.builder_file, timeout=0.5):
+            order.append('write')
+        readers.wait()
+        list(pile)
+        self.assertTrue(order.index('write') > 0)
+
+
+class TestBatch(MiddlewareTestCase):
+
+    def setUp(self):
+        MiddlewareTestCase.setUp(self)
+        self.builder_file = self.app.bf_path['object']
+        self.lasthash = self.write_builder()
+
+    def post_batch(self, operations):
+        start_response = MagicMock(return_value="MOCKED")
+        env = {'PATH_INFO': '/ringbuilder/object/batch',
+               'CONTENT_TYPE': 'application/json',
+               'HTTP_X_RING_BUILDER_LAST_HASH': self.lasthash}
+        result = self.app.post(env, start_response,
+                               json.dumps({'operations': operations}))
+        return start_response.call_args[0], result
+
+    def test_batch(self):
+        from rbm import ring_builder
+        (status, headers), result = self.post_batch([
+            {'op': 'add', 'devices': [{'zone': 5, 'ip': '1.1.1.2',
+                                       'port': 6010, 'device': 'sdb',
+                                       'weight': 0.0, 'meta': ''}]},
+            {'op': 'weight', 'devices': {'5': 1.0}},
+            {'op': 'weight', 'devices': {'5': 2.0, '0': 3.0}},
+            {'op': 'meta', 'devices': {'1': 'new meta'}},
+            {'op': 'remove', 'devices': [2]}])
+        self.assertEquals(status, '200 OK')
+        newhash = ring_builder.hash_file(self.builder_file)
+        self.assertTrue(('X-Current-Hash', newhash) in headers)
+        builder = RingBuilder.load(self.builder_file)
+        self.assertEquals(builder.devs[5]['ip'], '1.1.1.2')
+        self.assertEquals(builder.devs[5]['weight'], 2.0)
+        self.assertEquals(builder.devs[0]['weight'], 3.0)
+        self.assertEquals(builder.devs[1]['meta'], 'new meta')
+        self.assertEquals(builder.devs[2]['weight'], 0)
+        #written and backed up once
+        self.assertEquals([e['digest'] for e in self.app.backups.entries()],
+                          [self.lasthash, newhash])
+
+    def test_batch_rolls_back(self):
+        from rbm import ring_builder
+        (status, headers), result = self.post_batch([
+            {'op': 'weight', 'devices': {'0': 3.0}},
+            {'op': 'weight', 'devices': {'99': 1.0}}])
+        self.assertEquals(status, '400 Bad Request')
+        self.assertEquals(result,
+                          ['Operation 1 (weight): Invalid dev id 99.\r\n'])
+        self.assertEquals(ring_builder.hash_file(self.builder_file),
+                          self.lasthash)
+        self.assertEquals(self.app.backups.entries(), [])
+        (status, headers), result = self.post_batch([{'op': 'nope'}])
+        self.assertEquals(result, ['Operation 0: Malformed request.\r\n'])
+        (status, headers), result = self.post_batch({'op': 'weight'})
+        self.assertEquals(result, ['Malformed request.\r\n'])
+        #meta needs a non empty dict of devices
+        for devices in ({}, ['1']):
+            (status, headers), result = self.post_batch([
+                {'op': 'meta', 'devices': devices}])
+            self.assertEquals(status, '400 Bad Request')
+            self.assertEquals(result,
+                              ['Operation 0 (meta): Malformed request.\r\n'])
+        (status, headers), result = self.post_batch([
+            {'op': 'meta', 'devices': {'99': 'x'}}])
+        self.assertEquals(result,
+                          ['Operation 0 (meta): Invalid dev id 99.\r\n'])
+        #nothing to do
+        (status, headers), result = self.post_batch([])
+        self.assertEquals(result, ['Ring remains unchanged.\r\n'])
+
+
+class TestDeviceIndex(unittest.TestCase):
+
+    def test_index(self):
+        from rbm.devices import DeviceIndex
+        builder = FakedBuilder().create_builder()
+        builder.remove_dev(4)
+        index = DeviceIndex(builder.devs + [None])
+        self.assertEquals(index.next_id, 5)
+        self.assertTrue(index.get(1) is builder.devs[1])
+        self.assertEquals(index.get(42), None)
+        self.assertTrue(index.find('1.1.1.1', 6010, 'sd2') is
+                        builder.devs[2])
+        self.assertEquals(index.find('1.1.1.1', 6011, 'sd2'), None)
+        index.add({'id': 7, 'ip': '1.1.1.2', 'port': 6010, 'device': 'sda'})
+        self.assertEquals(index.next_id, 8)
+        self.assertEquals(index.find('1.1.1.2', 6010, 'sda')['id'], 7)
+        self.assertEquals(DeviceIndex([]).next_id, 0)
+
+    def test_apply_add(self):
+        from rbm import ring_builder
+        app = ring_builder.RingBuilderMiddleware(FakeApp(), {'key': 'a'})
+        builder = FakedBuilder().create_builder()
+        new = {'zone': 1, 'ip': '1.1.1.3', 'port': 6010, 'device': 'sda',
+               'weight': 1.0, 'meta': ''}
+        existing = dict(new, ip='1.1.1.1', device='sd0')
+        self.assertTrue(app._apply_add(builder, [existing, new, new]))
+        self.assertEquals(len(builder.devs), 6)
+        self.assertEquals(builder.devs[5]['ip'], '1.1.1.3')
+        self.assertFalse(app._apply_add(builder, [new]))
+        self.assertTrue(app._apply_meta(builder, {'5': 'meta'}))
+        self.assertEquals(builder.devs[5]['meta'], 'meta')
+
+
+class TestDeviceSearch(MiddlewareTestCase):
+
+    def setUp(self):
+        from rbm.devices import DeviceSearchIndex
+        MiddlewareTestCase.setUp(self)
+        self.devs = [
+            {'id': 0, 'zone': 1, 'ip': '10.0.0.1', 'port': 6010,
+             'device': 'sda', 'weight': 1.0, 'meta': 'rack 1'},
+            {'id': 1, 'zone': 1, 'ip': '10.0.0.1', 'port': 6010,
+             'device': 'sdb', 'weight': 2.0, 'meta': 'rack 1 slow'},
+            None,
+            {'id': 3, 'zone': 2, 'ip': '10.0.1.7', 'port': 6020,
+             'device': 'sdc', 'weight': 3.0, 'meta': ''},
+            {'id': 4, 'zone': 3, 'ip': 'fe80::1', 'port': 6010,
+             'device': 'nvme0', 'weight': 0.0, 'meta': 'rack 2'}]
+        self.index = DeviceSearchIndex(self.devs)
+
+    def test_fields(self):
+        search = self.index.search
+        self.assertEquals(search({'zone': 1}), set([0, 1]))
+        self.assertEquals(search({'zone': [2, 3]}), set([3, 4]))
+        self.assertEquals(search({'weight': {'min': 1.5, 'max': 3}}),
+                          set([1, 3]))
+        self.assertEquals(search({'weight': {'max': 0.5}}), set([4]))
+        self.assertEquals(search({'port': 6020}), set([3]))
+        self.assertEquals(search({'id': 2}), set())
+        self.assertEquals(search({'ip': '10.0.0.1'}), set([0, 1]))
+        self.assertEquals(search({'ip': '10.0.0.0/16'}), set([0, 1, 3]))
+        self.assertEquals(search({'ip': '10.0.1.0/24'}), set([3]))
+        self.assertEquals(search({'ip': 'fe80::/64'}), set([4]))
+        self.assertEquals(search({'device': 'sd[ab]'}), set([0, 1]))
+        self.assertEquals(search({'device': 'nvme*'}), set([4]))
+        self.assertEquals(search({'device': 'sdc'}), set([3]))
+        self.assertEquals(search({'meta': 'rack 1'}), set([0, 1]))
+
+    def test_combined(self):
+        search = self.index.search
+        self.assertEquals(search({'zone': 1, 'meta': 'slow'}), set([1]))
+        self.assertEquals(search({'or': [{'zone': 2}, {'meta': 'rack 2'}]}),
+                          set([3, 4]))
+        self.assertEquals(search({'and': [{'port': 6010},
+                                          {'or': [{'zone': 3},
+                                                  {'device': 'sda'}]}]}),
+                          set([0, 4]))
+        self.assertEquals([d['id'] for d in self.index.devices(set([4, 0]))],
+                          [0, 4])
+
+    def test_invalid(self):
+        search = self.index.search
+        for bad in ({}, [], {'nope': 1}, {'zone': 'one'},
+                    {'zone': {'min': 'a'}}, {'zone': {'low': 1}},
+                    {'ip': '10.0.0.0/40'}, {'ip': 'nope/8'}, {'ip': 5},
+                    {'or': []}, {'and': {'zone': 1}}, {'zone': True}):
+            self.assertRaises(ValueError, search, bad)
+
+    def test_page(self):
+        page = self.index.page
+        self.assertEquals(page(), ([0, 1, 3, 4], False))
+        self.assertEquals(page(limit=2), ([0, 1], True))
+        self.assertEquals(page(marker=1, limit=2), ([3, 4], False))
+        self.assertEquals(page(marker=2, limit=1), ([3], True))
+        self.assertEquals(page('weight'), ([4, 0, 1, 3], False))
+        self.assertEquals(page('zone', marker=0), ([1, 3, 4], False))
+        self.assertEquals(page('zone', marker=1, limit=1), ([3], True))
+        self.assertRaises(ValueError, page, 'zone', 2)
+        self.assertRaises(ValueError, page, 'ip')
+
+    def test_list_devices_paged(self):
+        app = self.app
+        app._get_md5sum = MagicMock(return_value='currenthash')
+        builder = MagicMock()
+        builder.devs = self.devs
+        app._load_builder = MagicMock(return_value=builder)
+        start_response = MagicMock(return_value="MOCKED")
+
+        def list_devices(query):
+            env = {'QUERY_STRING': query}
+            return json.loads(''.join(app.list_devices('object',
+                                                       start_response, env)))
+
+        #without parameters everything is listed as before
+        self.assertEquals(list_devices(''), self.devs)
+        result = list_devices('limit=2&fields=ip,weight')
+        self.assertEquals(result, [{'id': 0, 'ip': '10.0.0.1', 'weight': 1.0},
+                                   {'id': 1, 'ip': '10.0.0.1', 'weight': 2.0}])
+        self.assertTrue(('X-Next-Marker', '1') in
+                        start_response.call_args[0][1])
+        result = list_devices('limit=2&fields=ip&marker=1')
+        self.assertEquals([d['id'] for d in result], [3, 4])
+        self.assertFalse('X-Next-Marker' in
+                         dict(start_response.call_args[0][1]))
+        result = list_devices('sort=weight&fields=id')
+        self.assertEquals(result, [{'id': 4}, {'id': 0}, {'id': 1},
+                                   {'id': 3}])
+        for bad in ('limit=0', 'marker=x', 'sort=ip', 'sort=zone&marker=2'):
+            start_response.reset_mock()
+            app.list_devices('object', start_response, {'QUERY_STRING': bad})
+            self.assertEquals(start_response.call_args[0][0],
+                              '400 Bad Request')
+
+    def test_list_devices_streamed(self):
+        app = self.make_app(json_stream_threshold='2')
+        app._get_md5sum = MagicMock(return_value='currenthash')
+        builder = MagicMock()
+        builder.devs = self.devs
+        app._load_builder = MagicMock(return_value=builder)
+        start_response = MagicMock(return_value="MOCKED")
+        result = app.list_devices('object', start_response,
+                                  {'QUERY_STRING': ''})
+        self.assertFalse(isinstance(result, list))
+        headers = dict(start_response.call_args[0][1])
+        self.assertFalse('Content-Length' in headers)
+        self.assertEquals(headers['X-Current-Hash'], 'currenthash')
+        self.assertEquals(''.join(result), json.dumps(self.devs))
+        #lists at or below the threshold are sent as before
+        result = app.list_devices('object', start_response,
+                                  {'QUERY_STRING': 'limit=2'})
+        self.assertTrue(isinstance(result, list))
+
+    def test_iter_json_list(self):
+        from rbm.ring_builder import iter_json_list
+        for items in ([], [None], self.devs):
+            self.assertEquals(''.join(iter_json_list(items)),
+                              json.dumps(items))
+        chunks = list(iter_json_list(self.devs, chunk_size=1))
+        self.assertEquals(len(chunks), len(self.devs) + 1)
+        self.assertEquals(''.join(chunks), json.dumps(self.devs))
+
+    def test_filter_devices(self):
+        app = self.app
+        app._get_md5sum = MagicMock(return_value='currenthash')
+        builder = MagicMock()
+        builder.devs = self.devs
+        app._load_builder = MagicMock(return_value=builder)
+        start_response = MagicMock(return_value="MOCKED")
+        result = app.filter_devices('object', {'zone': 1}, start_response,
+                                    {})
+        self.assertEquals([d['id'] for d in json.loads(result[0])], [0, 1])
+        self.assertTrue(('X-Current-Hash', 'currenthash') in
+                        start_response.call_args[0][1])
+        #indexes are reused until the builder changes
+        app.filter_devices('object', {'zone': 2}, start_response, {})
+        self.assertEquals(app._load_builder.call_count, 1)
+        app._get_md5sum.return_value = 'newhash'
+        app.filter_devices('object', {'zone': 2}, start_response, {})
+        self.assertEquals(app._load_builder.call_count, 2)
+        result = app.filter_devices('object', {'zone': 'x'}, start_response,
+                                    {})
+        self.assertEquals(start_response.call_args[0][0], '400 Bad Request')
+
+
+class TestStats(MiddlewareTestCase):
+
+    def setUp(self):
+        from rbm import stats
+        MiddlewareTestCase.setUp(self)
+        self.stats = stats
+        self.numpy = stats.numpy
+        self.builder = Mock()
+        self.builder.parts = 4
+        self.builder.replicas = 2
+        self.builder.devs = [
+            {'id': 0, 'zone': 1, 'ip': '10.0.0.1', 'device': 'sda',
+             'weight': 1.0},
+            {'id': 1, 'zone': 1, 'ip': '10.0.0.2', 'device': 'sda',
+             'weight': 1.0},
+            {'id': 2, 'zone': 2, 'ip': '10.0.0.2', 'device': 'sdb',
+             'weight': 2.0},
+            None]
+        self.builder._replica2part2dev = [array('H', [0, 1, 2, 2]),
+                                          array('H', [2, 0, 1, 3])]
+
+    def tearDown(self):
+        self.stats.numpy = self.numpy
+        MiddlewareTestCase.tearDown(self)
+
+    def _check_stats(self):
+        result = self.stats.builder_stats(self.builder)
+        self.assertEquals(result['assigned'], 8)
+        self.assertEquals(result['balance'], 25.0)
+        self.assertEquals([(d['id'], d['parts'], d['parts_wanted'],
+                            d['balance']) for d in result['devices']],
+                          [(0, 2, 2.0, 0.0), (1, 2, 2.0, 0.0),
+                           (2, 3, 4.0, -25.0)])
+        self.assertEquals(result['zones']['2']['balance'], -25.0)
+        self.assertEquals(result['zones']['1']['devices'], 2)
+        self.assertEquals(result['ips']['10.0.0.2']['balance'], -16.67)
+        self.assertEquals(result['dispersion'],
+                          {'zone': {'parts': 1, 'percent': 25.0},
+                           'ip': {'parts': 1, 'percent': 25.0}})
+        self.assertEquals(result['worst'], [2, 0, 1])
+        #a fractional replica count leaves the last replica shorter
+        self.assertEquals(self.stats.shared_parts(
+            [array('H', [0, 1]), array('H', [0])], [0, 1]), 1)
+
+    def test_builder_stats(self):
+        self.stats.numpy = None
+        self._check_stats()
+        if self.numpy is not None:
+            self.stats.numpy = self.numpy
+            self._check_stats()
+
+    def test_numpy_matches_fallback(self):
+        if self.numpy is None:
+            raise SkipTest('numpy is not installed')
+        import random
+        rand = random.Random(42)
+        self.builder.parts = 1024
+        self.builder.replicas = 2.5
+        self.builder.devs = [
+            {'id': i, 'zone': i % 5, 'ip': '10.0.0.%d' % (i % 7),
+             'device': 'sd%d' % i, 'weight': rand.choice([0.0, 1.0, 2.0])}
+            for i in xrange(40)]
+        #partitions still assigned to removed devices
+        self.builder.devs[13] = self.builder.devs[27] = None
+        self.builder._replica2part2dev = [
+            array('H', [rand.randrange(40) for _junk in xrange(parts)])
+            for parts in (1024, 1024, 512)]
+        results = []
+        for numpy in (None, self.numpy):
+            self.stats.numpy = numpy
+            results.append(self.stats.builder_stats(self.builder))
+        self.assertEquals(results[0], results[1])
+
+    def test_not_rebalanced(self):
+        self.builder._replica2part2dev = None
+        result = self.stats.builder_stats(self.builder)
+        self.assertEquals(result['assigned'], 0)
+        self.assertEquals(result['dispersion']['zone']['parts'], 0)
+        self.assertEquals(result['balance'], 0.0)
+
+    def test_stats_endpoint(self):
+        app = self.app
+        app._get_md5sum = MagicMock(return_value='currenthash')
+        builder = RingBuilder(2, 2, 0)
+        builder.devs = self.builder.devs
+        builder._replica2part2dev = self.builder._replica2part2dev
+        app._load_builder = MagicMock(return_value=builder)
+        start_response = MagicMock(return_value="MOCKED")
+        env = {'REQUEST_METHOD': 'GET',
+               'PATH_INFO': '/ringbuilder/object/stats'}
+        result = json.loads(''.join(app.get_or_head(env, start_response)))
+        self.assertEquals(result['worst'], [2, 0, 1])
+        self.assertTrue(('X-Current-Hash', 'currenthash') in
+                        start_response.call_args[0][1])
+        #computed once per version of the builder
+        app.get_or_head(env, start_response)
+        self.assertEquals(app._load_builder.call_count, 1)
+        app._get_md5sum.return_value = 'newhash'
+        app.get_or_head(env, start_response)
+        self.assertEquals(app._load_builder.call_count, 2)
+        env['PATH_INFO'] = '/ring/object/stats'
+        app.get_or_head(env, start_response)
+        self.assertEquals(start_response.call_args[0][0], '400 Bad Request')
+
+
+class TestRebalanceJobs(MiddlewareTestCase):
+
+    def setUp(self):
+        MiddlewareTestCase.setUp(self)
+        with open(self.app.bf_path['object'], 'wb') as f:
+            f.write('somedata')
+        self.lasthash = self.app._get_md5sum(self.app.bf_path['object'])
+        self.app.job_executor.call = MagicMock()
+        self.app._save_rebalance = MagicMock(return_value='newhash')
+
+    def _start_job(self):
+        from eventlet import sleep
+        start_response = MagicMock(return_value="MOCKED")
+        env = {'PATH_INFO': '/ringbuilder/object/rebalance',
+               'QUERY_STRING': 'async=1',
+               'HTTP_X_RING_BUILDER_LAST_HASH': self.lasthash}
+        result = self.app.handle_post('object', 'rebalance', env,
+                                      start_response, '')
+        self.assertEquals(start_response.call_args[0][0], '202 Accepted')
+        job_id = json.loads(result[0])['job']
+        sleep(0)
+        return job_id
+
+    def test_rebalance_job_complete(self):
+        builder = FakedBuilder().create_builder()
+        self.app.job_executor.call.return_value = {
+            'builder': builder.to_dict(), 'reassigned': 3, 'balance': 1.5}
+        job_id = self._start_job()
+        start_response = MagicMock(return_value="MOCKED")
+        result = self.app.get_or_head({'PATH_INFO':
+                                       '/ringbuilder/jobs/%s' % job_id,
+                                       'REQUEST_METHOD': 'GET'},
+                                      start_response)
+        job = json.loads(result[0])
+        self.assertEquals(job['status'], 'complete')
+        self.assertEquals(job['hash'], 'newhash')
+        self.assertEquals(job['reassigned'], 3)
+        self.assertEquals(job['balance'], 1.5)
+        self.assertEquals(self.app._save_rebalance.call_count, 1)
+
+    def test_rebalance_dry_run(self):
+        builder = self.make_builder()
+        self.app._load_builder = MagicMock(return_value=builder)
+        start_response = MagicMock(return_value="MOCKED")
+        env = {'PATH_INFO': '/ringbuilder/object/rebalance',
+               'QUERY_STRING': 'dry_run=1',
+               'HTTP_X_RING_BUILDER_LAST_HASH': self.lasthash}
+        result = json.loads(self.app.handle_post('object', 'rebalance', env,
+                                                 start_response, '')[0])
+        self.assertEquals(start_response.call_args[0][0], '200 OK')
+        self.assertEquals(result['partitions'], 256)
+        self.assertEquals(sum(m['gained'] for m in result['moved'].values()),
+                          256 * 3)
+        #the builder is neither modified nor saved
+        self.assertEquals(builder._replica2part2dev, None)
+        self.assertFalse(self.app._save_rebalance.called)
+        builder.rebalance()
+        builder.add_dev({'id': 4, 'region': 1, 'zone': 4, 'ip': '1.1.1.1',
+                         'port': 6010, 'device': 'sd4', 'weight': 1.0,
+                         'meta': ''})
+        result = json.loads(self.app.handle_post('object', 'rebalance', env,
+                                                 start_response, '')[0])
+        moved = result['moved']
+        self.assertTrue(moved['4']['gained'] > 0)
+        self.assertEquals(moved['4']['lost'], 0)
+        self.assertEquals(sum(m['gained'] for m in moved.values()),
+                          sum(m['lost'] for m in moved.values()))
+        self.assertTrue(result['saveable'])
+        self.assertEquals(result['reason'], None)
+        self.assertFalse(self.app._save_rebalance.called)
+        #rebalances that wouldn't be saved are still previewed
+        builder.rebalance()
+        builder.set_dev_weight(4, 1.01)
+        builder.devs_changed = False
+        result = json.loads(self.app.handle_post('object', 'rebalance', env,
+                                                 start_response, '')[0])
+        self.assertEquals(start_response.call_args[0][0], '200 OK')
+        self.assertFalse(result['saveable'])
+        self.assertTrue(result['reason'].startswith('Refusing to save'))
+        self.assertTrue('moved' in result)
+        self.assertFalse(self.app._save_rebalance.called)
+
+    def test_rebalance_dry_run_writes_nothing(self):
+        builder = self.make_builder()
+        builder_file = self.app.bf_path['object']
+        lasthash = self.write_builder(builder)
+        old = time() - 30
+        os.utime(builder_file, (old, old))
+        #the lock files are created once and kept, take them up front
+        with self.app._lock(builder_file, shared=True):
+            pass
+
+        def _snapshot():
+            return sorted((name, os.stat(os.path.join(self.testdir,
+                                                      name)).st_mtime)
+                          for name in os.listdir(self.testdir))
+
+        before = _snapshot()
+        start_response = MagicMock(return_value="MOCKED")
+        env = {'PATH_INFO': '/ringbuilder/object/rebalance',
+               'QUERY_STRING': 'dry_run=1',
+               'HTTP_X_RING_BUILDER_LAST_HASH': lasthash}
+        result = json.loads(self.app.handle_post('object', 'rebalance', env,
+                                                 start_response, '')[0])
+        self.assertEquals(start_response.call_args[0][0], '200 OK')
+        self.assertTrue(result['saveable'])
+        self.assertEquals(_snapshot(), before)
+
+    def test_rebalance_job_failed(self):
+        self.app.job_executor.call.return_value = {'error':
+                                                   'Refusing to save'}
+        job_id = self._start_job()
+        self.assertEquals(self.app._load_job(job_id)['status'], 'failed')
+        self.assertEquals(self.app._load_job(job_id)['error'],
+                          'Refusing to save')
+        self.assertEquals(self.app.jobs, {})
+        self.assertFalse(self.app._save_rebalance.called)
+        #builder changed while rebalancing
+
+        def _changed_while_waiting(func, builder_file, seed, lasthash):
+            with open(self.app.bf_path['object'], 'wb') as f:
+                f.write('otherdata')
+            return {'builder': {}, 'reassigned': 1, 'balance': 1.0}
+
+        self.app.job_executor.call = _changed_while_waiting
+        job_id = self._start_job()
+        self.assertEquals(self.app._load_job(job_id)['error'],
+                          'Builder md5sum differs')
+        self.assertFalse(self.app._save_rebalance.called)
+
+    def test_rebalance_job_checks_loaded_builder(self):
+        self.lasthash = self.write_builder(self.make_builder())
+        builder_file = self.app.bf_path['object']
+        with open(builder_file, 'rb') as f:
+            original = f.read()
+        self.app.job_executor.call = lambda func, *args: func(*args)
+        job_id = self._start_job()
+        self.assertEquals(self.app._load_job(job_id)['status'], 'complete')
+        self.assertEquals(self.app._save_rebalance.call_count, 1)
+        #the builder was changed when the worker loaded it and changed back
+        #by the time the result was saved
+        self.app._save_rebalance.reset_mock()
+
+        def _changed_while_queued(func, *args):
+            self.write_builder(self.make_builder(devices=5))
+            try:
+                return func(*args)
+            finally:
+                with open(builder_file, 'wb') as f:
+                    f.write(original)
+
+        self.app.job_executor.call = _changed_while_queued
+        job_id = self._start_job()
+        self.assertEquals(self.app._get_md5sum(builder_file), self.lasthash)
+        self.assertEquals(self.app._load_job(job_id)['status'], 'failed')
+        self.assertEquals(self.app._load_job(job_id)['error'],
+                          'Builder md5sum differs')
+        self.assertFalse(self.app._save_rebalance.called)
+
+    def test_rebalance_attempts(self):
+        from eventlet import sleep
+        builder = FakedBuilder().create_builder()
+        results = {}
+
+        def _attempt(func, builder_file, seed, lasthash):
+            results[seed] = [{'error': 'Refusing to save'},
+                             {'builder': builder.to_dict(), 'reassigned': 9,
+                              'balance': 1.5},
+                             {'builder': builder.to_dict(), 'reassigned': 5,
+                              'balance': 1.5},
+                             {'builder': builder.to_dict(), 'reassigned': 1,
+                              'balance': 2.5}][len(results)]
+            return results[seed]
+
+        self.app.job_executor.call = _attempt
+        start_response = MagicMock(return_value="MOCKED")
+        env = {'PATH_INFO': '/ringbuilder/object/rebalance',
+               'QUERY_STRING': 'attempts=4',
+               'HTTP_X_RING_BUILDER_LAST_HASH': self.lasthash}
+        result = json.loads(self.app.handle_post('object', 'rebalance', env,
+                                                 start_response, '')[0])
+        self.assertEquals(len(results), 4)
+        self.assertEquals(result['balance'], 1.5)
+        self.assertEquals(result['reassigned'], 5)
+        self.assertEquals(self.app._save_rebalance.call_args[0][2:], (5, 1.5))
+        #attempts run in the background too
+        results.clear()
+        env['QUERY_STRING'] = 'attempts=4&async=1'
+        self.app.handle_post('object', 'rebalance', env, start_response, '')
+        job, = self.app.jobs.values()
+        for _junk in xrange(10):
+            sleep(0)
+        job = self.app._load_job(job['id'])
+        self.assertEquals(job['status'], 'complete')
+        self.assertEquals(job['attempts'], 4)
+        self.assertEquals(job['reassigned'], 5)
+        #all attempts failed
+        self.app.job_executor.call = MagicMock(
+            return_value={'error': 'Refusing to save'})
+        env['QUERY_STRING'] = 'attempts=2'
+        self.app.handle_post('object', 'rebalance', env, start_response, '')
+        self.assertEquals(start_response.call_args[0][0], '400 Bad Request')
+        self.assertEquals(self.app.job_executor.call.call_count, 2)
+        for bad in ('attempts=0', 'attempts=9', 'attempts=x'):
+            env['QUERY_STRING'] = bad
+            self.app.handle_post('object', 'rebalance', env, start_response,
+                                 '')
+            self.assertEquals(start_response.call_args[0][0],
+                              '400 Bad Request')
+        self.assertEquals(self.app.job_executor.call.call_count, 2)
+
+    def test_seeded_rebalance_restores_random_state(self):
+        import random
+        from rbm import ring_builder
+        builder = self.make_builder()
+        builder_file = self.app.bf_path['object']
+        self.write_builder(builder)
+        random.seed(1)
+        expected = random.random()
+        random.seed(1)
+        results = [ring_builder.rebalance_builder_file(builder_file, 5)
+                   for _junk in xrange(2)]
+        #the worker carries on as if the seeded rebalances never happened
+        self.assertEquals(random.random(), expected)
+        #and the same seed gives the same rebalance
+        self.assertEquals(results[0]['builder']['_replica2part2dev'],
+                          results[1]['builder']['_replica2part2dev'])
+
+    def test_rebalance_all(self):
+        from eventlet import sleep
+        builder = FakedBuilder().create_builder()
+        hashes = {'object': self.lasthash}
+        for builder_type in ('account', 'container'):
+            with open(self.app.bf_path[builder_type], 'wb') as f:
+                f.write('%sdata' % builder_type)
+            hashes[builder_type] = self.app._get_md5sum(
+                self.app.bf_path[builder_type])
+        running = []
+        concurrency = []
+
+        def _rebalance(func, builder_file, seed, lasthash):
+            running.append(builder_file)
+            sleep(0)
+            concurrency.append(len(running))
+            running.remove(builder_file)
+            if builder_file == self.app.bf_path['container']:
+                return {'error': 'Refusing to save'}
+            return {'builder': builder.to_dict(), 'reassigned': 3,
+                    'balance': 1.5}
+
+        self.app.job_executor.call = _rebalance
+        start_response = MagicMock(return_value="MOCKED")
+        env = {'PATH_INFO': '/ringbuilder/all/rebalance',
+               'CONTENT_TYPE': 'application/json'}
+        result = self.app.post(env, start_response,
+                               json.dumps({'hashes': hashes}))
+        self.assertEquals(start_response.call_args[0][0], '200 OK')
+        result = json.loads(result[0])
+        self.assertEquals(result['object'], {'reassigned': 3,
+                                             'balance': 1.5,
+                                             'partitions': builder.parts,
+                                             'hash': 'newhash'})
+        self.assertEquals(result['account']['hash'], 'newhash')
+        self.assertEquals(result['container'],
+                          {'error': 'Refusing to save'})
+        #the builders are rebalanced at the same time
+        self.assertEquals(max(concurrency), 3)
+        self.assertEquals(self.app._save_rebalance.call_count, 2)
+        #a single outdated hash fails the whole request
+        hashes['account'] = 'wronghash'
+        self.app.post(env, start_response, json.dumps({'hashes': hashes}))
+        self.assertEquals(start_response.call_args[0][0], '409 Conflict')
+        self.assertEquals(self.app._save_rebalance.call_count, 2)
+        for body in ({}, {'hashes': {'bogus': 'x'}}, {'hashes': []}, []):
+            self.app.post(env, start_response, json.dumps(body))
+            self.assertEquals(start_response.call_args[0][0],
+                              '400 Bad Request')
+        for path in ('/ringbuilder/all/add', '/ringbuilder/all/rebalance'):
+            self.app.post({'PATH_INFO': path,
+                           'QUERY_STRING': 'dry_run=1',
+                           'CONTENT_TYPE': 'application/json'},
+                          start_response, json.dumps({'hashes': hashes}))
+            self.assertEquals(start_response.call_args[0][0],
+                              '400 Bad Request')
+        self.assertEquals(self.app._save_rebalance.call_count, 2)
+
+    def test_rebalance_all_unexpected_error(self):
+        from eventlet import sleep
+        builder = FakedBuilder().create_builder()
+        hashes = {'object': self.lasthash}
+        with open(self.app.bf_path['account'], 'wb') as f:
+            f.write('accountdata')
+        hashes['account'] = self.app._get_md5sum(self.app.bf_path['account'])
+        saved = []
+
+        def _rebalance(func, builder_file, seed, lasthash):
+            sleep(0)
+            return {'builder': builder.to_dict(), 'reassigned': 3,
+                    'balance': 1.5}
+
+        def _save(builder_type, builder, parts, balance):
+            if builder_type == 'account':
+                raise IOError(28, 'No space left on device')
+            #the sibling is still saved while its builder is locked
+            sleep(0.01)
+            try:
+                with self.app._lock(self.app.bf_path[builder_type],
+                                    timeout=0):
+                    self.fail('builder not locked')
+            except LockTimeout:
+                pass
+            saved.append(builder_type)
+            return 'newhash'
+
+        self.app.job_executor.call = _rebalance
+        self.app._save_rebalance = _save
+        start_response = MagicMock(return_value="MOCKED")
+        env = {'PATH_INFO': '/ringbuilder/all/rebalance',
+               'CONTENT_TYPE': 'application/json'}
+        result = self.app.post(env, start_response,
+                               json.dumps({'hashes': hashes}))
+        self.assertEquals(start_response.call_args[0][0], '200 OK')
+        result = json.loads(result[0])
+        self.assertEquals(result['object']['hash'], 'newhash')
+        self.assertTrue('No space left' in result['account']['error'])
+        self.assertEquals(saved, ['object'])
+        #and the locks are released once all of them are done
+        with self.app._lock(self.app.bf_path['object'], timeout=0):
+            pass
+
+    def test_rebalance_all_queues_listed_types(self):
+        app = self.make_app(mutation_queue='true')
+        busy = []
+
+        def _handle_post(builder_type, target, env, start_response, body):
+            busy.extend(sorted(queued for queued, queue
+                               in app.mutation_queues.iteritems()
+                               if queue.busy))
+            return start_response('200 OK', [])
+
+        app.handle_post = _handle_post
+        start_response = MagicMock(return_value="MOCKED")
+        app.post({'PATH_INFO': '/ringbuilder/all/rebalance',
+                  'CONTENT_TYPE': 'application/json'}, start_response,
+                 json.dumps({'hashes': {'object': self.lasthash,
+                                        'account': 'x'}}))
+        self.assertEquals(busy, ['account', 'object'])
+
+    def test_too_many_jobs(self):
+        self.app.job_executor.pending = 1000
+        start_response = MagicMock(return_value="MOCKED")
+        result = self.app.post({'PATH_INFO': '/ringbuilder/object/rebalance',
+                                'QUERY_STRING': 'async=1',
+                                'HTTP_X_RING_BUILDER_LAST_HASH':
+                                self.lasthash}, start_response, '')
+        self.assertEquals(start_response.call_args[0][0],
+                          '503 Service Unavailable')
+        self.assertEquals(self.app.jobs, {})
+        #a worker only runs so many unfinished jobs itself
+        self.app.job_executor.pending = 0
+        self.app.max_jobs = 1
+        self.app.jobs['x' * 32] = {'status': 'running'}
+        self.app.post({'PATH_INFO': '/ringbuilder/object/rebalance',
+                       'QUERY_STRING': 'async=1',
+                       'HTTP_X_RING_BUILDER_LAST_HASH': self.lasthash},
+                      start_response, '')
+        self.assertEquals(start_response.call_args[0][0],
+                          '503 Service Unavailable')
+        self.assertEquals(len(self.app.jobs), 1)
+
+    def test_job_status_from_other_worker(self):
+        self.app.job_executor.call.return_value = {'error':
+                                                   'Refusing to save'}
+        job_id = self._start_job()
+        other = self.make_app()
+        start_response = MagicMock(return_value="MOCKED")
+        result = other.get_or_head({'PATH_INFO':
+                                    '/ringbuilder/jobs/%s' % job_id,
+                                    'REQUEST_METHOD': 'GET'},
+                                   start_response)
+        self.assertEquals(start_response.call_args[0][0], '200 OK')
+        self.assertEquals(json.loads(result[0])['error'], 'Refusing to save')
+
+    def test_finished_jobs_pruned(self):
+        self.app.job_executor.call.return_value = {'error':
+                                                   'Refusing to save'}
+        self.app.max_jobs = 2
+        job_ids = [self._start_job() for _junk in xrange(4)]
+        self.assertEquals(sorted(os.listdir(self.app.jobs_dir)),
+                          sorted('%s.json' % j for j in job_ids[-2:]))
+
+    def test_unknown_job(self):
+        start_response = MagicMock(return_value="MOCKED")
+        for job_id in ('nope', '../object.builder', 'a' * 32):
+            self.app.get_or_head({'PATH_INFO': '/ringbuilder/jobs/%s' % job_id,
+                                  'REQUEST_METHOD': 'GET'}, start_response)
+            self.assertEquals(start_response.call_args[0][0],
+                              '404 Not Found')
+
+
+# runs an asynchronous rebalance job with process workers in a process that's
+# monkey patched like swift's wsgi server, printing the job status and how
+# often a greenthread got to run meanwhile
+PATCHED_JOB_SCRIPT = """
+import json
+import signal
+import sys
+signal.alarm(60)
+import eventlet.patcher
+eventlet.patcher.monkey_patch(all=False, socket=True, select=True,
+                              thread=True)
+from mock import MagicMock
+from swift.common.ring import RingBuilder
+from rbm.middleware import RingBuilderMiddleware, dump_builder
+
+app = RingBuilderMiddleware(None, {'key': 'a', 'swift_dir': sys.argv[1],
+                                   'rebalance_workers': 2})
+builder = RingBuilder(8, 3, 0)
+for i in xrange(4):
+    builder.add_dev({'id': i, 'region': 1, 'zone': i, 'ip': '1.1.1.1',
+                     'port': 6010, 'device': 'sd%d' % i, 'weight': 1.0,
+                     'meta': ''})
+lasthash = dump_builder(builder.to_dict(), app.bf_path['object'])
+ticks = []
+
+
+def tick():
+    while True:
+        ticks.append(1)
+        eventlet.sleep(0.01)
+
+eventlet.spawn_n(tick)
+env = {'PATH_INFO': '/ringbuilder/object/rebalance',
+       'QUERY_STRING': 'async=1&attempts=2',
+       'HTTP_X_RING_BUILDER_LAST_HASH': lasthash}
+result = app.handle_post('object', 'rebalance', env, MagicMock(), '')
+job_id = json.loads(result[0])['job']
+with eventlet.Timeout(30):
+    while app._load_job(job_id)['status'] in ('queued', 'running',
+                                              'saving'):
+        eventlet.sleep(0.05)
+print json.dumps({'status': app._load_job(job_id)['status'],
+                  'ticks': len(ticks)})
+"""
+
+
+class TestExecutor(unittest.TestCase):
+
+    def test_modes(self):
+        from rbm.executor import Executor
+        self.assertEquals(Executor('inline').call(max, 1, 2), 2)
+        self.assertEquals(Executor('tpool').call(max, 1, 2), 2)
+        self.assertEquals(Executor('process').call(max, 1, 2), 2)
+        self.assertRaises(ValueError, Executor, 'nope')
+
+    def test_process_errors(self):
+        from rbm.executor import Executor, ExecutorError
+        executor = Executor('process')
+        self.assertRaises(ValueError, executor.call, int, 'nope')
+        #results that can't be pickled fail the call rather than the worker
+        self.assertRaises(ExecutorError, executor.call, iter, [])
+
+    def test_process_jobs_with_patched_threads(self):
+        import subprocess
+        import sys
+        testdir = tempfile.mkdtemp()
+        try:
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+            proc = subprocess.Popen([sys.executable, '-c',
+                                     PATCHED_JOB_SCRIPT, testdir],
+                                    stdout=subprocess.PIPE, env=env)
+            out = proc.communicate()[0]
+        finally:
+            shutil.rmtree(testdir)
+        self.assertEquals(proc.returncode, 0)
+        result = json.loads(out.splitlines()[-1])
+        self.assertEquals(result['status'], 'complete')
+        #the hub kept running while the workers rebalanced
+        self.assertTrue(result['ticks'] > 0)
+
+    def test_busy(self):
+        from rbm.executor import Executor, ExecutorBusy
+        executor = Executor('tpool', pool_size=1, queue_size=1)
+        executor.pending = 2
+        self.assertTrue(executor.busy)
+        self.assertRaises(ExecutorBusy, executor.call, max, 1, 2)
+        executor.pending = 1
+        self.assertEquals(executor.call(max, 1, 2), 2)
+        self.assertEquals(executor.pending, 1)
+
+
+class TestMutationQueue(unittest.TestCase):
+
+    def test_fifo(self):
+        from eventlet import spawn, sleep
+        from rbm.executor import MutationQueue
+        queue = MutationQueue(depth=5, timeout=5)
+        order = []
+
+        def mutate(i):
+            with queue.turn():
+                order.append(('start', i))
+                sleep(0.01)
+                order.append(('end', i))
+
+        threads = [spawn(mutate, i) for i in xrange(4)]
+        for thread in threads:
+            thread.wait()
+        self.assertEquals(order, [(e, i) for i in xrange(4)
+                                  for e in ('start', 'end')])
+        self.assertFalse(queue.busy)
+
+    def test_full_and_timeout(self):
+        from eventlet import spawn, sleep
+        from rbm.executor import MutationQueue, QueueFull, QueueTimeout
+        queue = MutationQueue(depth=1, timeout=0.05)
+        results = []
+
+        def mutate(hold):
+            try:
+                with queue.turn():
+                    sleep(hold)
+                    results.append('ok')
+            except (QueueFull, QueueTimeout), err:
+                results.append(err.__class__.__name__)
+
+        first = spawn(mutate, 0.2)
+        sleep(0)
+        second = spawn(mutate, 0)
+        sleep(0)
+        third = spawn(mutate, 0)
+        for thread in (first, second, third):
+            thread.wait()
+        self.assertEquals(results, ['QueueFull', 'QueueTimeout', 'ok'])
+        self.assertFalse(queue.waiters)
+        self.assertFalse(queue.busy)
+        #still usable afterwards
+        mutate(0)
+        self.assertEquals(results[-1], 'ok')
+
+    def test_rebase(self):
+        from eventlet import spawn, sleep
+        from rbm.executor import MutationQueue
+        queue = MutationQueue(depth=5, timeout=5)
+        rebased = []
+
+        def mutate(version, new):
+            with queue.turn() as since:
+                sleep(0.01)
+                version = queue.rebase(version, since)
+                rebased.append(version)
+                queue.changed(version, new)
+
+        threads = [spawn(mutate, 'a', 'b'), spawn(mutate, 'a', 'c'),
+                   spawn(mutate, 'x', 'y'), spawn(mutate, 'b', 'd')]
+        for thread in threads:
+            thread.wait()
+        #changes unrelated to the expected version are skipped
+        self.assertEquals(rebased, ['a', 'b', 'x', 'c'])
+        #once nobody waits the changes are forgotten
+        self.assertEquals(queue.changes, [])
+        with queue.turn() as since:
+            self.assertEquals(queue.rebase('a', since), 'a')
+
+    def test_queued_writers_with_same_hash(self):
+        from eventlet import GreenPile, sleep
+        from rbm import ring_builder
+        testdir = tempfile.mkdtemp()
+        try:
+            app = ring_builder.RingBuilderMiddleware(
+                FakeApp(), {'key': 'a', 'swift_dir': testdir,
+                            'backup_dir': os.path.join(testdir, 'backups'),
+                            'executor': 'inline', 'mutation_queue': 'true'})
+            lasthash = ring_builder.dump_builder(
+                FakedBuilder().create_builder().to_dict(),
+                app.bf_path['object'])
+            handle_post = app.handle_post
+
+            def _slow_handle_post(*args):
+                sleep(0.01)
+                return handle_post(*args)
+
+            app.handle_post = _slow_handle_post
+
+            def _set_weight(dev_id, weight, lasthash):
+                start_response = MagicMock(return_value="MOCKED")
+                app.post({'PATH_INFO': '/ringbuilder/object/weight',
+                          'CONTENT_TYPE': 'application/json',
+                          'HTTP_X_RING_BUILDER_LAST_HASH': lasthash},
+                         start_response,
+                         json.dumps({'devices': {dev_id: weight}}))
+                return start_response.call_args[0][0]
+
+            pile = GreenPile()
+            pile.spawn(_set_weight, '1', 5.0, lasthash)
+            pile.spawn(_set_weight, '2', 6.0, lasthash)
+            #both were sent for the same builder, the second is applied
+            #to the builder as changed by the first
+            self.assertEquals(list(pile), ['200 OK', '200 OK'])
+            builder = RingBuilder.load(app.bf_path['object'])
+            self.assertEquals([dev['weight'] for dev in builder.devs],
+                              [1.0, 5.0, 6.0, 1.0, 1.0])
+            #requests that didn't wait behind the change still conflict
+            self.assertEquals(_set_weight('3', 7.0, lasthash),
+                              '409 Conflict')
+        finally:
+            shutil.rmtree(testdir)
+
+    def test_post_queued(self):
+        from rbm import ring_builder
+        from rbm.executor import QueueFull
+        app = ring_builder.RingBuilderMiddleware(
+            FakeApp(), {'key': 'a', 'mutation_queue': 'true'})
+        app.handle_post = MagicMock(
+            side_effect=lambda bt, t, e, sr, b: sr('200 OK', []))
+        start_response = MagicMock(return_value="MOCKED")
+        env = {'PATH_INFO': '/ringbuilder/object/weight'}
+        app.post(env, start_response, '{}')
+        status, headers = start_response.call_args[0]
+        self.assertEquals(headers[0][0], 'X-Queue-Wait')
+        #reads aren't queued
+        env = {'PATH_INFO': '/ringbuilder/object/search'}
+        app.post(env, start_response, '{}')
+        self.assertEquals(start_response.call_args[0][1], [])
+        app.mutation_queues['object'].turn = MagicMock(
+            side_effect=QueueFull)
+        env = {'PATH_INFO': '/ringbuilder/object/weight'}
+        app.post(env, start_response, '{}')
+        self.assertEquals(start_response.call_args[0][0],
+                          '503 Service Unavailable')
+
+
+class TestStaticFiles(MiddlewareTestCase):
+
+    conf = {'static_chunk_size': '7'}
+
+    def setUp(self):
+        MiddlewareTestCase.setUp(self)
+        self.target = self.app.rf_path['object']
+        self.data = ''.join(chr(i % 256) for i in xrange(100))
+        with open(self.target, 'wb') as f:
+            f.write(self.data)
+
+    def test_file_iterable(self):
+        from rbm.ring_builder import FileIterable
+        chunks = list(FileIterable(open(self.target, 'rb'), 7))
+        self.assertEquals(len(chunks), 15)
+        self.assertEquals(''.join(chunks), self.data)
+        with open(self.target, 'wb') as f:
+            pass
+        self.assertEquals(list(FileIterable(open(self.target, 'rb'), 7)), [])
+
+    def test_file_replaced_while_serving(self):
+        from rbm.ring_builder import FileIterator
+        fi = FileIterator(open(self.target, 'rb'), 7)
+        first = fi.next()
+        with open(self.target + '.new', 'wb') as f:
+            f.write('replaced')
+        os.rename(self.target + '.new', self.target)
+        self.assertEquals(first + ''.join(fi), self.data)
+
+    def test_file_truncated_while_serving(self):
+        from rbm.ring_builder import FileIterator
+        fi = FileIterator(open(self.target, 'rb', 0), 7)
+        first = fi.next()
+        with open(self.target, 'r+b') as f:
+            f.truncate(10)
+        self.assertEquals(first + ''.join(fi), self.data[:10])
+        fi = FileIterator(open(self.target, 'rb'), 7, 3, 9)
+        self.assertEquals(list(fi), [self.data[3:9]])
+
+    def test_return_static_file(self):
+        start_response = MagicMock(return_value="MOCKED")
+        result = self.app.return_static_file(self.target, start_response, {})
+        self.assertEquals(''.join(result), self.data)
+        filehash = self.app._get_md5sum(self.target)
+        mtime = os.stat(self.target).st_mtime
+        start_response.assert_called_once_with(
+            '200 OK', [('Content-Length', '100'),
+                       ('X-Current-Hash', filehash),
+                       ('Content-Type', 'application/octet-stream'),
+                       ('ETag', '"%s"' % filehash),
+                       ('Last-Modified', formatdate(mtime, usegmt=True)),
+                       ('Accept-Ranges', 'bytes')])
+        #servers file_wrapper is preferred
+        file_wrapper = MagicMock(return_value="WRAPPED")
+        result = self.app.return_static_file(self.target, start_response,
+                                             {'wsgi.file_wrapper':
+                                              file_wrapper})
+        self.assertEquals(result, "WRAPPED")
+        self.assertEquals(file_wrapper.call_args[0][1], 7)
+
+    def test_conditional_get(self):
+        filehash = self.app._get_md5sum(self.target)
+        mtime = os.stat(self.target).st_mtime
+        start_response = MagicMock(return_value="MOCKED")
+        env = {'HTTP_IF_NONE_MATCH': '"%s"' % filehash}
+        result = self.app.return_static_file(self.target, start_response, env)
+        self.assertEquals(result, [])
+        self.assertEquals(start_response.call_args[0][0], '304 Not Modified')
+        self.assertTrue(('ETag', '"%s"' % filehash) in
+                        start_response.call_args[0][1])
+        #etag mismatch wins over if-modified-since
+        env = {'HTTP_IF_NONE_MATCH': '"nope", W/"other"',
+               'HTTP_IF_MODIFIED_SINCE': formatdate(mtime + 60, usegmt=True)}
+        result = self.app.return_static_file(self.target, start_response, env)
+        self.assertEquals(start_response.call_args[0][0], '200 OK')
+        self.assertEquals(''.join(result), self.data)
+        env = {'HTTP_IF_MODIFIED_SINCE': formatdate(mtime + 60, usegmt=True)}
+        self.app.return_static_file(self.target, start_response, env)
+        self.assertEquals(start_response.call_args[0][0], '304 Not Modified')
+        env = {'HTTP_IF_MODIFIED_SINCE': formatdate(mtime - 60, usegmt=True)}
+        self.app.return_static_file(self.target, start_response, env)
+        self.assertEquals(start_response.call_args[0][0], '200 OK')
+
+    def test_range_get(self):
+        filehash = self.app._get_md5sum(self.target)
+        start_response = MagicMock(return_value="MOCKED")
+        env = {'HTTP_RANGE': 'bytes=10-19'}
+        result = self.app.return_static_file(self.target, start_response, env)
+        self.assertEquals(''.join(result), self.data[10:20])
+        status, headers = start_response.call_args[0]
+        self.assertEquals(status, '206 Partial Content')
+        self.assertTrue(('Content-Range', 'bytes 10-19/100') in headers)
+        self.assertTrue(('Content-Length', '10') in headers)
+        #suffix and open ended ranges
+        env = {'HTTP_RANGE': 'bytes=-5'}
+        result = self.app.return_static_file(self.target, start_response, env)
+        self.assertEquals(''.join(result), self.data[-5:])
+        env = {'HTTP_RANGE': 'bytes=95-'}
+        result = self.app.return_static_file(self.target, start_response, env)
+        self.assertEquals(''.join(result), self.data[95:])
+        #unsatisfiable
+        env = {'HTTP_RANGE': 'bytes=100-'}
+        result = self.app.return_static_file(self.target, start_response, env)
+        status, headers = start_response.call_args[0]
+        self.assertEquals(status, '416 Requested Range Not Satisfiable')
+        self.assertTrue(('Content-Range', 'bytes */100') in headers)
+        #malformed ranges and stale if-range are ignored
+        for env in ({'HTTP_RANGE': 'bytes=5-1'}, {'HTTP_RANGE': 'lines=1-2'},
+                    {'HTTP_RANGE': 'bytes=1-2', 'HTTP_IF_RANGE': '"nope"'}):
+            result = self.app.return_static_file(self.target, start_response,
+                                                 env)
+            self.assertEquals(start_response.call_args[0][0], '200 OK')
+            self.assertEquals(''.join(result), self.data)
+        env = {'HTTP_RANGE': 'bytes=1-2', 'HTTP_IF_RANGE': '"%s"' % filehash}
+        result = self.app.return_static_file(self.target, start_response, env)
+        self.assertEquals(''.join(result), self.data[1:3])
+
+    def test_multi_range_get(self):
+        start_response = MagicMock(return_value="MOCKED")
+        env = {'HTTP_RANGE': 'bytes=0-2,50-59,-3'}
+        result = self.app.return_static_file(self.target, start_response, env)
+        body = ''.join(result)
+        status, headers = start_response.call_args[0]
+        headers = dict(headers)
+        self.assertEquals(status, '206 Partial Content')
+        self.assertEquals(int(headers['Content-Length']), len(body))
+        boundary = headers['Content-Type'].split('boundary=')[1]
+        parts = body.split('--%s' % boundary)
+        self.assertEquals(parts[0], '')
+        self.assertEquals(parts[-1], '--\r\n')
+        expected = [('0-2', self.data[0:3]), ('50-59', self.data[50:60]),
+                    ('97-99', self.data[97:])]
+        for part, (byte_range, data) in zip(parts[1:-1], expected):
+            part_headers, part_body = part.split('\r\n\r\n', 1)
+            self.assertTrue('Content-Range: bytes %s/100' % byte_range in
+                            part_headers)
+            self.assertEquals(part_body, data + '\r\n')
+
+    def test_conditional_head(self):
+        filehash = self.app._get_md5sum(self.target)
+        start_response = MagicMock(return_value="MOCKED")
+        env = {'HTTP_IF_NONE_MATCH': '*'}
+        self.app.handle_head(self.target, start_response, env)
+        self.assertEquals(start_response.call_args[0][0], '304 Not Modified')
+        env = {'HTTP_IF_NONE_MATCH': '"nope"'}
+        self.app.handle_head(self.target, start_response, env)
+        self.assertEquals(start_response.call_args[0][0], '200 OK')
+        self.assertEquals(start_response.call_args[0][1][:2],
+                          [('X-Current-Hash', filehash),
+                           ('ETag', '"%s"' % filehash)])
+
+
+class TestRingDelta(MiddlewareTestCase):
+
+    def setUp(self):
+        MiddlewareTestCase.setUp(self)
+        devs = [{'id': 0, 'zone': 0, 'ip': '1.1.1.1', 'port': 6010,
+                 'device': 'sda', 'weight': 1.0, 'meta': ''},
+                {'id': 1, 'zone': 1, 'ip': '1.1.1.2', 'port': 6010,
+                 'device': 'sda', 'weight': 1.0, 'meta': ''}]
+        self.old = RingData([array('H', [0, 1, 0, 1]),
+                             array('H', [1, 0, 1, 0])], devs, 30)
+        new_devs = [dict(devs[0], weight=2.0), devs[1],
+                    {'id': 2, 'zone': 2, 'ip': '1.1.1.3', 'port': 6010,
+                     'device': 'sda', 'weight': 1.0, 'meta': ''}]
+        self.new = RingData([array('H', [0, 1, 2, 1]),
+                             array('H', [1, 2, 1, 0]),
+                             array('H', [2, 0, 0, 2])], new_devs, 30)
+
+    def test_make_and_apply_delta(self):
+        from rbm.delta import make_ring_delta, apply_ring_delta, \
+            ring_digest, dump_delta, load_delta
+        delta = load_delta(dump_delta(make_ring_delta(self.old, self.new)))
+        self.assertEquals(delta['replicas'][0]['parts'], [2])
+        self.assertEquals(delta['replicas'][0]['devs'], [2])
+        self.assertEquals(sorted(delta['devs'].keys()), ['0', '2'])
+        result = apply_ring_delta(self.old, delta)
+        self.assertEquals(ring_digest(result), ring_digest(self.new))
+        self.assertEquals(result.devs, self.new.devs)
+        self.assertEquals([list(r) for r in result._replica2part2dev_id],
+                          [list(r) for r in self.new._replica2part2dev_id])
+        #applying to the wrong ring is detected
+        other = RingData([array('H', [1, 1, 1, 1]),
+                          array('H', [0, 0, 0, 0])], self.old.devs, 30)
+        self.assertRaises(Exception, apply_ring_delta, other, delta)
+
+    def test_ring_delta_endpoint(self):
+        from rbm.delta import load_delta, apply_ring_delta, ring_digest
+        self.old.save(self.app.rf_path['object'])
+        old_hash = self.app.backups.store(self.app.rf_path['object'])
+        self.new.save(self.app.rf_path['object'])
+        current_hash = self.app._get_md5sum(self.app.rf_path['object'])
+        start_response = MagicMock(return_value="MOCKED")
+        env = {'PATH_INFO': '/ring/object/delta',
+               'QUERY_STRING': 'from=%s' % old_hash, 'REQUEST_METHOD': 'GET'}
+        result = self.app.get_or_head(env, start_response)
+        self.assertEquals(start_response.call_args[0][0], '200 OK')
+        self.assertTrue(('X-Current-Hash', current_hash) in
+                        start_response.call_args[0][1])
+        delta = load_delta(''.join(result))
+        self.assertEquals(delta['from'], old_hash)
+        self.assertEquals(delta['to'], current_hash)
+        self.assertEquals(ring_digest(apply_ring_delta(self.old, delta)),
+                          ring_digest(self.new))
+        #up to date
+        env['QUERY_STRING'] = 'from=%s' % current_hash
+        self.app.get_or_head(env, start_response)
+        self.assertEquals(start_response.call_args[0][0], '304 Not Modified')
+        #unknown version
+        env['QUERY_STRING'] = 'from=nope'
+        self.app.get_or_head(env, start_response)
+        self.assertEquals(start_response.call_args[0][0], '404 Not Found')
+        env['QUERY_STRING'] = ''
+        self.app.get_or_head(env, start_response)
+        self.assertEquals(start_response.call_args[0][0], '400 Bad Request')
+
+
+class TestBackupStore(MiddlewareTestCase):
+
+    def setUp(self):
+        MiddlewareTestCase.setUp(self)
+        self.store = self.app.backups
+        self.source = self.app.bf_path['object']
+        with open(self.source, 'wb') as fp:
+            fp.write('version one')
+
+    def test_store_dedupes(self):
+        from hashlib import md5
+        digest = self.store.store(self.source)
+        self.assertEquals(digest, md5('version one').hexdigest())
+        path = self.store.find(digest)
+        self.assertEquals(path, os.path.join(self.testdir, 'backups',
+                                             'objects', digest[:2], digest))
+        #never hardlinked to the source
+        self.assertNotEquals(os.stat(path).st_ino,
+                             os.stat(self.source).st_ino)
+        self.assertEquals(self.store.store(self.source, digest), digest)
+        objects = os.listdir(os.path.join(self.testdir, 'backups', 'objects',
+                                          digest[:2]))
+        self.assertEquals(objects, [digest])
+        entries = self.store.entries()
+        self.assertEquals([(e['name'], e['digest']) for e in entries],
+                          [('object.builder', digest)] * 2)
+        self.assertEquals(entries[0]['size'], len('version one'))
+        self.assertEquals(self.store.open(digest).read(), 'version one')
+        self.assertEquals(self.store.find('0' * 32), None)
+        self.assertEquals(self.store.find('../manifest'), None)
+        self.assertRaises(IOError, self.store.open, '0' * 32)
+
+    def test_store_copies_if_reflink_fails(self):
+        from rbm import backup
+        real_ioctl = backup.ioctl
+        backup.ioctl = MagicMock(side_effect=IOError(errno.EOPNOTSUPP,
+                                                     'not supported'))
+        try:
+            digest = self.store.store(self.source)
+        finally:
+            backup.ioctl = real_ioctl
+        self.assertEquals(self.store.open(digest).read(), 'version one')
+        self.assertFalse([f for f in os.listdir(self.store.objects_dir)
+                          if f.startswith('.tmp')])
+
+    def test_source_rewritten_in_place(self):
+        digest = self.store.store(self.source)
+        #what swift-ring-builder does when it saves a builder
+        with open(self.source, 'r+b') as fp:
+            fp.write('version two, longer')
+        with open(self.source, 'r+b') as fp:
+            fp.truncate(3)
+        self.assertEquals(self.store.open(digest).read(), 'version one')
+
+    def test_store_compressed(self):
+        from hashlib import md5
+        from rbm.backup import BackupStore
+        store = BackupStore(os.path.join(self.testdir, 'backups'),
+                            compress=True)
+        digest = store.store(self.source)
+        self.assertEquals(digest, md5('version one').hexdigest())
+        self.assertTrue(store.find(digest).endswith('.gz'))
+        self.assertEquals(store.open(digest).read(), 'version one')
+        #already gzipped files are stored as is
+        ring = os.path.join(self.testdir, 'object.ring.gz')
+        RingData([array('H', [0])], [], 30).save(ring)
+        digest = store.store(ring)
+        self.assertFalse(store.find(digest).endswith('.gz'))
+
+    def test_retained(self):
+        from rbm.backup import BackupStore
+        now = 100 * 86400
+        entries = []
+        #one backup every 20 minutes for the last 5 days, of two files
+        for i in xrange(5 * 72, 0, -1):
+            for name in ('object.builder', 'object.ring.gz'):
+                entries.append({'time': now - i * 1200, 'name': name,
+                                'digest': '%s%d' % (name, i), 'size': 10})
+        store = BackupStore(self.testdir, keep_last=5, keep_hourly=0,
+                            keep_daily=0)
+        kept = store.retained(entries, now)
+        self.assertEquals(len(kept), 10)
+        self.assertEquals(kept[-2:], entries[-2:])
+        store = BackupStore(self.testdir, keep_last=1, keep_hourly=6,
+                            keep_daily=0)
+        self.assertEquals(len(store.retained(entries, now)), 12)
+        store = BackupStore(self.testdir, keep_last=1, keep_hourly=6,
+                            keep_daily=3)
+        #three days, but today's last backup is also this hours last backup
+        self.assertEquals(len(store.retained(entries, now)), 12 + 4)
+        #the latest backups are kept regardless of max_size
+        store = BackupStore(self.testdir, keep_last=5, keep_hourly=0,
+                            keep_daily=0, max_size=45)
+        kept = store.retained(entries, now)
+        self.assertEquals(kept, entries[-4:])
+        store = BackupStore(self.testdir, keep_last=5, keep_hourly=0,
+                            keep_daily=0, max_size=1)
+        self.assertEquals(store.retained(entries, now), entries[-2:])
+
+    def test_prune(self):
+        from rbm.backup import BackupStore
+        store = BackupStore(os.path.join(self.testdir, 'backups'),
+                            keep_last=1, keep_hourly=0, keep_daily=0)
+        self.assertEquals(store.prune(), (0, 0))
+        digests = []
+        for version in ('one', 'two', 'three'):
+            os.unlink(self.source)
+            with open(self.source, 'wb') as fp:
+                fp.write('version %s' % version)
+            digests.append(store.store(self.source))
+        self.assertEquals(store.prune(), (2, len('version one') +
+                                          len('version two')))
+        self.assertEquals(store.find(digests[0]), None)
+        self.assertEquals(store.find(digests[1]), None)
+        self.assertTrue(store.find(digests[2]))
+        self.assertEquals([e['digest'] for e in store.entries()],
+                          digests[2:])
+        self.assertEquals(store.prune(), (0, 0))
+
+
 if __name__ == '__main__':
     unittest.main()